@@ -117,6 +117,9 @@ def cmdline_args():
                         help="Colon seperated weights for euclidean wirelength, hpwl and overlap")
     parser.add_argument("--shuffle_idxs", required=False, action="store_true",
                         help="shuffle agent idx prior to stepping in the environment")
+    parser.add_argument("--los_backend", required=False, default="raster",
+                        choices=["raster", "analytic"],
+                        help="computation of the line-of-sight and overlap observations")
 
     args = parser.parse_args()
     settings = {}
@@ -151,6 +154,7 @@ def cmdline_args():
     settings["o"] = float(rp[2])       # overlap
 
     settings["shuffle_idxs"] = args.shuffle_idxs
+    settings["los_backend"] = args.los_backend
     return args, settings
 
 def set_seed_everywhere(seed):
@@ -210,6 +214,7 @@ def evaluation_run(settings):
             "log_dir": None,
             "idx": j,
             "shuffle_idxs": settings["shuffle_idxs"],
+            "los_backend": settings["los_backend"],
             })
 
         eval_env = environment(env_params)
@@ -1,12 +1,19 @@
+import functools
 import torch
 import torch.nn.functional as F
 from torch.optim import Adam
-from utils import soft_update, hard_update, ReplayMemory
+from utils import PolyakUpdater, hard_update, make_replay_memory, is_prioritized, BatchPrefetcher
+from ensemble_critic import EnsembleCritic, match_critic_checkpoint
+from inference_engine import InferenceEngine
 import time
 import numpy as np
 
 import tracker
 import gym
+
+from core.environment.vector_environment import vector_environment
+from core.environment.environment_pool import environment_pool
+from collector import collector_pool
 LOG_SIG_MAX = 2
 LOG_SIG_MIN = -20
 epsilon = 1e-6
@@ -140,6 +147,15 @@ class GaussianPolicy(torch.nn.Module):
             _, _, action = self.sample(state)
         return action.detach().cpu().numpy()[0]
 
+    def select_actions(self, states, evaluate=False):
+        # one forward pass for a (batch, num_inputs) array of states
+        states = torch.FloatTensor(np.asarray(states)).to(self.device)
+        if evaluate is False:
+            actions, _, _ = self.sample(states)
+        else:
+            _, _, actions = self.sample(states)
+        return actions.detach().cpu().numpy()
+
 class SAC(object):
     def __init__(
             self,
@@ -162,7 +178,9 @@ class SAC(object):
         self.buffer_size = hyperparameters["buffer_size"]
         self.gradient_steps = 1
         self.policy_type = "Gaussian"
-        self.target_update_interval = 1
+        # gradient steps between target network updates
+        self.target_update_interval = hyperparameters.get(
+            "target_update_interval", 1)
         self.automatic_entropy_tuning = True
 
         if device == "cuda":
@@ -185,18 +203,31 @@ class SAC(object):
                 low=np.array([0,0,0],dtype=np.float32),
                 high=np.array([1,2*np.pi,1],dtype=np.float32))
 
-        self.critic = QNetwork(state_dim,
-                               action_dim,
-                               hyperparameters["net_arch"]["qf"],
-                               hyperparameters["activation_fn"]).to(device=self.device)
+        # "twin" (two torch.nn.Sequential Q-networks) or "ensemble"
+        # (critic_heads Q-heads evaluated in one batched pass)
+        if hyperparameters.get("critic", "twin") == "ensemble":
+            critic_class = functools.partial(
+                EnsembleCritic,
+                num_heads=hyperparameters.get("critic_heads", 2))
+        else:
+            critic_class = QNetwork
+
+        self.critic = critic_class(state_dim,
+                                   action_dim,
+                                   hyperparameters["net_arch"]["qf"],
+                                   hyperparameters["activation_fn"]).to(device=self.device)
         self.critic_optim = Adam(self.critic.parameters(), lr=self.lr)
 
-        self.critic_target = QNetwork(state_dim,
-                                      action_dim,
-                                      hyperparameters["net_arch"]["qf"],
-                                      hyperparameters["activation_fn"]).to(self.device)
+        self.critic_target = critic_class(state_dim,
+                                          action_dim,
+                                          hyperparameters["net_arch"]["qf"],
+                                          hyperparameters["activation_fn"]).to(self.device)
 
         hard_update(self.critic_target, self.critic)
+        self.target_updater = PolyakUpdater([self.critic_target],
+                                            [self.critic],
+                                            self.tau,
+                                            interval=self.target_update_interval)
 
         if self.automatic_entropy_tuning is True:
             if self.train_env is not None:
@@ -224,41 +255,61 @@ class SAC(object):
                                          device=device).to(self.device)
 
         self.policy_optim = Adam(self.policy.parameters(), lr=self.lr)
+        # acts with the policy in the environments; "eager", "script" or
+        # "compile"
+        self.inference_engine = InferenceEngine(
+            self.policy,
+            backend=hyperparameters.get("inference_backend", "eager"))
 
         # Memory
-        self.replay_buffer = ReplayMemory(
-            capacity=hyperparameters["buffer_size"],
-            device=self.device)
+        self.replay_buffer = make_replay_memory(
+            hyperparameters,
+            device=self.device,
+            log_dir=None if train_env is None else train_env.parameters.log_dir)
         self.trackr = tracker.tracker(avg_size=100,rl_policy_type="SAC")
+        # batches sampled ahead on a background thread; 0 samples in train
+        self.prefetch_batches = hyperparameters.get("prefetch_batches", 0)
 
         # Early stopping
         self.early_stopping = early_stopping
         self.exit = False
+        # gradient updates done by learn / learn_async
+        self.gradient_updates = 0
 
     def select_action(self, state, evaluate=False):
-        state = torch.FloatTensor(state).to(self.device).unsqueeze(0)
-        if evaluate is False:
-            action, _, _ = self.policy.sample(state)
-        else:
-            _, _, action = self.policy.sample(state)
-        return action.detach().cpu().numpy()[0]
+        return self.inference_engine.select_action(state, evaluate=evaluate)
 
     def train(self, memory, batch_size, updates):
         # Sample a batch from memory
-        state_batch, action_batch, next_state_batch, reward_batch, mask_batch = memory.sample(batch_size=batch_size)
+        prioritized = is_prioritized(memory)
+        if prioritized:
+            state_batch, action_batch, next_state_batch, reward_batch, mask_batch, weights, rows = \
+                memory.sample_prioritized(batch_size)
+        else:
+            state_batch, action_batch, next_state_batch, reward_batch, mask_batch = memory.sample(batch_size=batch_size)
 
         with torch.no_grad():
             next_state_action, next_state_log_pi, _ = self.policy.sample(next_state_batch)
-            qf1_next_target, qf2_next_target = self.critic_target(next_state_batch, next_state_action)
-            min_qf_next_target = torch.min(qf1_next_target, qf2_next_target) - self.alpha * next_state_log_pi
+            qf_next_targets = self.critic_target(next_state_batch, next_state_action)
+            min_qf_next_target = functools.reduce(torch.min, qf_next_targets) - self.alpha * next_state_log_pi
             next_q_value = reward_batch + mask_batch * self.gamma * (min_qf_next_target)
-        # Two Q-functions to mitigate positive bias in the policy improvement step
-        qf1, qf2 = self.critic(state_batch, action_batch)
+        # Two (or more) Q-functions to mitigate positive bias in the policy improvement step
+        qfs = self.critic(state_batch, action_batch)
 
         # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
-        qf1_loss = F.mse_loss(qf1, next_q_value)
-        qf2_loss = F.mse_loss(qf2, next_q_value)
-        qf_loss = qf1_loss + qf2_loss
+        if prioritized:
+            # importance-sampling weighted, and the TD errors become the new
+            # priorities of the batch
+            qf_losses = [(weights * (qf - next_q_value)**2).mean() for qf in qfs]
+            td_errors = functools.reduce(torch.max,
+                                         [torch.abs(qf - next_q_value)
+                                          for qf in qfs])
+            memory.update_priorities(rows, td_errors.detach().cpu().numpy())
+        else:
+            qf_losses = [F.mse_loss(qf, next_q_value) for qf in qfs]
+        # the losses of the first two heads are logged
+        qf1_loss, qf2_loss = qf_losses[0], qf_losses[1]
+        qf_loss = sum(qf_losses)
 
         self.critic_optim.zero_grad()
         qf_loss.backward()
@@ -266,8 +317,7 @@ class SAC(object):
 
         pi, log_pi, _ = self.policy.sample(state_batch)
 
-        qf1_pi, qf2_pi = self.critic(state_batch, pi)
-        min_qf_pi = torch.min(qf1_pi, qf2_pi)
+        min_qf_pi = functools.reduce(torch.min, self.critic(state_batch, pi))
         # Jπ = 𝔼st∼D,εt∼N[α * logπ(f(εt;st)|st) − Q(st,f(εt;st))]
         policy_loss = ((self.alpha * log_pi) - min_qf_pi).mean()
 
@@ -290,7 +340,7 @@ class SAC(object):
 
 
         if updates % self.target_update_interval == 0:
-            soft_update(self.critic_target, self.critic, self.tau)
+            self.target_updater.update()
 
         return qf1_loss.item(), qf2_loss.item(), policy_loss.item(), alpha_loss.item(), alpha_tlogs.item()
 
@@ -300,6 +350,16 @@ class SAC(object):
             print("Model cannot explore because training envrionment is missing. Please reload model and supply a training envrionment.")
             return
 
+        if isinstance(self.train_env, (vector_environment, environment_pool)):
+            # finished environments are reset by the vector environment
+            for _ in range(reward_target_exploration_steps):
+                self.train_env.step(self.policy,
+                                    random=True,
+                                    rl_model_type="SAC")
+            self.train_env.reset()
+            self.done = False
+            return
+
         self.done = False
         for _ in range(reward_target_exploration_steps):
             obs_vec = self.train_env.step(self.policy,
@@ -318,6 +378,74 @@ class SAC(object):
         self.train_env.reset()
         self.done = False
 
+    def step_vector_environment(self, random=False):
+        """
+        Steps every environment of the vector environment (or environment
+        pool) train_env once and adds the transitions to the replay buffer.
+
+        Returns:
+            list: the episodes that finished, as returned by
+            vector_environment.step and environment_pool.step.
+        """
+        steps = self.train_env.step(model=self.inference_engine,
+                                    random=random,
+                                    rl_model_type="SAC")
+        self.replay_buffer.add_batch(steps["state"],
+                                     steps["action"],
+                                     steps["next_state"],
+                                     steps["reward"],
+                                     1. - steps["done"])
+        return steps["episodes"]
+
+    def start_prefetching(self):
+        """
+        Replaces the replay buffer by a BatchPrefetcher when
+        prefetch_batches > 0, so that train pops batches prepared on a
+        background thread.
+        """
+        if self.prefetch_batches > 0:
+            self.replay_buffer = BatchPrefetcher(
+                self.replay_buffer, self.batch_size, depth=self.prefetch_batches)
+
+    def stop_prefetching(self):
+        """
+        Stops the prefetcher started by start_prefetching and restores the
+        replay buffer.
+        """
+        if isinstance(self.replay_buffer, BatchPrefetcher):
+            prefetcher = self.replay_buffer
+            self.replay_buffer = prefetcher.close()
+            print(f"prefetcher stalled on {prefetcher.stalls} of "
+                  f"{prefetcher.batches} batches ({prefetcher.stall_time:.2f}s)")
+
+    def grow_replay_buffer(self, t, next_update_at, incremental_replay_buffer):
+        """
+        Grows the replay buffer once timestep t reaches next_update_at,
+        following the incremental_replay_buffer schedule ("double", "triple"
+        or "quadruple"; None never grows it).
+
+        Returns:
+            int: the timestep at which the buffer grows next.
+        """
+        if incremental_replay_buffer is None or t < next_update_at:
+            return next_update_at
+
+        if incremental_replay_buffer == "double":
+            self.buffer_size *= 2
+            next_update_at += self.buffer_size * 2
+        elif incremental_replay_buffer == "triple":
+            self.buffer_size *= 3
+            next_update_at += self.buffer_size
+        elif incremental_replay_buffer == "quadruple":
+            self.buffer_size *= 4
+            next_update_at += self.buffer_size
+
+        self.replay_buffer.grow(self.buffer_size)
+
+        print(f"Updated replay buffer at timestep {t}; replay_buffer_size={self.buffer_size}, len={self.replay_buffer.__len__()} next_update_at={next_update_at}")
+
+        return next_update_at
+
     def learn(self,
               timesteps,
               callback,
@@ -330,11 +458,20 @@ class SAC(object):
 
         next_update_at = self.buffer_size*2
 
+        # A vector environment collects num_envs environment steps per
+        # iteration. t counts environment steps, so timesteps, start_timesteps
+        # and the replay buffer growth keep their meaning, and num_envs
+        # rounds of gradient updates are done per iteration to keep the ratio
+        # of updates to collected data unchanged.
+        vectorised = isinstance(self.train_env, (vector_environment, environment_pool))
+        num_envs = self.train_env.num_envs if vectorised else 1
+
         episode_reward = 0
         episode_timesteps = 0
         self.episode_num = 0
 
         callback.on_training_start()
+        self.start_prefetching()
 
         self.train_env.reset()
         self.done = False
@@ -351,49 +488,99 @@ class SAC(object):
         all_entropy_losses = []
 
         alpha =0
-        for t in range(1,int(timesteps)+1):
+        for t in range(num_envs, int(timesteps)+num_envs, num_envs):
             self.num_timesteps = t
             episode_timesteps += 1
 
-            if t < start_timesteps:
-                obs_vec = self.train_env.step(model=self.policy,
-                                              random=True,
-                                              rl_model_type="SAC")
+            if vectorised:
+                episodes = self.step_vector_environment(
+                    random=t < start_timesteps)
+                self.done = len(episodes) != 0
             else:
-                obs_vec = self.train_env.step(model=self.policy,
-                                              random=False,
-                                              rl_model_type="SAC")
-
-            all_rewards = []
-            for indiv_obs in obs_vec:
-                if indiv_obs[4] is True:
-                    self.done = True
-                all_rewards.append(indiv_obs[2])
-                transition = (indiv_obs[0],
-                              indiv_obs[3],
-                              indiv_obs[1],
-                              indiv_obs[2],
-                              1. -indiv_obs[4])
-                self.replay_buffer.add(*transition)
-
-            episode_reward += float(np.mean(np.array(all_rewards)))
+                if t < start_timesteps:
+                    obs_vec = self.train_env.step(model=self.inference_engine,
+                                                  random=True,
+                                                  rl_model_type="SAC")
+                else:
+                    obs_vec = self.train_env.step(model=self.inference_engine,
+                                                  random=False,
+                                                  rl_model_type="SAC")
+
+                all_rewards = []
+                for indiv_obs in obs_vec:
+                    if indiv_obs[4] is True:
+                        self.done = True
+                    all_rewards.append(indiv_obs[2])
+                    transition = (indiv_obs[0],
+                                  indiv_obs[3],
+                                  indiv_obs[1],
+                                  indiv_obs[2],
+                                  1. -indiv_obs[4])
+                    self.replay_buffer.add(*transition)
+
+                episode_reward += float(np.mean(np.array(all_rewards)))
 
             if t >= start_timesteps:
                 if len(self.replay_buffer) > self.batch_size:
                     # Number of updates per step in environment
-                    for _ in range(self.gradient_steps):
+                    for _ in range(self.gradient_steps * num_envs):
                         # Update parameters of all the networks
                         critic_1_loss, critic_2_loss, policy_loss, ent_loss, alpha = self.train(self.replay_buffer,
                                                                                                 self.batch_size,
                                                                                                 updates)
                         updates += 1
+                        self.gradient_updates += 1
 
                         all_actor_losses.append(policy_loss)
                         all_critic_1_losses.append(critic_1_loss)
                         all_critic_2_losses.append(critic_2_loss)
                         all_entropy_losses.append(ent_loss)
 
-            if self.done:
+            if vectorised:
+                # one callback step per environment step, reporting the
+                # episodes of that environment
+                for e in range(num_envs):
+                    self.num_timesteps = t - num_envs + 1 + e
+                    for episode in episodes:
+                        if episode["env"] != e:
+                            continue
+                        self.done = True
+                        if t < start_timesteps or len(self.replay_buffer) <= self.batch_size:
+                            self.trackr.append(actor_loss=0,
+                                   critic_loss=0,
+                                   episode_reward=episode["episode_reward"],
+                                   episode_length=episode["episode_length"],
+                                   episode_fps=episode["episode_fps"],
+                                   critic_1_loss=0,
+                                   critic_2_loss=0,
+                                   entropy_loss=0,
+                                   entropy=0)
+                        else:
+                            self.trackr.append(actor_loss=np.mean(all_actor_losses),
+                                   critic_loss=np.mean(all_critic_1_losses+all_critic_2_losses),
+                                   episode_reward=episode["episode_reward"],
+                                   episode_length=episode["episode_length"],
+                                   episode_fps=episode["episode_fps"],
+                                   critic_1_loss=np.mean(all_critic_1_losses),
+                                   critic_2_loss=np.mean(all_critic_2_losses),
+                                   entropy_loss=np.mean(all_entropy_losses),
+                                   entropy=alpha)
+
+                    callback.on_step()
+                    if self.done:
+                        # finished environments were reset by the vector
+                        # environment
+                        self.done = False
+                        self.episode_num += 1
+                    if self.exit is True:
+                        break
+
+                if len(episodes) != 0:
+                    all_actor_losses = []
+                    all_critic_1_losses = []
+                    all_critic_2_losses = []
+                    all_entropy_losses = []
+            elif self.done:
                 episode_finish_time = time.clock_gettime(time.CLOCK_REALTIME)
                 if t < start_timesteps or len(self.replay_buffer) <= self.batch_size:
                     self.trackr.append(actor_loss=0,
@@ -416,7 +603,8 @@ class SAC(object):
                            entropy_loss=np.mean(all_entropy_losses),
                            entropy=alpha)
 
-            callback.on_step()
+            if not vectorised:
+                callback.on_step()
             if self.done:
                 self.train_env.reset()
                 self.done = False
@@ -436,25 +624,123 @@ class SAC(object):
                 print(f"Early stopping mechanism triggered at timestep={self.num_timesteps} after {self.early_stopping} steps without improvement ... Learning terminated.")
                 break
 
-            if incremental_replay_buffer is not None:
-                if t >= next_update_at:
-                    if incremental_replay_buffer == "double":
-                        self.buffer_size *= 2
-                        next_update_at += self.buffer_size * 2
-                    elif incremental_replay_buffer == "triple":
-                        self.buffer_size *= 3
-                        next_update_at += self.buffer_size
-                    elif incremental_replay_buffer == "quadruple":
-                        self.buffer_size *= 4
-                        next_update_at += self.buffer_size
-
-                    old_replay_buffer = self.replay_buffer
-                    self.replay_buffer = ReplayMemory(self.buffer_size,
-                                                      device=self.device)
-                    self.replay_buffer.add_content_of(old_replay_buffer)
-
-                    print(f"Updated replay buffer at timestep {t}; replay_buffer_size={self.buffer_size}, len={self.replay_buffer.__len__()} next_update_at={next_update_at}")
+            next_update_at = self.grow_replay_buffer(
+                t, next_update_at, incremental_replay_buffer)
 
+        self.stop_prefetching()
+        callback.on_training_end()
+
+    def learn_async(self,
+                    timesteps,
+                    callback,
+                    start_timesteps=25_000,
+                    num_collectors=1,
+                    num_envs=1,
+                    target_exploration_steps=0,
+                    weight_sync_interval=100,
+                    max_update_to_data_ratio=None,
+                    incremental_replay_buffer=None):
+        """
+        Asynchronous actor-learner variant of learn; see TD3.learn_async.
+        """
+        if self.train_env is None:
+            print("Model cannot learn because training envrionment is missing. Please reload model and supply a training envrionment.")
+            return
+
+        next_update_at = self.buffer_size*2
+
+        self.episode_num = 0
+        self.num_timesteps = 0
+        self.done = False
+
+        all_actor_losses = []
+        all_critic_1_losses = []
+        all_critic_2_losses = []
+        all_entropy_losses = []
+        alpha = 0
+
+        callback.on_training_start()
+        self.start_prefetching()
+        collectors = collector_pool(self.train_env.parameters,
+                                    self.policy,
+                                    "SAC",
+                                    num_collectors=num_collectors,
+                                    num_envs=num_envs,
+                                    start_timesteps=start_timesteps,
+                                    exploration_steps=target_exploration_steps)
+        t = 0
+        try:
+            while t < timesteps and self.exit is False:
+                can_train = t >= start_timesteps and \
+                    len(self.replay_buffer) > self.batch_size and \
+                    (max_update_to_data_ratio is None or
+                     self.gradient_updates < max_update_to_data_ratio * t)
+
+                for item in collectors.get(block=not can_train):
+                    for e in np.unique(item["env"]):
+                        t += 1
+                        self.num_timesteps = t
+                        rows = item["env"] == e
+                        self.replay_buffer.add_batch(item["state"][rows],
+                                                     item["action"][rows],
+                                                     item["next_state"][rows],
+                                                     item["reward"][rows],
+                                                     1. - item["done"][rows])
+                        for episode in item["episodes"]:
+                            if episode["env"] != e:
+                                continue
+                            self.done = True
+                            if len(all_actor_losses) == 0:
+                                self.trackr.append(actor_loss=0,
+                                       critic_loss=0,
+                                       episode_reward=episode["episode_reward"],
+                                       episode_length=episode["episode_length"],
+                                       episode_fps=episode["episode_fps"],
+                                       critic_1_loss=0,
+                                       critic_2_loss=0,
+                                       entropy_loss=0,
+                                       entropy=0)
+                            else:
+                                self.trackr.append(actor_loss=np.mean(all_actor_losses),
+                                       critic_loss=np.mean(all_critic_1_losses+all_critic_2_losses),
+                                       episode_reward=episode["episode_reward"],
+                                       episode_length=episode["episode_length"],
+                                       episode_fps=episode["episode_fps"],
+                                       critic_1_loss=np.mean(all_critic_1_losses),
+                                       critic_2_loss=np.mean(all_critic_2_losses),
+                                       entropy_loss=np.mean(all_entropy_losses),
+                                       entropy=alpha)
+
+                        callback.on_step()
+                        if self.done:
+                            self.done = False
+                            self.episode_num += 1
+                            all_actor_losses = []
+                            all_critic_1_losses = []
+                            all_critic_2_losses = []
+                            all_entropy_losses = []
+                collectors.set_timesteps(t)
+                next_update_at = self.grow_replay_buffer(
+                    t, next_update_at, incremental_replay_buffer)
+
+                if can_train:
+                    critic_1_loss, critic_2_loss, policy_loss, ent_loss, alpha = self.train(self.replay_buffer,
+                                                                                            self.batch_size,
+                                                                                            self.gradient_updates)
+                    self.gradient_updates += 1
+                    all_actor_losses.append(policy_loss)
+                    all_critic_1_losses.append(critic_1_loss)
+                    all_critic_2_losses.append(critic_2_loss)
+                    all_entropy_losses.append(ent_loss)
+                    if self.gradient_updates % weight_sync_interval == 0:
+                        collectors.publish(self.policy)
+        finally:
+            collectors.close()
+            self.stop_prefetching()
+
+        if self.exit is True:
+            print(f"Early stopping mechanism triggered at timestep={self.num_timesteps} after {self.early_stopping} steps without improvement ... Learning terminated.")
+        print(f"update-to-data ratio={self.gradient_updates / max(t, 1)} ({self.gradient_updates} updates, {t} timesteps)")
         callback.on_training_end()
 
     # Save model parameters
@@ -469,10 +755,17 @@ class SAC(object):
     def load(self, filename):
         checkpoint = torch.load(filename)
         self.policy.load_state_dict(checkpoint["policy_state_dict"])
-        self.critic.load_state_dict(checkpoint["critic_state_dict"])
-        self.critic_target.load_state_dict(
-            checkpoint["critic_target_state_dict"])
-        self.critic_optim.load_state_dict(
+        # checkpoints of twin and ensemble critics are converted to the
+        # critic of this model
+        critic_state, critic_optimizer_state = match_critic_checkpoint(
+            self.critic,
+            checkpoint["critic_state_dict"],
             checkpoint["critic_optimizer_state_dict"])
+        critic_target_state, _ = match_critic_checkpoint(
+            self.critic_target,
+            checkpoint["critic_target_state_dict"])
+        self.critic.load_state_dict(critic_state)
+        self.critic_target.load_state_dict(critic_target_state)
+        self.critic_optim.load_state_dict(critic_optimizer_state)
         self.policy_optim.load_state_dict(
             checkpoint["policy_optimizer_state_dict"])
@@ -1,4 +1,5 @@
 import copy
+import functools
 import numpy as np
 import torch
 import torch.nn as nn
@@ -8,6 +9,12 @@ import utils
 import tracker
 import time
 
+from core.environment.vector_environment import vector_environment
+from core.environment.environment_pool import environment_pool
+from collector import collector_pool
+from ensemble_critic import EnsembleCritic, match_critic_checkpoint
+from inference_engine import InferenceEngine
+
 # Implementation of Twin Delayed Deep Deterministic Policy Gradients (TD3)
 # Paper: https://arxiv.org/abs/1802.09477
 
@@ -47,6 +54,11 @@ class Actor(nn.Module):
         state = torch.FloatTensor(state.reshape(1, -1)).to(self.device)
         return self.forward(state).cpu().data.numpy().flatten()
 
+    def select_actions(self, states):
+        # one forward pass for a (batch, state_dim) array of states
+        states = torch.FloatTensor(np.asarray(states)).to(self.device)
+        return self.forward(states).cpu().data.numpy()
+
 class Critic(nn.Module):
     def __init__(self,
                  state_dim,
@@ -137,11 +149,26 @@ class TD3(object):
         self.actor_target = copy.deepcopy(self.actor)
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(),
                                                 lr=hyperparameters["learning_rate"])
-
-        self.critic = Critic(state_dim,
-                             action_dim,
-                             hyperparameters["net_arch"]["qf"],
-                             hyperparameters["activation_fn"]).to(self.device)
+        # acts with the actor in the environments; "eager", "script" or
+        # "compile"
+        self.inference_engine = InferenceEngine(
+            self.actor,
+            backend=hyperparameters.get("inference_backend", "eager"))
+
+        # "twin" (two torch.nn.Sequential Q-networks) or "ensemble"
+        # (critic_heads Q-heads evaluated in one batched pass)
+        if hyperparameters.get("critic", "twin") == "ensemble":
+            self.critic = EnsembleCritic(
+                state_dim,
+                action_dim,
+                hyperparameters["net_arch"]["qf"],
+                hyperparameters["activation_fn"],
+                num_heads=hyperparameters.get("critic_heads", 2)).to(self.device)
+        else:
+            self.critic = Critic(state_dim,
+                                 action_dim,
+                                 hyperparameters["net_arch"]["qf"],
+                                 hyperparameters["activation_fn"]).to(self.device)
         self.critic_target = copy.deepcopy(self.critic)
         self.critic_optimizer = torch.optim.Adam(self.critic.parameters(),
                                                  lr=hyperparameters["learning_rate"])
@@ -154,26 +181,49 @@ class TD3(object):
         self.policy_noise = hyperparameters["policy_noise"] * self.max_action
         self.noise_clip = hyperparameters["noise_clip"] * self.max_action
         self.policy_freq = hyperparameters["policy_freq"]
-
-        self.replay_buffer = utils.ReplayMemory(hyperparameters["buffer_size"],
-                                                device=self.device)
+        # delayed policy updates between target network updates
+        self.target_update_interval = hyperparameters.get(
+            "target_update_interval", 1)
+        self._build_target_updater()
+
+        self.replay_buffer = utils.make_replay_memory(
+            hyperparameters,
+            device=self.device,
+            log_dir=None if train_env is None else train_env.parameters.log_dir)
         self.trackr = tracker.tracker(100)
+        # batches sampled ahead on a background thread; 0 samples in train
+        self.prefetch_batches = hyperparameters.get("prefetch_batches", 0)
 
         # Early stopping
         self.early_stopping = early_stopping
         self.exit = False
 
         self.total_it = 0
+        # gradient updates done by learn / learn_async
+        self.gradient_updates = 0
+
+    def _build_target_updater(self):
+        # the updater keeps the parameter lists of the networks, so it is
+        # rebuilt whenever the target networks are replaced
+        self.target_updater = utils.PolyakUpdater(
+            [self.critic_target, self.actor_target],
+            [self.critic, self.actor],
+            self.tau,
+            interval=self.target_update_interval)
 
     def select_action(self, state):
-        state = torch.FloatTensor(state.reshape(1, -1)).to(self.device)
-        return self.actor(state).cpu().data.numpy().flatten()
+        return self.inference_engine.select_action(state)
 
     def train(self, replay_buffer):
         self.total_it += 1
 
         # Sample replay buffer
-        state, action, next_state, reward, not_done = replay_buffer.sample(self.batch_size)
+        prioritized = utils.is_prioritized(replay_buffer)
+        if prioritized:
+            state, action, next_state, reward, not_done, weights, rows = \
+                replay_buffer.sample_prioritized(self.batch_size)
+        else:
+            state, action, next_state, reward, not_done = replay_buffer.sample(self.batch_size)
 
         with torch.no_grad():
             # Select action according to policy and add clipped noise
@@ -185,16 +235,28 @@ class TD3(object):
 		    self.actor_target(next_state) + noise
 			).clamp(-self.max_action, self.max_action)
 
-            # Compute the target Q value
-            target_Q1, target_Q2 = self.critic_target(next_state, next_action)
-            target_Q = torch.min(target_Q1, target_Q2)
+            # Compute the target Q value, the minimum over the Q-heads
+            target_Qs = self.critic_target(next_state, next_action)
+            target_Q = functools.reduce(torch.min, target_Qs)
             target_Q = reward + not_done * self.discount * target_Q
 
         # Get current Q estimates
-        current_Q1, current_Q2 = self.critic.forward(state, action)
+        current_Qs = self.critic.forward(state, action)
 
         # Compute critic loss
-        critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q)
+        if prioritized:
+            # importance-sampling weighted, and the TD errors become the new
+            # priorities of the batch
+            critic_loss = (weights * sum((current_Q - target_Q)**2
+                                         for current_Q in current_Qs)).mean()
+            td_errors = functools.reduce(torch.max,
+                                         [torch.abs(current_Q - target_Q)
+                                          for current_Q in current_Qs])
+            replay_buffer.update_priorities(
+                rows, td_errors.detach().cpu().numpy())
+        else:
+            critic_loss = sum(F.mse_loss(current_Q, target_Q)
+                              for current_Q in current_Qs)
 
         # Optimize the critic
         self.critic_optimizer.zero_grad()
@@ -213,15 +275,9 @@ class TD3(object):
             self.actor_optimizer.step()
 
             # Update the frozen target models
-            for param, target_param in zip(self.critic.parameters(),
-                                           self.critic_target.parameters()
-                                           ):
-                target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
-
-            for param, target_param in zip(self.actor.parameters(),
-                                           self.actor_target.parameters()
-                                           ):
-                target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
+            if (self.total_it // self.policy_freq) \
+                    % self.target_update_interval == 0:
+                self.target_updater.update()
 
             return critic_loss.cpu().detach().numpy(), actor_loss.cpu().detach().numpy()
 
@@ -237,13 +293,20 @@ class TD3(object):
                    filename + "_actor_optimizer")
 
     def load(self, filename):
-        self.critic.load_state_dict(torch.load(filename + "_critic"))
-        self.critic_optimizer.load_state_dict(torch.load(filename + "_critic_optimizer"))
+        # checkpoints of twin and ensemble critics are converted to the
+        # critic of this model
+        critic_state, critic_optimizer_state = match_critic_checkpoint(
+            self.critic,
+            torch.load(filename + "_critic"),
+            torch.load(filename + "_critic_optimizer"))
+        self.critic.load_state_dict(critic_state)
+        self.critic_optimizer.load_state_dict(critic_optimizer_state)
         self.critic_target = copy.deepcopy(self.critic)
 
         self.actor.load_state_dict(torch.load(filename + "_actor"))
         self.actor_optimizer.load_state_dict(torch.load(filename + "_actor_optimizer"))
         self.actor_target = copy.deepcopy(self.actor)
+        self._build_target_updater()
 
     def explore_for_expert_targets(self,
                                    reward_target_exploration_steps=25_000):
@@ -252,6 +315,14 @@ class TD3(object):
                   missing. Please reload model and supply a training envrionment.")
             return
 
+        if isinstance(self.train_env, (vector_environment, environment_pool)):
+            # finished environments are reset by the vector environment
+            for t in range(reward_target_exploration_steps):
+                self.train_env.step(self.actor, random=True)
+            self.train_env.reset()
+            self.done = False
+            return
+
         self.done = False
         for t in range(reward_target_exploration_steps):
             obs_vec = self.train_env.step(self.actor, random=True)
@@ -269,6 +340,75 @@ class TD3(object):
         self.train_env.reset()
         self.done = False
 
+    def step_vector_environment(self, random=False):
+        """
+        Steps every environment of the vector environment (or environment
+        pool) train_env once and adds the transitions to the replay buffer.
+
+        Returns:
+            list: the episodes that finished, as returned by
+            vector_environment.step and environment_pool.step.
+        """
+        steps = self.train_env.step(model=self.inference_engine, random=random)
+        self.replay_buffer.add_batch(steps["state"],
+                                     steps["action"],
+                                     steps["next_state"],
+                                     steps["reward"],
+                                     1. - steps["done"])
+        return steps["episodes"]
+
+    def start_prefetching(self):
+        """
+        Replaces the replay buffer by a utils.BatchPrefetcher when
+        prefetch_batches > 0, so that train pops batches prepared on a
+        background thread.
+        """
+        if self.prefetch_batches > 0:
+            self.replay_buffer = utils.BatchPrefetcher(
+                self.replay_buffer, self.batch_size, depth=self.prefetch_batches)
+
+    def stop_prefetching(self):
+        """
+        Stops the prefetcher started by start_prefetching and restores the
+        replay buffer.
+        """
+        if isinstance(self.replay_buffer, utils.BatchPrefetcher):
+            prefetcher = self.replay_buffer
+            self.replay_buffer = prefetcher.close()
+            print(f"prefetcher stalled on {prefetcher.stalls} of "
+                  f"{prefetcher.batches} batches ({prefetcher.stall_time:.2f}s)")
+
+    def grow_replay_buffer(self, t, next_update_at, incremental_replay_buffer):
+        """
+        Grows the replay buffer once timestep t reaches next_update_at,
+        following the incremental_replay_buffer schedule ("double", "triple"
+        or "quadruple"; None never grows it).
+
+        Returns:
+            int: the timestep at which the buffer grows next.
+        """
+        if incremental_replay_buffer is None or t < next_update_at:
+            return next_update_at
+
+        if incremental_replay_buffer == "double":
+            self.buffer_size *= 2
+            next_update_at += self.buffer_size * 2
+        elif incremental_replay_buffer == "triple":
+            self.buffer_size *= 3
+            next_update_at += self.buffer_size# * 3
+        elif incremental_replay_buffer == "quadruple":
+            self.buffer_size *= 4
+            next_update_at += self.buffer_size# * 3
+
+        self.replay_buffer.grow(self.buffer_size)
+
+        print(f"Updated replay buffer at timestep {t};\
+               replay_buffer_size={self.buffer_size},\
+               len={self.replay_buffer.__len__()}\
+               next_update_at={next_update_at}")
+
+        return next_update_at
+
     def learn(self,
               timesteps,
               callback,
@@ -282,11 +422,20 @@ class TD3(object):
 
         next_update_at = self.buffer_size*2
 
+        # A vector environment collects num_envs environment steps per
+        # iteration. t counts environment steps, so timesteps, start_timesteps
+        # and the replay buffer growth keep their meaning, and num_envs
+        # gradient updates are done per iteration to keep the ratio of
+        # updates to collected data unchanged.
+        vectorised = isinstance(self.train_env, (vector_environment, environment_pool))
+        num_envs = self.train_env.num_envs if vectorised else 1
+
         episode_reward = 0
         episode_timesteps = 0
         self.episode_num = 0
 
         callback.on_training_start()
+        self.start_prefetching()
 
         self.train_env.reset()
         self.done = False
@@ -294,29 +443,66 @@ class TD3(object):
 
         episode_start_time = start_time
 
-        for t in range(1,int(timesteps)+1):
+        for t in range(num_envs, int(timesteps)+num_envs, num_envs):
             self.num_timesteps = t
 
             episode_timesteps += 1
-            if t < start_timesteps:
-                obs_vec = self.train_env.step(model=self.actor, random=True)
+            if vectorised:
+                episodes = self.step_vector_environment(
+                    random=t < start_timesteps)
+                self.done = len(episodes) != 0
             else:
-                obs_vec = self.train_env.step(model=self.actor, random=False)
+                if t < start_timesteps:
+                    obs_vec = self.train_env.step(model=self.inference_engine, random=True)
+                else:
+                    obs_vec = self.train_env.step(model=self.inference_engine, random=False)
 
-            all_rewards = []
-            for indiv_obs in obs_vec:
-                if indiv_obs[4] is True:
-                    self.done = True
-                all_rewards.append(indiv_obs[2])
-                transition = (indiv_obs[0], indiv_obs[3], indiv_obs[1], indiv_obs[2], 1. -indiv_obs[4])
-                self.replay_buffer.add(*transition)
+                all_rewards = []
+                for indiv_obs in obs_vec:
+                    if indiv_obs[4] is True:
+                        self.done = True
+                    all_rewards.append(indiv_obs[2])
+                    transition = (indiv_obs[0], indiv_obs[3], indiv_obs[1], indiv_obs[2], 1. -indiv_obs[4])
+                    self.replay_buffer.add(*transition)
 
-            episode_reward += float(np.mean(np.array(all_rewards)))
+                episode_reward += float(np.mean(np.array(all_rewards)))
 
             if t >= start_timesteps:
-                critic_loss, actor_loss = self.train(self.replay_buffer)
-
-            if self.done:
+                for _ in range(num_envs):
+                    critic_loss, actor_loss = self.train(self.replay_buffer)
+                    self.gradient_updates += 1
+
+            if vectorised:
+                # one callback step per environment step, reporting the
+                # episodes of that environment
+                for e in range(num_envs):
+                    self.num_timesteps = t - num_envs + 1 + e
+                    for episode in episodes:
+                        if episode["env"] != e:
+                            continue
+                        self.done = True
+                        if t < start_timesteps:
+                            self.trackr.append(actor_loss=0,
+                                               critic_loss=0,
+                                               episode_reward=episode["episode_reward"],
+                                               episode_length=episode["episode_length"],
+                                               episode_fps=episode["episode_fps"])
+                        else:
+                            self.trackr.append(actor_loss=actor_loss,
+                                               critic_loss=critic_loss,
+                                               episode_reward=episode["episode_reward"],
+                                               episode_length=episode["episode_length"],
+                                               episode_fps=episode["episode_fps"])
+
+                    callback.on_step()
+                    if self.done:
+                        # finished environments were reset by the vector
+                        # environment
+                        self.done = False
+                        self.episode_num += 1
+                    if self.exit is True:
+                        break
+            elif self.done:
                 episode_finish_time = time.clock_gettime(time.CLOCK_REALTIME)
                 if t < start_timesteps:
                     self.trackr.append(actor_loss=0,
@@ -331,7 +517,8 @@ class TD3(object):
                            episode_length = episode_timesteps,
                            episode_fps = episode_timesteps / (episode_finish_time - episode_start_time))
 
-            callback.on_step()
+            if not vectorised:
+                callback.on_step()
             if self.done:
                 self.train_env.reset()
                 self.done = False
@@ -348,26 +535,113 @@ class TD3(object):
                        without improvement ... Learning terminated.")
                 break
 
-            if incremental_replay_buffer is not None:
-                if t >= next_update_at:
-                    if incremental_replay_buffer == "double":
-                        self.buffer_size *= 2
-                        next_update_at += self.buffer_size * 2
-                    elif incremental_replay_buffer == "triple":
-                        self.buffer_size *= 3
-                        next_update_at += self.buffer_size# * 3
-                    elif incremental_replay_buffer == "quadruple":
-                        self.buffer_size *= 4
-                        next_update_at += self.buffer_size# * 3
-
-                    old_replay_buffer = self.replay_buffer
-                    self.replay_buffer = utils.ReplayMemory(self.buffer_size,
-                                                            device=self.device)
-                    self.replay_buffer.add_content_of(old_replay_buffer)
-
-                    print(f"Updated replay buffer at timestep {t};\
-                           replay_buffer_size={self.buffer_size},\
-                           len={self.replay_buffer.__len__()}\
-                           next_update_at={next_update_at}")
+            next_update_at = self.grow_replay_buffer(
+                t, next_update_at, incremental_replay_buffer)
+
+        self.stop_prefetching()
+        callback.on_training_end()
+
+    def learn_async(self,
+                    timesteps,
+                    callback,
+                    start_timesteps=25_000,
+                    num_collectors=1,
+                    num_envs=1,
+                    target_exploration_steps=0,
+                    weight_sync_interval=100,
+                    max_update_to_data_ratio=None,
+                    incremental_replay_buffer=None):
+        """
+        Asynchronous actor-learner variant of learn. Collector processes
+        step their own environments with a copy of the actor, refreshed
+        every weight_sync_interval updates, while this process trains
+        continuously on the replay buffer.
+
+        A timestep is one step of one collector environment; the callback is
+        called once per timestep, as in learn. The update-to-data ratio
+        (gradient_updates / timesteps) is not fixed; it is bounded by
+        max_update_to_data_ratio when given, by waiting for data.
+
+        Args:
+            num_collectors (int): number of collector processes.
+            num_envs (int): environments stepped by every collector.
+            target_exploration_steps (int): random steps every collector
+            takes to explore expert targets; replaces
+            explore_for_expert_targets, whose targets would stay in this
+            process.
+            incremental_replay_buffer (str): replay buffer growth schedule,
+            as in learn.
+        """
+        if self.train_env is None:
+            print("Model cannot explore because training envrionment is\
+                  missing. Please reload model and supply a training envrionment.")
+            return
+
+        next_update_at = self.buffer_size*2
+
+        self.episode_num = 0
+        self.num_timesteps = 0
+        self.done = False
+        critic_loss, actor_loss = 0, 0
 
+        callback.on_training_start()
+        self.start_prefetching()
+        collectors = collector_pool(self.train_env.parameters,
+                                    self.actor,
+                                    "TD3",
+                                    num_collectors=num_collectors,
+                                    num_envs=num_envs,
+                                    start_timesteps=start_timesteps,
+                                    exploration_steps=target_exploration_steps)
+        t = 0
+        try:
+            while t < timesteps and self.exit is False:
+                can_train = t >= start_timesteps and \
+                    len(self.replay_buffer) >= self.batch_size and \
+                    (max_update_to_data_ratio is None or
+                     self.gradient_updates < max_update_to_data_ratio * t)
+
+                for item in collectors.get(block=not can_train):
+                    for e in np.unique(item["env"]):
+                        t += 1
+                        self.num_timesteps = t
+                        rows = item["env"] == e
+                        self.replay_buffer.add_batch(item["state"][rows],
+                                                     item["action"][rows],
+                                                     item["next_state"][rows],
+                                                     item["reward"][rows],
+                                                     1. - item["done"][rows])
+                        for episode in item["episodes"]:
+                            if episode["env"] != e:
+                                continue
+                            self.done = True
+                            self.trackr.append(actor_loss=actor_loss,
+                                               critic_loss=critic_loss,
+                                               episode_reward=episode["episode_reward"],
+                                               episode_length=episode["episode_length"],
+                                               episode_fps=episode["episode_fps"])
+
+                        callback.on_step()
+                        if self.done:
+                            self.done = False
+                            self.episode_num += 1
+                collectors.set_timesteps(t)
+                next_update_at = self.grow_replay_buffer(
+                    t, next_update_at, incremental_replay_buffer)
+
+                if can_train:
+                    critic_loss, actor_loss = self.train(self.replay_buffer)
+                    self.gradient_updates += 1
+                    if self.gradient_updates % weight_sync_interval == 0:
+                        collectors.publish(self.actor)
+        finally:
+            collectors.close()
+            self.stop_prefetching()
+
+        if self.exit is True:
+            print(f"Early stopping mechanism triggered at timestep=\
+                  {self.num_timesteps} after {self.early_stopping} steps\
+                   without improvement ... Learning terminated.")
+        print(f"update-to-data ratio={self.gradient_updates / max(t, 1)} "
+              f"({self.gradient_updates} updates, {t} timesteps)")
         callback.on_training_end()
@@ -5,6 +5,7 @@ from datetime import datetime
 
 from torch.utils.tensorboard import SummaryWriter
 from core.environment.environment import environment
+from utils import BatchPrefetcher
 
 from pcb import pcb
 from graph import graph     # Necessary for graph related methods
@@ -124,6 +125,16 @@ class log_and_eval_callback():
             self.writer.add_scalar(tag="rollout/fps",
                                    scalar_value=mean_fps,
                                    global_step=self.model.num_timesteps)
+            self.writer.add_scalar(tag="training/update_to_data_ratio",
+                                   scalar_value=self.model.gradient_updates / self.model.num_timesteps,
+                                   global_step=self.model.num_timesteps)
+            if isinstance(self.model.replay_buffer, BatchPrefetcher):
+                self.writer.add_scalar(tag="training/prefetch_stall_fraction",
+                                       scalar_value=self.model.replay_buffer.stall_fraction(),
+                                       global_step=self.model.num_timesteps)
+                self.writer.add_scalar(tag="training/prefetch_stall_time",
+                                       scalar_value=self.model.replay_buffer.stall_time,
+                                       global_step=self.model.num_timesteps)
 
             mean_actor_loss = np.round(
                 np.mean(self.model.trackr.critic_losses),2)
@@ -389,16 +400,10 @@ class log_and_eval_callback():
             episode_steps=0
             while not done:
                 episode_steps += 1
-                if self.rl_model_type == "TD3":
-                    obs_vec = eval_env.step(model=self.model.actor,
-                                            random=False,
-                                            deterministic=True,
-                                            rl_model_type=self.rl_model_type)
-                else:
-                    obs_vec = eval_env.step(model=self.model.policy,
-                                            random=False,
-                                            deterministic=True,
-                                            rl_model_type=self.rl_model_type)
+                obs_vec = eval_env.step(model=self.model.inference_engine,
+                                        random=False,
+                                        deterministic=True,
+                                        rl_model_type=self.rl_model_type)
                 step_reward=0
 
                 if quick_eval is False: # save best layouts, log video
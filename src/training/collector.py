@@ -0,0 +1,215 @@
+"""
+This module collects transitions in background processes, for asynchronous
+actor-learner training.
+
+Module: collector
+
+Classes:
+
+    collector_pool: Starts collector processes that each step a
+    vector_environment with their own copy of the policy and push the
+    transitions through a queue. The learner publishes its policy weights
+    every few updates; collectors pick them up before their next step.
+
+Usage example:
+from collector import collector_pool
+
+collectors = collector_pool(env_params, model.actor, "TD3", num_collectors=2)
+for item in collectors.get(block=True):
+    ...
+collectors.publish(model.actor)
+collectors.close()
+
+"""
+import copy
+import queue
+import random as random_package
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from core.environment.vector_environment import vector_environment, derive_seeds
+from inference_engine import InferenceEngine
+
+def _collector(index,
+               parameters,
+               seeds,
+               shared_policy,
+               version,
+               lock,
+               timesteps,
+               start_timesteps,
+               exploration_steps,
+               rl_model_type,
+               transitions,
+               stop):
+    # Steps a vector_environment with the latest published policy until
+    # stop is set; see collector_pool.
+    torch.set_num_threads(1)
+    random_package.seed(seeds[0])
+    np.random.seed(seeds[0] % 2**32)
+    torch.manual_seed(seeds[0])
+
+    envs = vector_environment(parameters, seeds=seeds)
+    envs.reset()
+    # expert targets are kept by the environments, so every collector
+    # explores its own
+    for _ in range(exploration_steps):
+        envs.step(None, random=True, rl_model_type=rl_model_type)
+    envs.reset()
+
+    policy = copy.deepcopy(shared_policy)
+    engine = InferenceEngine(policy)
+    policy_version = -1
+    offset = index * len(seeds)
+    while not stop.is_set():
+        if version.value != policy_version:
+            with lock:
+                policy.load_state_dict(shared_policy.state_dict())
+                policy_version = version.value
+
+        with torch.no_grad():
+            steps = envs.step(engine,
+                              random=timesteps.value < start_timesteps,
+                              rl_model_type=rl_model_type)
+        for episode in steps["episodes"]:
+            episode["env"] += offset
+        item = {"state": steps["state"],
+                "action": steps["action"],
+                "next_state": steps["next_state"],
+                "reward": steps["reward"],
+                "done": steps["done"],
+                "env": steps["env"] + offset,
+                "episodes": steps["episodes"],
+                "policy_version": policy_version}
+
+        while not stop.is_set():
+            try:
+                transitions.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+
+class collector_pool:
+    """
+    Collector processes for asynchronous actor-learner training.
+
+    Collector c steps num_envs environments seeded with
+    derive_seeds(parameters.seed, num_collectors * num_envs)[c * num_envs:
+    (c + 1) * num_envs], acting randomly until the learner reports
+    start_timesteps timesteps.
+
+    Args:
+        parameters: environment parameters.
+        policy: TD3 actor or SAC policy of the learner; a CPU copy in shared
+        memory is handed to the collectors.
+        rl_model_type (str): "TD3" or "SAC".
+        num_collectors (int): number of collector processes.
+        num_envs (int): environments stepped in lockstep by every collector.
+        start_timesteps (int): timesteps with random actions.
+        exploration_steps (int): random steps every collector takes to
+        explore expert targets before collecting.
+        queue_size (int): maximum number of collected steps waiting for the
+        learner; collectors block when it is full.
+
+    Attributes:
+        version (int): number of times weights were published.
+    """
+    def __init__(self,
+                 parameters,
+                 policy,
+                 rl_model_type,
+                 num_collectors=1,
+                 num_envs=1,
+                 start_timesteps=0,
+                 exploration_steps=0,
+                 queue_size=64):
+        self.shared_policy = copy.deepcopy(policy).to("cpu")
+        self.shared_policy.device = torch.device("cpu")
+        self.shared_policy.share_memory()
+
+        self.lock = mp.Lock()
+        self.version = 0
+        self.shared_version = mp.Value("l", 0)
+        self.timesteps = mp.Value("l", 0)
+        self.transitions = mp.Queue(maxsize=queue_size)
+        self.stop = mp.Event()
+
+        seeds = derive_seeds(parameters.seed, num_collectors * num_envs)
+        self.processes = []
+        for c in range(num_collectors):
+            process = mp.Process(
+                target=_collector,
+                args=(c,
+                      parameters,
+                      seeds[c*num_envs:(c+1)*num_envs],
+                      self.shared_policy,
+                      self.shared_version,
+                      self.lock,
+                      self.timesteps,
+                      start_timesteps,
+                      exploration_steps,
+                      rl_model_type,
+                      self.transitions,
+                      self.stop),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def publish(self, policy):
+        """
+        Copies the weights of policy to the collectors.
+        """
+        with self.lock:
+            with torch.no_grad():
+                for shared, param in zip(self.shared_policy.state_dict().values(),
+                                         policy.state_dict().values()):
+                    shared.copy_(param)
+            self.version += 1
+            self.shared_version.value = self.version
+
+    def set_timesteps(self, timesteps):
+        """
+        Reports the number of timesteps the learner has consumed.
+        """
+        self.timesteps.value = timesteps
+
+    def get(self, block=False):
+        """
+        Collected steps waiting in the queue.
+
+        Args:
+            block (bool): wait until at least one step is available.
+
+        Returns:
+            list: dicts with the stacked "state", "action", "next_state",
+            "reward", "done" and "env" arrays of one step of a collector,
+            its finished "episodes", as returned by vector_environment.step,
+            and the "policy_version" it acted with.
+        """
+        items = []
+        while block and len(items) == 0:
+            try:
+                items.append(self.transitions.get(timeout=1.0))
+            except queue.Empty:
+                for process in self.processes:
+                    if not process.is_alive():
+                        raise RuntimeError(
+                            f"collector process {process.pid} terminated")
+        while True:
+            try:
+                items.append(self.transitions.get_nowait())
+            except queue.Empty:
+                return items
+
+    def close(self):
+        """
+        Stops the collectors.
+        """
+        self.stop.set()
+        # collectors waiting on a full queue need it drained to exit
+        while any(process.is_alive() for process in self.processes):
+            self.get()
+            for process in self.processes:
+                process.join(timeout=0.1)
+        self.transitions.close()
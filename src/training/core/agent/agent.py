@@ -1,9 +1,9 @@
-from pcb_vector_utils import compute_sum_of_euclidean_distances_between_pads
+from pcb_vector_utils import compute_sum_of_euclidean_distances_between_pads_v2
 import numpy as np
 import gym
 from gym import spaces
 
-from core.agent.observation import get_agent_observation
+from core.agent.observation import get_agent_observation, observation_to_state
 from core.agent.tracker import tracker
 
 from pcbDraw import draw_board_from_board_and_graph_multi_agent
@@ -63,15 +63,10 @@ class agent(gym.Env):
         self.ol_term5 = []
         self.current_We = self.We
 
-        self.Wi = compute_sum_of_euclidean_distances_between_pads(
-            self.parameters.node,
-            self.parameters.neighbors,
-            self.parameters.eoi,
+        self.Wi = compute_sum_of_euclidean_distances_between_pads_v2(
+            self.parameters.topology,
             ignore_power=self.parameters.ignore_power)
-        self.HPWLi = 0
-        for net_id in self.parameters.nets:
-            self.HPWLi += self.parameters.graph.calc_hpwl_of_net(net_id,
-                                                                 True)
+        self.HPWLi = self.calc_hpwl()
         self.current_HPWL = self.HPWLe
 
         self.all_w = []
@@ -83,9 +78,38 @@ class agent(gym.Env):
              random:bool=False,
              deterministic:bool =False,
              rl_model_type:str = "TD3"):
-        self.steps_done += 1
         state = get_agent_observation(parameters=self.parameters)
-        _state = list(state["los"]) + list(state["ol"]) + state["dom"] + state["euc_dist"] + state["position"] + state["ortientation"]
+        action = self.act(state,
+                          model=model,
+                          random=random,
+                          deterministic=deterministic,
+                          rl_model_type=rl_model_type)
+
+        next_state = get_agent_observation(parameters=self.parameters)
+        reward, done = self.get_reward(next_state)
+
+        return state, next_state, reward, action, done
+
+    def act(self,
+            state,
+            model,
+            random:bool=False,
+            deterministic:bool =False,
+            rl_model_type:str = "TD3",
+            policy_action=None):
+        """
+        Selects an action for the observation state and moves the node.
+
+        policy_action is the output of model.select_action for state when it
+        has already been computed, e.g. in a batched forward pass over the
+        states of several agents; model is not evaluated again.
+
+        Returns:
+            list: the action as stored in the replay buffer, i.e. the policy
+            output for TD3 and the scaled action for SAC.
+        """
+        self.steps_done += 1
+        _state = observation_to_state(state)
 
         if random is True:
             action = self.action_space.sample()
@@ -97,10 +121,12 @@ class agent(gym.Env):
         else:
             if rl_model_type == "TD3":
                  # Action scaling done here, outside of policy.
+                if policy_action is None:
+                    policy_action = model.select_action(np.array(_state))
                 if deterministic is True:
-                    model_action = model.select_action(np.array(_state))
+                    model_action = policy_action
                 else:
-                    model_action = (model.select_action(np.array(_state))
+                    model_action = (policy_action
                             + np.random.normal(0, self.parameters.max_action * self.parameters.expl_noise, size=3)
                             ).clip(-self.parameters.max_action, self.parameters.max_action)
                 # convert action
@@ -110,8 +136,10 @@ class agent(gym.Env):
 
             else: # SAC
                 # Action scaling done inside policy
-                action = model.select_action(
-                    np.array(_state), evaluate=deterministic)
+                if policy_action is None:
+                    policy_action = model.select_action(
+                        np.array(_state), evaluate=deterministic)
+                action = policy_action
 
         pos = self.parameters.node.get_pos()
         step_scale = (self.parameters.step_size * action[0])
@@ -119,31 +147,31 @@ class agent(gym.Env):
         y_offset = step_scale*np.sin(-action[1])
         angle = (np.int0(action[2] * 4) % 4) * 90.0
 
-        self.parameters.node.set_pos(
-            tuple([pos[0] + x_offset, pos[1] + y_offset]))
-        self.parameters.node.set_orientation(angle)
-
-        next_state = get_agent_observation(parameters=self.parameters)
-        reward, done = self.get_reward(next_state)
+        self.set_pose((pos[0] + x_offset, pos[1] + y_offset), angle)
 
         if rl_model_type == "TD3":
-            return state, next_state, reward, model_action, done
+            return model_action
         else:
-            return state, next_state, reward, action, done
+            return action
 
-    def get_reward(self, observation):
-        done = False
-        self.W.append(compute_sum_of_euclidean_distances_between_pads(
-            self.parameters.node,
-            self.parameters.neighbors,
-            self.parameters.eoi,
-            ignore_power=self.parameters.ignore_power))
+    def calc_hpwl(self):
+        # hpwl of all nets connected to the node
+        if self.parameters.hpwl_tracker is not None:
+            return self.parameters.hpwl_tracker.get_hpwl_of_nets(
+                self.parameters.nets)
 
         hpwl = 0
         for net_id in self.parameters.nets:
             hpwl += self.parameters.graph.calc_hpwl_of_net(net_id, True)
+        return hpwl
 
-        self.HPWL.append(hpwl)
+    def get_reward(self, observation):
+        done = False
+        self.W.append(compute_sum_of_euclidean_distances_between_pads_v2(
+            self.parameters.topology,
+            ignore_power=self.parameters.ignore_power))
+
+        self.HPWL.append(self.calc_hpwl())
 
         if np.sum(observation["ol"]) > 1E-6:
             self.ol_term5.append(
@@ -162,18 +190,23 @@ class agent(gym.Env):
             self.parameters.node.set_opt_euclidean_distance(self.W[-1])
 
         if self.HPWL[-1] < self.HPWLe:
-            stack = draw_board_from_board_and_graph_multi_agent(
-                self.parameters.board,
-                self.parameters.graph,
-                node_id=self.parameters.node.get_id(),
-                padding=4)
-
-            stack_sum = np.zeros((stack[0].shape[0],stack[0].shape[1]),
-                                 dtype=np.int)
-            for i in range(len(stack)):
-                stack_sum += stack[i]
-
-            if np.max(stack_sum) <= 64:
+            if (self.parameters.occupancy is not None and
+                self.parameters.occupancy.padding == 4):
+                legal = self.parameters.occupancy.is_legal()
+            else:
+                stack = draw_board_from_board_and_graph_multi_agent(
+                    self.parameters.board,
+                    self.parameters.graph,
+                    node_id=self.parameters.node.get_id(),
+                    padding=4)
+
+                stack_sum = np.zeros((stack[0].shape[0],stack[0].shape[1]),
+                                     dtype=np.int)
+                for i in range(len(stack)):
+                    stack_sum += stack[i]
+                legal = np.max(stack_sum) <= 64
+
+            if legal:
                 if self.parameters.log_file is not None:
                     f = open(self.parameters.log_file, "a", encoding="utf-8")
                     f.write(f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f')[:-3]} Agent {self.parameters.node.get_name()} ({self.parameters.node.get_id()}) found a better, legal, HPWL target of {np.round(self.HPWL[-1],6)}, originally {np.round(self.HPWLe,6)}.\r\n")
@@ -213,8 +246,18 @@ class agent(gym.Env):
                               r_pos[1]*self.parameters.board_height])
         # 0, 90, 180, 270
         scaled_orientation = np.float64(self.rng.integers(4)*90)
-        self.parameters.node.set_pos(scaled_r_pos)
-        self.parameters.node.set_orientation(scaled_orientation)
+        self.set_pose(scaled_r_pos, scaled_orientation)
+
+    def set_pose(self, pos, orientation):
+        # moves the node, through the environment's graph_state if there is one
+        state = self.parameters.state
+        if state is None:
+            self.parameters.node.set_pos(tuple(pos))
+            self.parameters.node.set_orientation(orientation)
+        else:
+            state.set_pose(state.index[self.parameters.node.get_id()],
+                           pos,
+                           orientation)
 
     def get_observation_space_shape(self):
         sz = 0
@@ -1,6 +1,7 @@
 from pcbDraw import draw_los, draw_board_from_graph_multi_agent, draw_ratsnest, get_los_and_ol_multi_agent
-from pcb_vector_utils import compute_pad_referenced_distance_vectors_v2, compute_vector_to_group_midpoint
+from pcb_vector_utils import compute_pad_referenced_distance_vectors_batch, compute_vector_to_group_midpoint
 from pcb_vector_utils import wrap_angle
+from pcb_geometry_utils import get_los_and_ol_analytic
 import numpy as np
 
 def line_of_sight_and_overlap_v0(parameters, comp_grids):
@@ -35,42 +36,19 @@ def line_of_sight_and_overlap_v0(parameters, comp_grids):
     return los_grids, los, ol_grids, ol
 
 def get_agent_observation(parameters, tracker=None):
-
-    node_id = parameters.node.get_id()
-    # draw comp_grid from nodes
-    comp_grids = draw_board_from_graph_multi_agent(g=parameters.graph,
-                                                   node_id=node_id,
-                                                   bx=parameters.board_width,
-                                                   by=parameters.board_height,
-                                                   padding=parameters.padding)
-
-    los, ol, _, ol_grids = get_los_and_ol_multi_agent(
-        node=parameters.node,
-        board=parameters.board,
-        radius=np.max(parameters.node.get_size())*1.5,
-        grid_comps=comp_grids,
-        padding=parameters.padding)
-
-    # compute ol_ratio
-    ol_ratios = []
-    total = np.sum(ol_grids)/64
-    for grid in ol_grids:
-        ol_ratios.append((np.sum(grid) / 64) / total)
-
-    dom, _, _ = compute_pad_referenced_distance_vectors_v2(
-        parameters.node,
-        parameters.neighbors,
-        parameters.eoi,
-        ignore_power=parameters.ignore_power_nets
-        )
-
-    # group
-    _, eucledian_dist, angle = compute_vector_to_group_midpoint(
-        parameters.node,
-        parameters.neighbors
-    )
+    observation = get_agent_observations([parameters])[0]
 
     if tracker is not None:
+        node_id = parameters.node.get_id()
+        if parameters.occupancy is not None:
+            comp_grids = parameters.occupancy.get_layers(node_id)
+        else:
+            comp_grids = draw_board_from_graph_multi_agent(
+                g=parameters.graph,
+                node_id=node_id,
+                bx=parameters.board_width,
+                by=parameters.board_height,
+                padding=parameters.padding)
         tracker.add_observation(comp_grids=comp_grids)
         tracker.add_ratsnest(
             draw_ratsnest(parameters.node,
@@ -79,12 +57,140 @@ def get_agent_observation(parameters, tracker=None):
                           parameters.board_width,
                           parameters.board_height,
                           padding=parameters.padding,
-                          ignore_power=parameters.ignore_power_nets)
+                          ignore_power=parameters.ignore_power_nets,
+                          rotations=parameters.rotations)
                           )
 
-    info = { "ol_ratios": ol_ratios, }
+    return observation
+
+def get_agent_observations(parameters_list):
+    """
+    Computes the observations of several agents of the same environment in a
+    single pass over the board.
+
+    The board is synchronised (occupancy maps) or rasterised (layer stack)
+    once, component poses are gathered once and the per-agent vectors are
+    then derived from this shared state. An observation is the one the agent
+    would get from get_agent_observation on the current board, so callers
+    that need sequential semantics (later agents see the moves of earlier
+    agents) simply batch the agents observing the same board, e.g. the next
+    state of one agent with the state of the following agent.
+
+    Every agent memoises its last observation together with the board
+    version it was computed on (of the graph_state, or else of the occupancy
+    cache); it is returned again, and must therefore not be modified, as
+    long as no node has moved or rotated. The analytic backend does not
+    rasterise footprints.
+
+    Args:
+        parameters_list (list): agent parameters, all sharing one graph.
+
+    Returns:
+        list: one observation dictionary per entry of parameters_list.
+    """
+    if len(parameters_list) == 0:
+        return []
+
+    shared = parameters_list[0]
+    if shared.state is not None:
+        # nodes moved through the graph rather than the mirror (tests,
+        # scripts) would leave it stale; re-reading the poses is cheap
+        # compared with an observation
+        shared.state.pull()
+    # the version of board changes whenever any node moved or rotated
+    board = shared.state if shared.state is not None else shared.occupancy
+    if shared.occupancy is not None and (shared.los_backend != "analytic" or
+                                         board is shared.occupancy):
+        # only the footprints of nodes that moved since the last call are
+        # redrawn
+        shared.occupancy.sync()
+
+    # observations computed on an unchanged board are reused
+    observations = [None] * len(parameters_list)
+    pending = []
+    for k in range(len(parameters_list)):
+        memo = parameters_list[k].observation_memo
+        if (memo is not None and board is not None and
+                memo[0] is board and memo[1] == board.version):
+            observations[k] = memo[2]
+        else:
+            pending.append(k)
+
+    if len(pending) == 0:
+        return observations
+
+    nodes = shared.graph.get_nodes()
+    node_index = {}
+    for i in range(len(nodes)):
+        node_index[nodes[i].get_id()] = i
+
+    if shared.los_backend == "analytic":
+        poses = [(n.get_pos(), n.get_size(), n.get_orientation()) for n in nodes]
+    elif shared.occupancy is None:
+        # layers of all nodes in graph order, drawn once
+        stack = draw_board_from_graph_multi_agent(
+            g=shared.graph,
+            node_id=shared.node.get_id(),
+            bx=shared.board_width,
+            by=shared.board_height,
+            padding=shared.padding)
+        layers = stack[2:]
+        layers.insert(node_index[shared.node.get_id()], stack[1])
+
+    # dominant vectors of all pending agents in one pass
+    doms = compute_pad_referenced_distance_vectors_batch(
+        [parameters_list[k].topology for k in pending],
+        ignore_power=shared.ignore_power_nets,
+        plans=shared.batch_plans)
+
+    for k, dom in zip(pending, doms):
+        parameters = parameters_list[k]
+        node_id = parameters.node.get_id()
+        i = node_index[node_id]
+        radius = np.max(parameters.node.get_size())*1.5
+        if parameters.los_backend == "analytic":
+            los, ol, _, overlap_areas = get_los_and_ol_analytic(
+                pos=poses[i][0],
+                size=poses[i][1],
+                orientation=poses[i][2],
+                others=poses[:i] + poses[i+1:],
+                bx=parameters.board_width,
+                by=parameters.board_height,
+                radius=radius,
+                padding=parameters.padding)
+
+            ol_ratios = list(overlap_areas / np.sum(overlap_areas))
+        elif parameters.occupancy is not None:
+            # read from the environment's coverage map
+            los, ol, overlap_pixels = \
+                parameters.occupancy.get_los_and_ol_pixels(node_id, radius)
+            ol_ratios = list(overlap_pixels / np.sum(overlap_pixels))
+        else:
+            comp_grids = [stack[0], layers[i]] + layers[:i] + layers[i+1:]
+            los, ol, _, ol_grids = get_los_and_ol_multi_agent(
+                node=parameters.node,
+                board=parameters.board,
+                radius=radius,
+                grid_comps=comp_grids,
+                padding=parameters.padding,
+                roi=True)
+
+            # compute ol_ratio
+            ol_ratios = []
+            total = np.sum(ol_grids)/64
+            for grid in ol_grids:
+                ol_ratios.append((np.sum(grid) / 64) / total)
+
+        # group
+        _, eucledian_dist, angle = compute_vector_to_group_midpoint(
+            parameters.node,
+            parameters.neighbors
+        )
+
+        info = { "ol_ratios": ol_ratios, }
 
-    return {"los":  los[-8:],
+        observations[k] = {
+            "los":  los[-8:],
             "ol": ol[-8:],
             "dom": [dom[0], dom[1]],
             "euc_dist": [ eucledian_dist, angle ],
@@ -92,4 +198,20 @@ def get_agent_observation(parameters, tracker=None):
                          parameters.node.get_pos()[1] / parameters.board_height],
             "ortientation": [wrap_angle(parameters.node.get_orientation())],
             "info": info
-        }
+            }
+
+        if board is not None:
+            parameters.observation_memo = (board,
+                                           board.version,
+                                           observations[k])
+
+    return observations
+
+def observation_to_state(observation):
+    """
+    Flattens an observation dictionary into the state vector (list) used by
+    the policies.
+    """
+    return (list(observation["los"]) + list(observation["ol"])
+            + observation["dom"] + observation["euc_dist"]
+            + observation["position"] + observation["ortientation"])
@@ -1,3 +1,5 @@
+from pcb_vector_utils import pad_topology
+
 # parse parameters relevant to the environmnet only.
 # do not alter cla in any way.
 class parameters:
@@ -19,6 +21,16 @@ class parameters:
         self.neighbors = pcb_params["neighbors"]
         # list of edges of interest
         self.eoi = pcb_params["eoi"]
+        # pad connectivity of node, neighbors and eoi as arrays
+        # board wide pad_rotation_table, shared between all agents.
+        self.rotations = pcb_params["rotations"]
+        # environment owned graph_state; nodes are moved through it.
+        self.state = pcb_params["state"]
+        self.topology = pad_topology(self.node,
+                                     self.neighbors,
+                                     self.eoi,
+                                     rotations=self.rotations,
+                                     state=self.state)
 
         # path to stable baselines 3 neural network.
         # model extracted trom the file extension.
@@ -39,6 +51,17 @@ class parameters:
         self.p = pcb_params["p"]
         self.ignore_power = pcb_params["ignore_power"]
         self.log_file = pcb_params["log_file"]
+        # environment owned occupancy_cache, shared between all agents.
+        self.occupancy = pcb_params["occupancy"]
+        self.los_backend = pcb_params["los_backend"]
+        # environment owned hpwl_tracker, shared between all agents.
+        self.hpwl_tracker = pcb_params["hpwl_tracker"]
+        # environment owned cache of merged dominant vector plans, keyed on
+        # the topologies observed together; shared between all agents.
+        self.batch_plans = pcb_params["batch_plans"]
+        # (board, version, observation) of the last observation; board is
+        # the graph_state, or the occupancy_cache without one
+        self.observation_memo = None
 
     def write_to_file(self, fileName, append=True):
         return
@@ -51,7 +74,9 @@ class parameters:
         s = ""
         s += f"<strong>====== Agent {self.node.get_name()} ({self.node.get_id()}) parameters ======</strong><br>"
         for key,value in params.items():
-            if key in ("board", "graph", "node", "neighbors", "eoi", "edge"):
+            if key in ("board", "graph", "node", "neighbors", "eoi", "edge",
+                       "occupancy", "observation_memo", "topology",
+                       "rotations", "hpwl_tracker", "state", "batch_plans"):
                 continue
             s += f"{key} -> {value}<br>"
         s += "<br>"
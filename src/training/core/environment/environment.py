@@ -6,7 +6,13 @@ from graph import graph
 from core.agent.agent import agent as agent
 from core.agent.parameters import parameters as agent_parameters
 from core.environment.tracker import tracker
+from core.environment.occupancy import occupancy_cache
+from core.environment.hpwl import hpwl_tracker
+from core.environment.graph_state import graph_state
+from core.agent.observation import get_agent_observations, observation_to_state
 from pcbDraw import draw_board_from_board_and_graph_with_debug, draw_ratsnest_with_board
+from pcb_vector_utils import pad_topology
+from graph_utils import pad_rotation_table
 import numpy as np
 import random as random_package
 
@@ -15,6 +21,7 @@ class environment:
     # It's purpose is to initialize the object.
     def __init__(self, parameters):
         self.parameters = parameters
+        self.padding=4
 
         self.pv = pcb.vptr_pcbs()
         # Read pcb file
@@ -25,6 +32,8 @@ class environment:
             sys.exit()
 
         self.rng = np.random.default_rng(seed=self.parameters.seed)
+        # pad_rotation_table of every board, built the first time it is used.
+        self.rotation_tables = {}
         # sets p,g and b variables; idx=None => random!!
         self.initialize_environment_state_from_pcb(
             init=True,
@@ -57,8 +66,6 @@ class environment:
                 augment_orientation=self.parameters.augment_orientation,
                 rng = self.rng)
 
-        self.padding=4
-
     def reset(self):
         self.g.update_original_nodes_with_current_optimals()
         # sets p,g and b variables; idx=-1 => random!!; set to True for
@@ -86,6 +93,8 @@ class environment:
             self.dA.set_translation_limits([0.66*sz, 0.66*sz])
             # self.optimals and index are not used.
             self.optimal_location = self.dA.augment_graph(grph=self.g, idx=0)
+            # the augmenter moves nodes through the graph
+            self.state.pull()
 
         for i in range(len(self.agents)):
             self.agents[i].init_random()
@@ -108,7 +117,8 @@ class environment:
                         self.b,
                         line_thickness=1,
                         padding=self.padding,
-                        ignore_power=True)
+                        ignore_power=True,
+                        rotations=self.rotations)
                 else:
                     ratsnest = np.maximum(ratsnest,draw_ratsnest_with_board(self.agents[i].parameters.node,
                                                                             self.agents[i].parameters.neighbors,
@@ -116,18 +126,76 @@ class environment:
                                                                             self.b,
                                                                             line_thickness=1,
                                                                             padding=self.padding,
-                                                                            ignore_power=True))
+                                                                            ignore_power=True,
+                                                                            rotations=self.rotations))
 
             self.tracker.add(comp_grids=comp_grids,ratsnest=ratsnest)
 
+    def get_observations(self, idxs=None):
+        """
+        Observations of several agents on the current board, computed in one
+        batched pass.
+
+        Args:
+            idxs (list): indices of the agents, all agents when None.
+
+        Returns:
+            list: one observation dictionary per agent, in the order of idxs.
+        """
+        if idxs is None:
+            idxs = range(len(self.agents))
+
+        return get_agent_observations(
+            [self.agents[i].parameters for i in idxs])
+
     def step(self,
              model,
              random=False,
              deterministic:bool = False,
              rl_model_type:str ="TD3"):
+        if self.parameters.step_mode == "simultaneous":
+            return self.step_simultaneous(model,
+                                          random=random,
+                                          deterministic=deterministic,
+                                          rl_model_type=rl_model_type)
+
         observation_vec = []
         step_metrics = []
 
+        # Agents move one after the other, each observing the moves of the
+        # agents before it. The next state of an agent and the state of the
+        # following agent are taken from the same board, so both are
+        # computed in one batched pass.
+        idxs, state = self.begin_step()
+        for k in range(len(idxs)):
+            action = self.agents[idxs[k]].act(state,
+                                              model=model,
+                                              random=random,
+                                              deterministic=deterministic,
+                                              rl_model_type=rl_model_type)
+
+            transition, metrics, state = self.complete_agent_step(idxs,
+                                                                  k,
+                                                                  state,
+                                                                  action)
+            observation_vec.append(transition)
+            step_metrics.append(metrics)
+
+            if transition[4] is True:
+                break
+
+        self.end_step(step_metrics)
+        return observation_vec
+
+    def begin_step(self):
+        """
+        Starts a step: decides the order in which the agents move and
+        observes the first of them.
+
+        Returns:
+            tuple: (idxs, state) the agent order and the observation of the
+            first agent (None when there are no agents).
+        """
         idxs = []
         for i in range(len(self.agents)):
             idxs.append(i)
@@ -135,37 +203,162 @@ class environment:
         if self.parameters.shuffle_idxs is True:
             random_package.shuffle(idxs)
 
-        for i in idxs:
-            state, next_state, reward, action, done = self.agents[i].step(
-                model=model,
-                random=random,
-                deterministic=deterministic,
-                rl_model_type=rl_model_type)
-            # convert state_vector
-            _state = list(state["los"]) + list(state["ol"]) + state["dom"] + state["euc_dist"] + state["position"] + state["ortientation"]
-            _next_state = list(next_state["los"]) + list(next_state["ol"]) + next_state["dom"] + next_state["euc_dist"] + next_state["position"] + next_state["ortientation"]
-            _next_state_info = next_state["info"]
-            observation_vec.append(
-                [_state, _next_state, reward, action, done, _next_state_info])
-
-            step_metrics.append({"id": self.agents[i].parameters.node.get_id(),
-                                 "name": self.agents[i].parameters.node.get_name(),
-                                 "reward": reward,
-                                 "W": self.agents[i].all_w[-1],
-                                 "We": self.agents[i].We,
-                                 "HPWL": self.agents[i].all_hpwl[-1],
-                                 "HPWLe": self.agents[i].HPWLe,
-                                 "ol": 1-self.agents[i].ol_term5[-1],
-                                 "weighted_cost": self.agents[i].all_weighted_cost[-1],
-                                 "raw_W": self.agents[i].W[-1],
-                                 "raw_HPWL": self.agents[i].HPWL[-1],
-                                 "Wi": self.agents[i].Wi,
-                                 "HPWLi": self.agents[i].HPWLi
-                                 })
-
-            if done is True:
-                break
+        state = None
+        if len(idxs) != 0:
+            state = self.get_observations([idxs[0]])[0]
+        return idxs, state
 
+    def complete_agent_step(self, idxs, k, state, action):
+        """
+        Observes and rewards the move of agent idxs[k], which acted on
+        observation state.
+
+        Returns:
+            tuple: (transition, metrics, state), the transition
+            [state, next_state, reward, action, done, info] as returned by
+            step, the step metrics of the agent and the observation of the
+            next agent (None for the last agent).
+        """
+        observations = self.get_observations(idxs[k:k+2])
+        transition, metrics = self._reward_agent(idxs[k],
+                                                 state,
+                                                 observations[0],
+                                                 action)
+
+        state = None
+        if k + 1 < len(idxs):
+            state = observations[1]
+        return transition, metrics, state
+
+    def _reward_agent(self, i, state, next_state, action):
+        # transition and step metrics of agent i, which moved with action
+        # from observation state to next_state
+        reward, done = self.agents[i].get_reward(next_state)
+
+        # convert state_vector
+        _state = observation_to_state(state)
+        _next_state = observation_to_state(next_state)
+        _next_state_info = next_state["info"]
+        transition = [_state, _next_state, reward, action, done, _next_state_info]
+
+        metrics = {"id": self.agents[i].parameters.node.get_id(),
+                   "name": self.agents[i].parameters.node.get_name(),
+                   "reward": reward,
+                   "W": self.agents[i].all_w[-1],
+                   "We": self.agents[i].We,
+                   "HPWL": self.agents[i].all_hpwl[-1],
+                   "HPWLe": self.agents[i].HPWLe,
+                   "ol": 1-self.agents[i].ol_term5[-1],
+                   "weighted_cost": self.agents[i].all_weighted_cost[-1],
+                   "raw_W": self.agents[i].W[-1],
+                   "raw_HPWL": self.agents[i].HPWL[-1],
+                   "Wi": self.agents[i].Wi,
+                   "HPWLi": self.agents[i].HPWLi
+                   }
+        return transition, metrics
+
+    def step_simultaneous(self,
+                          model,
+                          random=False,
+                          deterministic:bool = False,
+                          rl_model_type:str ="TD3"):
+        """
+        A step in which all agents choose their actions on the same board.
+
+        The "simultaneous" step mode (parameters.step_mode): the states of
+        all agents are observed at the start of the step in one batched
+        pass, and the policy is evaluated once for all of them. The moves
+        are then applied in the agent order of step (shuffled with
+        shuffle_idxs), without re-observing the board between moves. The
+        next states and rewards are observed once all agents have moved.
+        Unlike step, an agent does not see the moves made earlier in the
+        same step, and every agent contributes a transition, even after
+        another agent's episode ended.
+
+        Returns:
+            list: one transition per agent, as returned by step.
+        """
+        idxs, states = self.begin_simultaneous_step()
+        policy_actions = [None] * len(idxs)
+        if random is not True and len(idxs) != 0:
+            _states = np.array([observation_to_state(s) for s in states])
+            if rl_model_type == "TD3":
+                policy_actions = list(model.select_actions(_states))
+            else:
+                policy_actions = list(model.select_actions(
+                    _states, evaluate=deterministic))
+
+        observation_vec, step_metrics = self.complete_simultaneous_step(
+            idxs,
+            states,
+            policy_actions,
+            model=model,
+            random=random,
+            deterministic=deterministic,
+            rl_model_type=rl_model_type)
+        self.end_step(step_metrics)
+        return observation_vec
+
+    def begin_simultaneous_step(self):
+        """
+        Starts a simultaneous step: decides the agent order and observes
+        every agent.
+
+        Returns:
+            tuple: (idxs, states) the agent order and the observations of
+            the agents, in that order.
+        """
+        idxs = list(range(len(self.agents)))
+        if self.parameters.shuffle_idxs is True:
+            random_package.shuffle(idxs)
+        return idxs, self.get_observations(idxs)
+
+    def complete_simultaneous_step(self,
+                                   idxs,
+                                   states,
+                                   policy_actions,
+                                   model=None,
+                                   random=False,
+                                   deterministic:bool = False,
+                                   rl_model_type:str = "TD3"):
+        """
+        Moves all agents, in the order idxs, and observes and rewards them
+        on the resulting board.
+
+        Args:
+            idxs (list): agent order, from begin_simultaneous_step.
+            states (list): observations of these agents.
+            policy_actions (list): policy output for every state, or None
+            entries when random.
+
+        Returns:
+            tuple: (transitions, metrics) one entry per agent.
+        """
+        actions = []
+        for i, state, policy_action in zip(idxs, states, policy_actions):
+            actions.append(self.agents[i].act(state,
+                                              model=model,
+                                              random=random,
+                                              deterministic=deterministic,
+                                              rl_model_type=rl_model_type,
+                                              policy_action=policy_action))
+
+        transitions = []
+        step_metrics = []
+        for k, next_state in enumerate(self.get_observations(idxs)):
+            transition, metrics = self._reward_agent(idxs[k],
+                                                     states[k],
+                                                     next_state,
+                                                     actions[k])
+            transitions.append(transition)
+            step_metrics.append(metrics)
+        return transitions, step_metrics
+
+    def end_step(self, step_metrics):
+        """
+        Finishes a step: records the step metrics (and the board when
+        debugging) in the tracker.
+        """
         if self.parameters.debug is True:
             comp_grids = draw_board_from_board_and_graph_with_debug(
                 self.b,
@@ -180,7 +373,8 @@ class environment:
                         self.b,
                         line_thickness=1,
                         padding=self.padding,
-                        ignore_power=True)
+                        ignore_power=True,
+                        rotations=self.rotations)
                 else:
                     ratsnest = np.maximum(ratsnest, draw_ratsnest_with_board(self.agents[i].parameters.node,
                                                                              self.agents[i].parameters.neighbors,
@@ -188,12 +382,12 @@ class environment:
                                                                              self.b,
                                                                              line_thickness=1,
                                                                              padding=self.padding,
-                                                                             ignore_power=True))
+                                                                             ignore_power=True,
+                                                                             rotations=self.rotations))
 
             self.tracker.add(comp_grids=comp_grids,ratsnest=ratsnest)
 
         self.tracker.add_metrics(step_metrics)
-        return observation_vec
 
     def initialize_environment_state_from_pcb(self, init = False, idx=-1):
         if idx==-1:
@@ -208,6 +402,23 @@ class environment:
         self.b = self.p.get_board()
         # >>> VERY VERY IMPORTANT <<<
         self.g.set_component_origin_to_zero(self.b)
+        # NumPy mirror of the graph; nodes are moved through it.
+        self.state = graph_state(self.g)
+        # Component layers are redrawn lazily, when a node moves.
+        self.occupancy = occupancy_cache(self.g,
+                                         self.b.get_width(),
+                                         self.b.get_height(),
+                                         padding=self.padding,
+                                         state=self.state)
+        if self.idx not in self.rotation_tables:
+            self.rotation_tables[self.idx] = pad_rotation_table(
+                self.g.get_edges())
+        self.rotations = self.rotation_tables[self.idx]
+        # Net bounding boxes are updated lazily, when a node moves.
+        self.hpwl_tracker = hpwl_tracker(self.g, self.rotations, self.state)
+        # Merged dominant vector plans of the agents observed together; they
+        # reference this board's topologies, so every board gets a new dict.
+        self.batch_plans = {}
 
         nn = self.g.get_nodes()
         for i in range(len(nn)):
@@ -249,6 +460,12 @@ class environment:
                          "m": self.parameters.m,
                          "p": self.parameters.p,
                          "ignore_power": self.parameters.ignore_power,
+                         "occupancy": self.occupancy,
+                         "rotations": self.rotations,
+                         "hpwl_tracker": self.hpwl_tracker,
+                         "batch_plans": self.batch_plans,
+                         "state": self.state,
+                         "los_backend": self.parameters.los_backend,
                          "log_file": None if self.parameters.log_dir is None else os.path.join(self.parameters.log_dir, self.p.get_kicad_pcb2().replace(".kicad_pcb", ".log")),
                          })
 
@@ -257,6 +474,17 @@ class environment:
                     self.agents[i].parameters.node = nn[i]
                     self.agents[i].parameters.neighbors = neighbors
                     self.agents[i].parameters.eoi = eoi
+                    self.agents[i].parameters.rotations = self.rotations
+                    self.agents[i].parameters.state = self.state
+                    self.agents[i].parameters.topology = pad_topology(
+                        nn[i],
+                        neighbors,
+                        eoi,
+                        rotations=self.rotations,
+                        state=self.state)
+                    self.agents[i].parameters.occupancy = self.occupancy
+                    self.agents[i].parameters.hpwl_tracker = self.hpwl_tracker
+                    self.agents[i].parameters.batch_plans = self.batch_plans
 
     def get_target_params(self):
         target_params = []
@@ -317,6 +545,8 @@ class environment:
             g = self.pv[i].get_graph()
             g.reset()
         pcb.write_pcb_file(save_loc, self.pv, False)
+        # the graph reset moved the nodes
+        self.state.pull()
 
     def write_current_pcb_file(self, path=None, filename=None):
 
@@ -325,6 +555,7 @@ class environment:
         else:
             save_loc = "./pcb_file.pcb"
 
+        self.state.push()
         pv = pcb.vptr_pcbs()
         pv.append(self.pv[self.idx])
         g = pv[0].get_graph()
@@ -335,9 +566,10 @@ class environment:
         pcb.write_pcb_file(save_loc, pv, False)
         # >>> VERY VERY IMPORTANT <<<
         g.set_component_origin_to_zero(self.b)
+        self.state.pull()
 
     def calc_hpwl(self):
-        return self.g.calc_hpwl(True)
+        return self.hpwl_tracker.calc_hpwl()
 
     def get_parameters(self):
         return self.parameters
@@ -0,0 +1,303 @@
+"""
+This module steps environments in worker processes.
+
+Module: environment_pool
+
+Classes:
+
+    environment_pool: Spreads K environments over worker processes, each
+    owning a vector_environment of its share. States, policy actions and
+    transitions are exchanged through preallocated shared memory arrays; the
+    pipes to the workers only carry short commands and the (rare) finished
+    episodes. The policy is evaluated in the learner process, once per agent
+    slot for all environments.
+
+Usage example:
+from core.environment.environment_pool import environment_pool
+
+envs = environment_pool(env_params, num_envs=8, num_workers=4)
+envs.reset()
+steps = envs.step(model=actor, random=False)
+states, rewards, dones = steps["state"], steps["reward"], steps["done"]
+envs.close()
+
+"""
+import multiprocessing
+from multiprocessing import shared_memory
+import random as random_package
+import numpy as np
+
+from core.environment.environment import environment
+from core.environment.vector_environment import vector_environment, derive_seeds
+
+def _attach(specs):
+    # numpy views on the shared memory blocks described by specs,
+    # name => (shared memory name, shape, dtype)
+    blocks = {}
+    arrays = {}
+    for key, (name, shape, dtype) in specs.items():
+        blocks[key] = shared_memory.SharedMemory(name=name)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=blocks[key].buf)
+    return blocks, arrays
+
+def _worker(remote, parameters, seeds, rows, specs):
+    # Owns a vector_environment of the environments rows (seeded with
+    # seeds) and serves the commands of environment_pool.
+    blocks, arrays = _attach(specs)
+    # agent orders are shuffled with the random module and TD3 exploration
+    # noise is drawn from the global numpy generator
+    random_package.seed(seeds[0])
+    np.random.seed(seeds[0] % 2**32)
+    envs = vector_environment(parameters, seeds=seeds)
+
+    def write_states():
+        active = envs.get_active()
+        arrays["active"][rows] = False
+        for e, state in zip(active, envs.get_states(active)):
+            arrays["active"][rows[e]] = True
+            arrays["state"][rows[e]] = state
+
+    try:
+        while True:
+            cmd, args = remote.recv()
+            if cmd == "reset":
+                envs.reset()
+                remote.send(None)
+            elif cmd == "begin":
+                envs.begin_step()
+                write_states()
+                remote.send(None)
+            elif cmd == "act":
+                random, deterministic, rl_model_type = args
+                active = envs.get_active()
+                if random is True:
+                    policy_actions = [None] * len(active)
+                else:
+                    policy_actions = [arrays["policy_action"][rows[e]].copy()
+                                      for e in active]
+                envs.act(active,
+                         policy_actions,
+                         random=random,
+                         deterministic=deterministic,
+                         rl_model_type=rl_model_type)
+                write_states()
+                remote.send(None)
+            elif cmd == "end":
+                steps = envs.end_step()
+                arrays["count"][rows] = 0
+                for k in range(len(steps["reward"])):
+                    row = rows[steps["env"][k]]
+                    j = arrays["count"][row]
+                    arrays["transition_state"][row, j] = steps["state"][k]
+                    arrays["transition_next_state"][row, j] = \
+                        steps["next_state"][k]
+                    arrays["transition_action"][row, j] = steps["action"][k]
+                    arrays["transition_reward"][row, j] = steps["reward"][k]
+                    arrays["transition_done"][row, j] = steps["done"][k]
+                    arrays["count"][row] += 1
+                for episode in steps["episodes"]:
+                    episode["env"] = rows[episode["env"]]
+                remote.send(steps["episodes"])
+            elif cmd == "call":
+                remote.send(getattr(envs, args)())
+            elif cmd == "get":
+                remote.send(getattr(envs, args))
+            elif cmd == "close":
+                remote.send(None)
+                break
+    finally:
+        for block in blocks.values():
+            block.close()
+
+class environment_pool:
+    """
+    K environments stepped in lockstep by worker processes.
+
+    Environment e is seeded with derive_seeds(parameters.seed, num_envs)[e],
+    whichever worker owns it, so random and deterministic steps give the
+    same transitions as vector_environment. Agent order shuffles and TD3
+    exploration noise come from the global generators, which every worker
+    seeds with the seed of its first environment; these are reproducible
+    for a fixed number of workers.
+
+    Args:
+        parameters: environment parameters.
+        num_envs (int): number of environments, K.
+        num_workers (int): number of worker processes; environments are
+        spread over them in contiguous blocks.
+        start_method (str): multiprocessing start method; the platform
+        default when None.
+
+    Attributes:
+        agents (list): agents of a local, never stepped, environment; used
+        for observation and action space shapes.
+        max_agents (int): largest number of agents on any board of the pcb
+        file; sizes the transition arrays.
+    """
+    def __init__(self, parameters, num_envs=1, num_workers=1,
+                 start_method=None):
+        if parameters.step_mode != "sequential":
+            raise ValueError("environment_pool steps the agents sequentially;"
+                             " use vector_environment for the"
+                             f" '{parameters.step_mode}' step mode")
+        self.num_envs = num_envs
+        self.num_workers = min(num_workers, num_envs)
+        self.local_env = environment(parameters)
+        self.max_agents = self._max_agents(self.local_env)
+        state_dim = self.local_env.agents[0].get_observation_space_shape()
+        action_dim = self.local_env.agents[0].action_space.shape[0]
+
+        shapes = {
+            "active": ((num_envs,), bool),
+            "state": ((num_envs, state_dim), np.float64),
+            # policies output float32; kept as is so that actions are
+            # computed exactly as in a single process
+            "policy_action": ((num_envs, action_dim), np.float32),
+            "count": ((num_envs,), np.int64),
+            "transition_state": ((num_envs, self.max_agents, state_dim),
+                                 np.float64),
+            "transition_next_state": ((num_envs, self.max_agents, state_dim),
+                                      np.float64),
+            "transition_action": ((num_envs, self.max_agents, action_dim),
+                                  np.float64),
+            "transition_reward": ((num_envs, self.max_agents), np.float64),
+            "transition_done": ((num_envs, self.max_agents), bool),
+            }
+        self.blocks = {}
+        self.arrays = {}
+        specs = {}
+        for key, (shape, dtype) in shapes.items():
+            size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+            self.blocks[key] = shared_memory.SharedMemory(create=True,
+                                                          size=size)
+            self.arrays[key] = np.ndarray(shape, dtype=dtype,
+                                          buffer=self.blocks[key].buf)
+            self.arrays[key][...] = 0
+            specs[key] = (self.blocks[key].name, shape, dtype)
+
+        seeds = derive_seeds(parameters.seed, num_envs)
+        context = multiprocessing.get_context(start_method)
+        self.remotes = []
+        self.processes = []
+        for rows in np.array_split(np.arange(num_envs), self.num_workers):
+            rows = [int(row) for row in rows]
+            remote, worker_remote = context.Pipe()
+            process = context.Process(
+                target=_worker,
+                args=(worker_remote,
+                      parameters,
+                      [seeds[row] for row in rows],
+                      rows,
+                      specs),
+                daemon=True)
+            process.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+        self.closed = False
+
+    @staticmethod
+    def _max_agents(env):
+        # one agent per unplaced node, on the largest board of the pcb file
+        max_agents = 0
+        for i in range(len(env.pv)):
+            nn = env.pv[i].get_graph().get_nodes()
+            max_agents = max(max_agents,
+                             sum(1 for j in range(len(nn))
+                                 if nn[j].get_isPlaced() == 0))
+        return max_agents
+
+    def _command(self, cmd, args=None):
+        for remote in self.remotes:
+            remote.send((cmd, args))
+        return [remote.recv() for remote in self.remotes]
+
+    @property
+    def agents(self):
+        return self.local_env.agents
+
+    @property
+    def parameters(self):
+        return self.local_env.parameters
+
+    def get_parameters(self):
+        return self.local_env.get_parameters()
+
+    # Targets, tracker and hpwl are those of the first environment, owned by
+    # the first worker. The tracker is a copy: changes made to it do not reach
+    # the worker.
+    def get_target_params(self):
+        self.remotes[0].send(("call", "get_target_params"))
+        return self.remotes[0].recv()
+
+    def get_all_target_params(self):
+        self.remotes[0].send(("call", "get_all_target_params"))
+        return self.remotes[0].recv()
+
+    @property
+    def tracker(self):
+        self.remotes[0].send(("get", "tracker"))
+        return self.remotes[0].recv()
+
+    def calc_hpwl(self):
+        self.remotes[0].send(("call", "calc_hpwl"))
+        return self.remotes[0].recv()
+
+    def reset(self):
+        self._command("reset")
+
+    def step(self,
+             model,
+             random=False,
+             deterministic:bool = False,
+             rl_model_type:str = "TD3"):
+        """
+        Steps every environment once and resets the environments whose
+        episode finished.
+
+        Returns:
+            dict: as returned by vector_environment.step, without "info".
+        """
+        arrays = self.arrays
+        self._command("begin")
+        while True:
+            active = np.flatnonzero(arrays["active"])
+            if len(active) == 0:
+                break
+            if random is not True:
+                states = arrays["state"][active]
+                if rl_model_type == "TD3":
+                    arrays["policy_action"][active] = \
+                        model.select_actions(states)
+                else:
+                    arrays["policy_action"][active] = \
+                        model.select_actions(states, evaluate=deterministic)
+            self._command("act", (random, deterministic, rl_model_type))
+
+        episodes = []
+        for worker_episodes in self._command("end"):
+            episodes += worker_episodes
+
+        rows = np.repeat(np.arange(self.num_envs), arrays["count"])
+        slots = np.concatenate([np.arange(count) for count in arrays["count"]])
+        return {"state": arrays["transition_state"][rows, slots],
+                "next_state": arrays["transition_next_state"][rows, slots],
+                "action": arrays["transition_action"][rows, slots],
+                "reward": arrays["transition_reward"][rows, slots],
+                "done": arrays["transition_done"][rows, slots],
+                "env": rows,
+                "episodes": sorted(episodes, key=lambda e: e["env"])}
+
+    def close(self):
+        """
+        Stops the workers and releases the shared memory.
+        """
+        if self.closed:
+            return
+        self._command("close")
+        for process in self.processes:
+            process.join()
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.closed = True
@@ -0,0 +1,165 @@
+"""
+This module provides a NumPy mirror of the state of a graph.
+
+Module: graph_state
+
+Classes:
+
+    graph_state: Holds node poses, sizes and placement flags, as well as edge
+    endpoints, pads and nets, in contiguous NumPy arrays. Node moves go
+    through the mirror, which writes them to the graph, so hot code can read
+    arrays instead of calling the graph bindings once per scalar.
+
+Usage example:
+from core.environment.graph_state import graph_state
+
+state = graph_state(g)
+state.set_pose(i, (x, y), orientation)
+positions = state.positions[state.index[node_id]]
+
+"""
+import numpy as np
+
+class graph_state:
+    """
+    Structure of arrays mirror of a graph, in graph (get_nodes / get_edges)
+    order.
+
+    The mirror writes through: set_pos, set_orientation and set_pose update
+    both the arrays and the graph. Anything that moves nodes through the
+    graph directly (graph.reset, dataAugmenter.augment_graph, node.set_pos,
+    ...) must be followed by pull() before the arrays are read. Observations
+    (core.agent.observation.get_agent_observations) pull on every call, so
+    the mirror, the occupancy cache and the observation memos always
+    reflect direct writes; the hpwl_tracker and pad_topology readers rely
+    on the write-through or on a preceding pull.
+
+    Args:
+        g: mirrored graph.
+
+    Attributes:
+        nodes (list): node references, in graph order.
+        node_ids (numpy array): (nodes,) node ids.
+        index (dict): node id => graph index.
+        positions (numpy array): (nodes, 2) node positions.
+        orientations (numpy array): (nodes,) node orientations, in degrees.
+        sizes (numpy array): (nodes, 2) node sizes.
+        placed (numpy array): (nodes,) True for placed (locked) nodes.
+        node_versions (numpy array): (nodes,) incremented whenever the pose
+        of a node changes; consumers compare them with the versions they last
+        synchronised to.
+        version (int): incremented whenever the pose of any node changes.
+        edge_nodes (numpy array): (edges, 2) graph index of both endpoints.
+        edge_instance_ids (numpy array): (edges, 2) node id of both endpoints.
+        edge_pad_ids (numpy array): (edges, 2) pad id of both endpoints.
+        edge_pad_offsets (numpy array): (edges, 2, 2) unrotated pad offsets of
+        both endpoints.
+        edge_net_ids (numpy array): (edges,) net ids.
+        edge_power (numpy array): (edges,) True for power rail edges.
+    """
+    def __init__(self, g):
+        self.g = g
+        # indexing the node vector is slow and iterating over it yields
+        # copies; keep a list of references instead.
+        nodes = g.get_nodes()
+        self.nodes = [nodes[i] for i in range(len(nodes))]
+        self.node_ids = np.array([n.get_id() for n in self.nodes],
+                                 dtype=np.int64)
+        self.index = {int(node_id): i for i, node_id in enumerate(self.node_ids)}
+        self.sizes = np.array([n.get_size() for n in self.nodes],
+                              dtype=np.float64).reshape(-1, 2)
+        self.placed = np.array([n.get_isPlaced() != 0 for n in self.nodes],
+                               dtype=bool)
+
+        self.positions = np.zeros((len(self.nodes), 2))
+        self.orientations = np.zeros(len(self.nodes))
+        self.node_versions = np.zeros(len(self.nodes), dtype=np.int64)
+        self.version = 0
+
+        edges = g.get_edges()
+        self.edge_instance_ids = np.zeros((len(edges), 2), dtype=np.int64)
+        self.edge_pad_ids = np.zeros((len(edges), 2), dtype=np.int64)
+        self.edge_pad_offsets = np.zeros((len(edges), 2, 2))
+        self.edge_net_ids = np.zeros(len(edges), dtype=np.int64)
+        self.edge_power = np.zeros(len(edges), dtype=bool)
+        for j in range(len(edges)):
+            e = edges[j]
+            for i in range(2):
+                pad_pos = e.get_pos(i)
+                self.edge_instance_ids[j, i] = e.get_instance_id(i)
+                self.edge_pad_ids[j, i] = e.get_pad_id(i)
+                self.edge_pad_offsets[j, i] = (float(pad_pos[0]),
+                                               float(pad_pos[1]))
+            self.edge_net_ids[j] = e.get_net_id()
+            self.edge_power[j] = e.get_power_rail() > 0
+        self.edge_nodes = np.array(
+            [[self.index[int(node_id)] for node_id in ids]
+             for ids in self.edge_instance_ids], dtype=np.int64).reshape(-1, 2)
+
+        self.pull()
+
+    def pull(self):
+        """
+        Reads the poses of all nodes from the graph.
+
+        Returns:
+            int: number of nodes whose pose changed.
+        """
+        changed = 0
+        for i in range(len(self.nodes)):
+            pos = self.nodes[i].get_pos()
+            orientation = self.nodes[i].get_orientation()
+            changed += self._store(i, pos, orientation)
+
+        if changed != 0:
+            self.version += 1
+        return changed
+
+    def _store(self, i, pos, orientation):
+        # stores the pose of node i; returns 1 if it changed, 0 otherwise
+        unchanged = (self.node_versions[i] != 0 and
+                     pos[0] == self.positions[i, 0] and
+                     pos[1] == self.positions[i, 1] and
+                     orientation == self.orientations[i])
+        self.positions[i] = pos
+        self.orientations[i] = orientation
+        if unchanged:
+            return 0
+        self.node_versions[i] += 1
+        return 1
+
+    def push(self):
+        """
+        Writes the poses of all nodes to the graph.
+        """
+        for i in range(len(self.nodes)):
+            self.nodes[i].set_pos((float(self.positions[i, 0]),
+                                   float(self.positions[i, 1])))
+            self.nodes[i].set_orientation(float(self.orientations[i]))
+
+    def set_pose(self, i, pos, orientation):
+        """
+        Moves and rotates the node at graph index i.
+
+        Args:
+            i (int): graph index of the node.
+            pos (tuple): new (x, y) position.
+            orientation (float): new orientation, in degrees.
+        """
+        pos = (float(pos[0]), float(pos[1]))
+        orientation = float(orientation)
+        self.nodes[i].set_pos(pos)
+        self.nodes[i].set_orientation(orientation)
+        self.version += self._store(i, pos, orientation)
+
+    def set_pos(self, i, pos):
+        """
+        Moves the node at graph index i to pos = (x, y).
+        """
+        self.set_pose(i, pos, self.orientations[i])
+
+    def set_orientation(self, i, orientation):
+        """
+        Rotates the node at graph index i to orientation (in degrees).
+        """
+        self.set_pose(i, self.positions[i], orientation)
@@ -0,0 +1,221 @@
+"""
+This module provides incrementally maintained half-perimeter wirelengths.
+
+Module: hpwl
+
+Classes:
+
+    hpwl_tracker: Keeps the bounding box of every net of a graph, together
+    with the pin defining each of its four sides. When a component moves,
+    only the nets it touches are updated, and a side is only rescanned when
+    the pin defining it moves inwards.
+
+Usage example:
+from core.environment.hpwl import hpwl_tracker
+
+hpwl = hpwl_tracker(g, rotations)
+net_hpwl = hpwl.get_hpwl_of_net(net_id)
+board_hpwl = hpwl.calc_hpwl()
+
+"""
+import math
+import numpy as np
+
+from graph_utils import pad_rotation_table, quarter_turn_index
+
+# bounding box sides, as (coordinate, direction): min_x, max_x, min_y, max_y
+_sides = ((0, -1), (0, 1), (1, -1), (1, 1))
+
+class hpwl_tracker:
+    """
+    Incrementally maintained equivalent of graph.calc_hpwl_of_net(net_id,
+    True) and graph.calc_hpwl(True); results are identical.
+
+    Every net holds one pin per distinct (instance id, pad id) found on its
+    edges. The hpwl of a net is (max_x - min_x) + (max_y - min_y) over the
+    absolute pin positions, or -1 for nets with fewer than two pins. As in
+    the graph library, the maxima start from 0, so they never go negative.
+
+    Args:
+        g: graph whose nets are tracked.
+        rotations (pad_rotation_table): board wide pad rotation table. Built
+        from the edges of g when None.
+        state (graph_state): NumPy mirror of g. When given, moved nodes are
+        found from its node versions instead of polling every node of g.
+
+    Attributes:
+        pins (dict): net id => list of (graph index, table row) per pin.
+        positions (dict): net id => list of absolute [x, y] per pin.
+        extremes (dict): net id => [min_x, max_x, min_y, max_y] pin indices.
+        hpwl (dict): net id => current hpwl.
+        power (dict): net id => True for power rail nets.
+        updates (int): number of net updates so far.
+        rescans (int): number of bounding box sides rescanned so far.
+        version (int): incremented by every sync that found a moved node.
+    """
+    def __init__(self, g, rotations=None, state=None):
+        self.g = g
+        self.state = state
+        edges = g.get_edges()
+        if rotations is None:
+            rotations = pad_rotation_table(edges)
+        self.rotations = rotations
+
+        # indexing the node vector is slow and iterating over it yields
+        # copies; keep a list of references instead.
+        nodes = g.get_nodes()
+        self.nodes = [nodes[i] for i in range(len(nodes))]
+        self.node_ids = [n.get_id() for n in self.nodes]
+        index = {node_id: i for i, node_id in enumerate(self.node_ids)}
+
+        self.pins = {}
+        self.power = {}
+        # graph index => [(net id, pin index)]
+        self.node_pins = [[] for _ in self.nodes]
+        seen = set()
+        for e in edges:
+            net_id = e.get_net_id()
+            self.pins.setdefault(net_id, [])
+            self.power[net_id] = e.get_power_rail() > 0
+            for i in range(2):
+                key = (net_id, e.get_instance_id(i), e.get_pad_id(i))
+                if key in seen:
+                    continue
+                seen.add(key)
+                node_index = index[e.get_instance_id(i)]
+                row = rotations.index[(e.get_instance_id(i), e.get_pad_id(i))]
+                self.node_pins[node_index].append((net_id,
+                                                   len(self.pins[net_id])))
+                self.pins[net_id].append((node_index, row))
+
+        self.net_ids = sorted(self.pins)
+        self.positions = {net_id: [None] * len(self.pins[net_id])
+                          for net_id in self.net_ids}
+        self.extremes = {net_id: None for net_id in self.net_ids}
+        self.hpwl = {net_id: -1 for net_id in self.net_ids}
+        self.poses = [None] * len(self.nodes)
+        self.updates = 0
+        self.rescans = 0
+        self.version = 0
+        if state is not None:
+            self.state_versions = np.zeros_like(state.node_versions)
+
+    def sync(self):
+        """
+        Updates the nets of every node that moved or rotated since the last
+        call.
+
+        Returns:
+            int: number of nets updated.
+        """
+        moved = {}
+        for i, pose in self._moved():
+            self.poses[i] = pose
+            for net_id, pin in self.node_pins[i]:
+                rotated = self._rotate(self.pins[net_id][pin][1], pose[2])
+                self.positions[net_id][pin] = [pose[0] + rotated[0],
+                                               pose[1] + rotated[1]]
+                moved.setdefault(net_id, set()).add(pin)
+
+        for net_id, pins in moved.items():
+            self._update_net(net_id, pins)
+
+        self.updates += len(moved)
+        if len(moved) != 0:
+            self.version += 1
+        return len(moved)
+
+    def _moved(self):
+        # (graph index, (x, y, orientation)) of nodes whose pose changed
+        if self.state is not None:
+            moved = np.flatnonzero(self.state.node_versions != self.state_versions)
+            self.state_versions[moved] = self.state.node_versions[moved]
+            return [(i, (float(self.state.positions[i, 0]),
+                         float(self.state.positions[i, 1]),
+                         float(self.state.orientations[i]))) for i in moved]
+
+        moved = []
+        for i in range(len(self.nodes)):
+            pos = self.nodes[i].get_pos()
+            pose = (pos[0], pos[1], self.nodes[i].get_orientation())
+            if pose != self.poses[i]:
+                moved.append((i, pose))
+        return moved
+
+    def _rotate(self, row, a):
+        # The graph library rotates pads with cos/sin(a / 180 * pi) from the
+        # C math library. These agree with the quarter turn table, but may
+        # differ from np.cos/np.sin (and thus kicad_rotate) by an ulp at
+        # other angles.
+        k = quarter_turn_index(a)
+        if k is not None:
+            return self.rotations.rotated[k, row]
+        x, y = self.rotations.offsets[row]
+        theta = a / 180.0 * math.pi
+        c = math.cos(theta)
+        s = math.sin(theta)
+        return (x * c + y * s, - x * s + y * c)
+
+    def _rescan(self, positions, coordinate, direction):
+        # pin index of the most extreme pin along one side
+        self.rescans += 1
+        best = 0
+        for j in range(1, len(positions)):
+            if direction * (positions[j][coordinate]
+                            - positions[best][coordinate]) > 0:
+                best = j
+        return best
+
+    def _update_net(self, net_id, moved):
+        positions = self.positions[net_id]
+        if len(positions) < 2 or None in positions:
+            return
+
+        extremes = self.extremes[net_id]
+        if extremes is None:
+            extremes = [self._rescan(positions, c, d) for c, d in _sides]
+        else:
+            for k, (c, d) in enumerate(_sides):
+                if extremes[k] in moved:
+                    # the defining pin moved, possibly inwards
+                    extremes[k] = self._rescan(positions, c, d)
+                    continue
+                for j in moved:
+                    if d * (positions[j][c] - positions[extremes[k]][c]) > 0:
+                        extremes[k] = j
+        self.extremes[net_id] = extremes
+
+        self.hpwl[net_id] = \
+            (max(positions[extremes[1]][0], 0.0) - positions[extremes[0]][0]) + \
+            (max(positions[extremes[3]][1], 0.0) - positions[extremes[2]][1])
+
+    def get_hpwl_of_net(self, net_id):
+        """
+        Equivalent of graph.calc_hpwl_of_net(net_id, True).
+        """
+        self.sync()
+        return self.hpwl[net_id]
+
+    def get_hpwl_of_nets(self, net_ids):
+        """
+        Sum of graph.calc_hpwl_of_net(net_id, True) over net_ids, added up in
+        the order given.
+        """
+        self.sync()
+        hpwl = 0
+        for net_id in net_ids:
+            hpwl += self.hpwl[net_id]
+        return hpwl
+
+    def calc_hpwl(self):
+        """
+        Equivalent of graph.calc_hpwl(True): the sum of the hpwl of every
+        net that is not a power rail, in increasing net id.
+        """
+        self.sync()
+        hpwl = 0.0
+        for net_id in self.net_ids:
+            if self.power[net_id] or self.hpwl[net_id] < 0:
+                continue
+            hpwl += self.hpwl[net_id]
+        return hpwl
@@ -0,0 +1,270 @@
+"""
+This module provides a persistent occupancy raster for an environment.
+
+Module: occupancy
+
+Classes:
+
+    occupancy_cache: Keeps a compact raster of the padded board and the
+    components of a graph: a coverage count map, plus the footprint of every
+    component in the smallest window containing it.
+    A footprint is only redrawn when the position or orientation of its node
+    has changed since it was last drawn, so memory and update cost no longer
+    grow with (number of components) x (board area).
+
+Usage example:
+from core.environment.occupancy import occupancy_cache
+
+occupancy = occupancy_cache(g, b.get_width(), b.get_height(), padding=4)
+los, ol, los_masks, ol_masks = occupancy.get_los_and_ol(node_id, radius)
+los, ol, overlap_pixels = occupancy.get_los_and_ol_pixels(node_id, radius)
+legal = occupancy.is_legal()
+
+"""
+import numpy as np
+import cv2
+
+from pcbDraw import draw_component_footprint, get_los_wedge_window
+from pcbDraw import pcbDraw_resolution
+
+class occupancy_cache:
+    """
+    Incrementally maintained, compact equivalent of
+    pcbDraw.draw_board_from_graph_multi_agent.
+
+    Args:
+        g: graph whose nodes are drawn.
+        bx (float): board width.
+        by (float): board height.
+        padding (float): padding around the board, in mm.
+        state (graph_state): NumPy mirror of g. When given, moved nodes are
+        found from its node versions and poses are read from its arrays
+        instead of polling every node of g.
+
+    Attributes:
+        border (numpy array): padded board border layer; never changes.
+        coverage (numpy array): number of components, and the board border,
+        covering every pixel.
+        footprints (list): (row_0, col_0, mask) of every node in graph order.
+        poses (list): (x, y, orientation) each footprint was drawn with.
+        redraws (int): number of footprints drawn so far.
+        version (int): incremented by every sync that redrew a footprint,
+        i.e. whenever a node moved or rotated.
+    """
+    def __init__(self, g, bx, by, padding=4, state=None):
+        self.g = g
+        self.state = state
+        self.bx = bx
+        self.by = by
+        self.padding = padding
+
+        res = pcbDraw_resolution()
+        x = bx / res
+        y = by / res
+        border = np.zeros((int(x),int(y),1), np.uint8)
+        self.border = cv2.copyMakeBorder(border,
+                                         int(padding/res),
+                                         int(padding/res),
+                                         int(padding/res),
+                                         int(padding/res),
+                                         cv2.BORDER_CONSTANT,
+                                         value=(64))
+        self.shape = self.border.shape
+
+        self.coverage = (self.border != 0).astype(np.int16)
+
+        self.nodes = g.get_nodes()
+        self.node_ids = [n.get_id() for n in self.nodes]
+        self.index = {node_id: i for i, node_id in enumerate(self.node_ids)}
+        self.sizes = [n.get_size() for n in self.nodes]
+        self.footprints = [None] * len(self.nodes)
+        self.poses = [None] * len(self.nodes)
+        self.redraws = 0
+        self.version = 0
+        if state is not None:
+            self.state_versions = np.zeros_like(state.node_versions)
+
+    def sync(self):
+        """
+        Redraws the footprints of nodes that moved or rotated since the last
+        call and updates the coverage map accordingly.
+
+        Returns:
+            int: number of footprints redrawn.
+        """
+        redrawn = 0
+        for i, pose in self._moved():
+            pos = pose[:2]
+
+            if self.footprints[i] is not None:
+                self._add_footprint(self.footprints[i], -1)
+
+            self.footprints[i] = draw_component_footprint(pos,
+                                                          self.sizes[i],
+                                                          pose[2],
+                                                          self.bx,
+                                                          self.by,
+                                                          padding=self.padding)
+            self._add_footprint(self.footprints[i], 1)
+            self.poses[i] = pose
+            redrawn += 1
+
+        self.redraws += redrawn
+        if redrawn != 0:
+            self.version += 1
+        return redrawn
+
+    def _moved(self):
+        # (graph index, (x, y, orientation)) of nodes whose pose changed
+        if self.state is not None:
+            moved = np.flatnonzero(self.state.node_versions != self.state_versions)
+            self.state_versions[moved] = self.state.node_versions[moved]
+            return [(i, (self.state.positions[i, 0],
+                         self.state.positions[i, 1],
+                         self.state.orientations[i])) for i in moved]
+
+        moved = []
+        for i in range(len(self.nodes)):
+            pos = self.nodes[i].get_pos()
+            pose = (pos[0], pos[1], self.nodes[i].get_orientation())
+            if pose != self.poses[i]:
+                moved.append((i, pose))
+        return moved
+
+    def _add_footprint(self, footprint, sign):
+        row_0, col_0, mask = footprint
+        window = self.coverage[row_0:row_0+mask.shape[0],
+                               col_0:col_0+mask.shape[1]]
+        window += sign * (mask != 0)
+
+    def _current_and_others(self, node_id, window):
+        # masks of the current node and of everything else (other nodes and
+        # the board border) within window = (row_0, row_1, col_0, col_1).
+        row_0, row_1, col_0, col_1 = window
+        current = np.zeros((row_1-row_0, col_1-col_0), bool)
+        r_0, c_0, m = self.footprints[self.index[node_id]]
+        top, bottom = max(r_0, row_0), min(r_0+m.shape[0], row_1)
+        left, right = max(c_0, col_0), min(c_0+m.shape[1], col_1)
+        if top < bottom and left < right:
+            current[top-row_0:bottom-row_0, left-col_0:right-col_0] = \
+                m[top-r_0:bottom-r_0, left-c_0:right-c_0] != 0
+
+        others = (self.coverage[row_0:row_1, col_0:col_1] - current) > 0
+        return current, others
+
+    def get_layer(self, i):
+        """
+        Returns the full size layer of the node at graph index i, as drawn by
+        draw_board_from_graph_multi_agent.
+        """
+        layer = np.zeros(self.shape, np.uint8)
+        row_0, col_0, mask = self.footprints[i]
+        layer[row_0:row_0+mask.shape[0], col_0:col_0+mask.shape[1]] = mask
+        return layer
+
+    def get_layers(self, node_id):
+        """
+        Returns the layer stack for node_id.
+
+        The layout matches draw_board_from_graph_multi_agent:
+        idx = 0 ( grid border ), idx = 1 ( current node ),
+        idx = 2 ... ( all other nodes in graph order ). The layers are
+        materialised from the footprints on every call; this is only needed
+        for visualisation.
+        """
+        self.sync()
+        stack = [self.border, None]
+        for i in range(len(self.nodes)):
+            if self.node_ids[i] == node_id:
+                stack[1] = self.get_layer(i)
+            else:
+                stack.append(self.get_layer(i))
+
+        return stack
+
+    def get_los_and_ol(self, node_id, radius):
+        """
+        Line-of-sight and overlap features of a node, read from the coverage
+        map. Identical to pcbDraw.get_los_and_ol_multi_agent (los_type 0) with
+        the layer stack of draw_board_from_graph_multi_agent.
+
+        Args:
+            node_id (int): id of the current node.
+            radius (float): line-of-sight radius in mm.
+
+        Returns:
+            tuple: (los, ol, los_segments_mask, overlap_segments_mask). The
+            masks cover the bounding window of the line-of-sight circle only.
+        """
+        self.sync()
+        res = pcbDraw_resolution()
+        pos = self.poses[self.index[node_id]]
+        cx = int(pos[0]/res) + int(self.padding/res)
+        cy = int(pos[1]/res) + int(self.padding/res)
+
+        masks, pixels, window = get_los_wedge_window(int(radius / res),
+                                                     pos[2],
+                                                     cx,
+                                                     cy,
+                                                     self.shape)
+        current, others = self._current_and_others(node_id, window)
+
+        overlap_masks = masks * current
+        segment_mask_pixels = pixels * 64
+        overlap_mask_pixels = np.sum(overlap_masks, axis=(1,2), dtype=np.float64)
+        segment_pixels = np.sum(masks * others, axis=(1,2), dtype=np.float64)
+        overlap_pixels = np.sum(overlap_masks * others, axis=(1,2), dtype=np.float64)
+
+        return (segment_pixels/segment_mask_pixels,
+                overlap_pixels/overlap_mask_pixels,
+                np.array(masks),
+                overlap_masks)
+
+    def get_los_and_ol_pixels(self, node_id, radius):
+        """
+        Line-of-sight and overlap features of a node, as get_los_and_ol,
+        without materialising the masked segments.
+
+        The wedge masks are multiplied with the coverage of the other
+        components, of the current node and of their overlap in a single
+        matrix product, instead of masking and summing three (8, h, w)
+        arrays. Pixel counts are exact in float32, so the features are
+        identical.
+
+        Args:
+            node_id (int): id of the current node.
+            radius (float): line-of-sight radius in mm.
+
+        Returns:
+            tuple: (los, ol, overlap_pixels), overlap_pixels is the number
+            of pixels of the current node within every segment.
+        """
+        self.sync()
+        res = pcbDraw_resolution()
+        pos = self.poses[self.index[node_id]]
+        cx = int(pos[0]/res) + int(self.padding/res)
+        cy = int(pos[1]/res) + int(self.padding/res)
+
+        masks, pixels, window = get_los_wedge_window(int(radius / res),
+                                                     pos[2],
+                                                     cx,
+                                                     cy,
+                                                     self.shape)
+        current, others = self._current_and_others(node_id, window)
+
+        coverage = np.stack((others, current, others & current), axis=-1)
+        sums = np.matmul(masks.reshape(8, -1).astype(np.float32),
+                         coverage.reshape(-1, 3).astype(np.float32))
+        # the masks are 64 inside a segment
+        sums = sums.astype(np.float64) / 64
+        return (sums[:, 0]/pixels,
+                sums[:, 2]/sums[:, 1],
+                sums[:, 1])
+
+    def is_legal(self):
+        """
+        True when no two components, or a component and the board border,
+        share a pixel.
+        """
+        self.sync()
+        return np.max(self.coverage) <= 1
@@ -30,6 +30,14 @@ class parameters:
         # TODO: Add error checking
         self.idx = params["idx"]
         self.shuffle_idxs = params["shuffle_idxs"]
+        # "raster" (pcbDraw) or "analytic" (pcb_geometry_utils) computation
+        # of the line-of-sight and overlap observations.
+        self.los_backend = params.get("los_backend", "raster")
+        # "sequential": every agent observes the moves of the agents before
+        # it; "simultaneous": all agents act on the board at the start of
+        # the step, with one batched policy evaluation (see
+        # environment.step_simultaneous)
+        self.step_mode = params.get("step_mode", "sequential")
     def write_to_file(self, fileName, append=True):
         return
 
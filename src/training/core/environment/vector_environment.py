@@ -0,0 +1,325 @@
+"""
+This module steps several environments in lockstep.
+
+Module: vector_environment
+
+Functions:
+
+    derive_seeds: Deterministic, independent seeds for several environments
+    from one seed.
+
+Classes:
+
+    vector_environment: Holds K independent environment copies (own seeds,
+    boards drawn from the same pcb file) and steps them together. The
+    agents moving at the same point of a step are evaluated in one batched
+    forward pass of the policy, and finished environments are reset
+    automatically.
+
+Usage example:
+from core.environment.vector_environment import vector_environment
+
+envs = vector_environment(env_params, num_envs=4)
+envs.reset()
+steps = envs.step(model=actor, random=False)
+states, rewards, dones = steps["state"], steps["reward"], steps["done"]
+
+"""
+import copy
+import time
+import numpy as np
+
+from core.environment.environment import environment
+from core.agent.observation import observation_to_state
+
+def derive_seeds(seed, n):
+    """
+    Seeds for n environments. The first environment keeps seed, the others
+    get independent seeds spawned from it.
+
+    Args:
+        seed (int): base seed.
+        n (int): number of seeds.
+
+    Returns:
+        list: n integer seeds.
+    """
+    children = np.random.SeedSequence(int(seed)).spawn(max(n-1, 0))
+    return [seed] + [int(c.generate_state(1)[0]) for c in children]
+
+class vector_environment:
+    """
+    K environments stepped in lockstep.
+
+    Within every environment the agents still move one after the other and
+    observe the moves of the agents before them, exactly as in
+    environment.step. Across environments the k-th moving agents are
+    batched: their states are evaluated in a single forward pass of the
+    policy, so a step costs (number of agents) forward passes of K states
+    instead of K x (number of agents) single state passes. With the
+    "simultaneous" step mode, a step is one forward pass for all agents of
+    all environments.
+
+    Args:
+        parameters: environment parameters; every copy gets its own seed
+        from derive_seeds(parameters.seed, num_envs).
+        num_envs (int): number of environments, K.
+        seeds (list): explicit seeds, one per environment; overrides
+        num_envs.
+
+    Attributes:
+        envs (list): the environments.
+        episode_rewards (list): running episode reward of every environment,
+        the sum over steps of the mean agent reward as in TD3.learn.
+        episode_lengths (list): running episode length of every environment.
+    """
+    def __init__(self, parameters, num_envs=1, seeds=None):
+        if seeds is None:
+            seeds = derive_seeds(parameters.seed, num_envs)
+        self.num_envs = len(seeds)
+        self.envs = []
+        for seed in seeds:
+            env_params = copy.copy(parameters)
+            env_params.seed = seed
+            self.envs.append(environment(env_params))
+
+        self.episode_rewards = [0.0] * self.num_envs
+        self.episode_lengths = [0] * self.num_envs
+        self.episode_start_times = [time.clock_gettime(time.CLOCK_REALTIME)] \
+            * self.num_envs
+
+    @property
+    def agents(self):
+        # agents of the first environment; used for observation and action
+        # space shapes, which all environments share.
+        return self.envs[0].agents
+
+    @property
+    def tracker(self):
+        return self.envs[0].tracker
+
+    def reset(self):
+        for e in range(self.num_envs):
+            self._reset(e)
+
+    def _reset(self, e):
+        self.envs[e].reset()
+        self.envs[e].tracker.reset()
+        self.episode_rewards[e] = 0.0
+        self.episode_lengths[e] = 0
+        self.episode_start_times[e] = time.clock_gettime(time.CLOCK_REALTIME)
+
+    def _policy_actions(self, model, states, random, deterministic,
+                        rl_model_type):
+        # one batched forward pass for the states of several agents
+        if random is True or len(states) == 0:
+            return [None] * len(states)
+        if rl_model_type == "TD3":
+            return list(model.select_actions(np.array(states)))
+        return list(model.select_actions(np.array(states),
+                                         evaluate=deterministic))
+
+    def step(self,
+             model,
+             random=False,
+             deterministic:bool = False,
+             rl_model_type:str = "TD3"):
+        """
+        Steps every environment once and resets the environments whose
+        episode finished.
+
+        Returns:
+            dict: stacked arrays over all transitions of this step, in
+            environment order: "state", "next_state" (transitions, state dim),
+            "action" (transitions, action dim), "reward", "done" and "env"
+            (index of the environment of every transition); "info", the list
+            of next state infos; and "episodes", a list with one dict
+            (env, episode_reward, episode_length, episode_fps) per finished
+            episode.
+        """
+        if self.envs[0].parameters.step_mode == "simultaneous":
+            return self.step_simultaneous(model,
+                                          random=random,
+                                          deterministic=deterministic,
+                                          rl_model_type=rl_model_type)
+
+        self.begin_step()
+        while True:
+            active = self.get_active()
+            if len(active) == 0:
+                break
+            policy_actions = self._policy_actions(model,
+                                                  self.get_states(active),
+                                                  random,
+                                                  deterministic,
+                                                  rl_model_type)
+            self.act(active,
+                     policy_actions,
+                     model=model,
+                     random=random,
+                     deterministic=deterministic,
+                     rl_model_type=rl_model_type)
+
+        return self.end_step()
+
+    def step_simultaneous(self,
+                          model,
+                          random=False,
+                          deterministic:bool = False,
+                          rl_model_type:str = "TD3"):
+        """
+        Simultaneous step (see environment.step_simultaneous) of every
+        environment, with a single forward pass of the policy for all the
+        agents of all environments.
+
+        Returns:
+            dict: as returned by step.
+        """
+        orders = []
+        states = []
+        for env in self.envs:
+            idxs, observations = env.begin_simultaneous_step()
+            orders.append(idxs)
+            states.append(observations)
+        policy_actions = self._policy_actions(
+            model,
+            [observation_to_state(s) for observations in states
+             for s in observations],
+            random,
+            deterministic,
+            rl_model_type)
+
+        self.transitions = []
+        self.metrics = []
+        start = 0
+        for e, env in enumerate(self.envs):
+            end = start + len(orders[e])
+            transitions, metrics = env.complete_simultaneous_step(
+                orders[e],
+                states[e],
+                policy_actions[start:end],
+                model=model,
+                random=random,
+                deterministic=deterministic,
+                rl_model_type=rl_model_type)
+            self.transitions.append(transitions)
+            self.metrics.append(metrics)
+            start = end
+        return self.end_step()
+
+    def begin_step(self):
+        """
+        Starts a step in every environment: decides the agent orders and
+        observes the first agents.
+        """
+        self.transitions = [[] for _ in range(self.num_envs)]
+        self.metrics = [[] for _ in range(self.num_envs)]
+        self.orders = []
+        self.observations = []
+        for env in self.envs:
+            idxs, observation = env.begin_step()
+            self.orders.append(idxs)
+            self.observations.append(observation)
+
+    def get_active(self):
+        """
+        Indices of the environments with an agent still to move in this step.
+        """
+        return [e for e in range(self.num_envs)
+                if self.observations[e] is not None]
+
+    def get_states(self, active):
+        """
+        States of the next agent to move in the environments active.
+        """
+        return [observation_to_state(self.observations[e]) for e in active]
+
+    def act(self,
+            active,
+            policy_actions,
+            model=None,
+            random=False,
+            deterministic:bool = False,
+            rl_model_type:str = "TD3"):
+        """
+        Moves the next agent of every environment in active.
+
+        Args:
+            active (list): environment indices, as returned by get_active.
+            policy_actions (list): policy output for the state of each of
+            these agents, or None entries when random.
+        """
+        for e, policy_action in zip(active, policy_actions):
+            env = self.envs[e]
+            k = len(self.transitions[e])
+            action = env.agents[self.orders[e][k]].act(
+                self.observations[e],
+                model=model,
+                random=random,
+                deterministic=deterministic,
+                rl_model_type=rl_model_type,
+                policy_action=policy_action)
+            transition, step_metrics, self.observations[e] = \
+                env.complete_agent_step(self.orders[e],
+                                        k,
+                                        self.observations[e],
+                                        action)
+            self.transitions[e].append(transition)
+            self.metrics[e].append(step_metrics)
+            if transition[4] is True:
+                self.observations[e] = None
+
+    def end_step(self):
+        """
+        Finishes the step in every environment and resets the environments
+        whose episode finished.
+
+        Returns:
+            dict: as returned by step.
+        """
+        episodes = []
+        for e in range(self.num_envs):
+            self.envs[e].end_step(self.metrics[e])
+            if len(self.transitions[e]) == 0:
+                continue
+            self.episode_rewards[e] += float(np.mean(
+                np.array([transition[2] for transition in self.transitions[e]])))
+            self.episode_lengths[e] += 1
+            if any(transition[4] for transition in self.transitions[e]):
+                finish_time = time.clock_gettime(time.CLOCK_REALTIME)
+                episodes.append({
+                    "env": e,
+                    "episode_reward": self.episode_rewards[e],
+                    "episode_length": self.episode_lengths[e],
+                    "episode_fps": self.episode_lengths[e] /
+                        (finish_time - self.episode_start_times[e])})
+                self._reset(e)
+
+        flat = [(e, transition) for e in range(self.num_envs)
+                for transition in self.transitions[e]]
+        return {"state": np.array([t[0] for _, t in flat]),
+                "next_state": np.array([t[1] for _, t in flat]),
+                "action": np.array([t[3] for _, t in flat]),
+                "reward": np.array([t[2] for _, t in flat], dtype=np.float64),
+                "done": np.array([t[4] is True for _, t in flat], dtype=bool),
+                "env": np.array([e for e, _ in flat], dtype=np.int64),
+                "info": [t[5] for _, t in flat],
+                "episodes": episodes}
+
+    # Parameters, targets and hpwl are those of the first environment, which
+    # keeps the seed the vector environment was created with.
+    @property
+    def parameters(self):
+        return self.envs[0].parameters
+
+    def get_parameters(self):
+        return self.envs[0].get_parameters()
+
+    def get_target_params(self):
+        return self.envs[0].get_target_params()
+
+    def get_all_target_params(self):
+        return self.envs[0].get_all_target_params()
+
+    def calc_hpwl(self):
+        return self.envs[0].calc_hpwl()
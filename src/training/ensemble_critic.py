@@ -0,0 +1,278 @@
+"""
+This module evaluates the Q-heads of a critic in one batched pass.
+
+Module: ensemble_critic
+
+Classes:
+
+    EnsembleLinear: num_heads linear layers with stacked weights, applied to
+    (num_heads, batch, in) inputs with a single torch.baddbmm.
+
+    EnsembleCritic: A critic of num_heads Q-networks with the architecture
+    of TD3.Critic and SAC.QNetwork, evaluated layer by layer for all heads
+    at once.
+
+Functions:
+
+    critic_layout: Whether a critic state dict is of a twin critic
+    (TD3.Critic, SAC.QNetwork) or of an EnsembleCritic.
+
+    convert_critic_state_dict: Converts a critic state dict between the
+    twin and ensemble layouts.
+
+    convert_critic_optimizer_state_dict: Converts the optimizer state of a
+    critic between the layouts.
+
+    match_critic_checkpoint: Converts a checkpoint to the layout of a
+    critic, when it differs.
+
+Usage example:
+from ensemble_critic import EnsembleCritic, match_critic_checkpoint
+
+critic = EnsembleCritic(state_dim, action_dim, [400, 300], "relu")
+state_dict, _ = match_critic_checkpoint(critic, torch.load("best_critic"))
+critic.load_state_dict(state_dict)
+
+"""
+import math
+import torch
+
+class EnsembleLinear(torch.nn.Module):
+    """
+    num_heads independent linear layers.
+
+    Args:
+        num_heads (int): number of layers.
+        in_features (int): input width.
+        out_features (int): output width.
+
+    Attributes:
+        weight (torch.Tensor): (num_heads, in_features, out_features), the
+        transposed weights of the layers.
+        bias (torch.Tensor): (num_heads, 1, out_features).
+    """
+    def __init__(self, num_heads, in_features, out_features):
+        super(EnsembleLinear, self).__init__()
+        self.num_heads = num_heads
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = torch.nn.Parameter(
+            torch.empty(num_heads, in_features, out_features))
+        self.bias = torch.nn.Parameter(torch.empty(num_heads, 1, out_features))
+        # the distribution of torch.nn.Linear
+        bound = 1 / math.sqrt(in_features)
+        torch.nn.init.uniform_(self.weight, -bound, bound)
+        torch.nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        """
+        Args:
+            x (torch.Tensor): (num_heads, batch, in_features).
+
+        Returns:
+            torch.Tensor: (num_heads, batch, out_features).
+        """
+        return torch.baddbmm(self.bias, x, self.weight)
+
+    def extra_repr(self):
+        return f"num_heads={self.num_heads}, in_features={self.in_features}, " \
+            f"out_features={self.out_features}"
+
+class EnsembleCritic(torch.nn.Module):
+    """
+    Critic with num_heads Q-heads stored as stacked weight tensors.
+
+    forward returns one (batch, 1) tensor per head, as the twin critics
+    return (q1, q2), so the trainers use either critic unchanged; a forward
+    pass launches one batched matmul per layer instead of one per layer and
+    head.
+
+    Args:
+        state_dim (int): state width.
+        action_dim (int): action width.
+        qf (list): hidden layer widths.
+        activation_fn (str): "relu" or "tanh".
+        num_heads (int): number of Q-heads, at least two, as for the
+        clipped double Q targets of the twin critics.
+    """
+    def __init__(self,
+                 state_dim,
+                 action_dim,
+                 qf : list = [400, 300],
+                 activation_fn: str = "relu",
+                 num_heads: int = 2):
+        super(EnsembleCritic, self).__init__()
+        if num_heads < 2:
+            raise ValueError(f"an ensemble critic needs at least 2 Q-heads,"
+                             f" got critic_heads={num_heads}")
+
+        if activation_fn == "relu":
+            self.activation_fn = torch.nn.functional.relu
+        elif activation_fn == "tanh":
+            self.activation_fn = torch.tanh
+        self.num_heads = num_heads
+
+        self.layers = torch.nn.ModuleList()
+        in_size = state_dim + action_dim
+        for layer_sz in qf:
+            self.layers.append(EnsembleLinear(num_heads, in_size, layer_sz))
+            in_size = layer_sz
+        self.layers.append(EnsembleLinear(num_heads, in_size, 1))
+
+    def forward_all(self, state, action):
+        """
+        Q-values of every head.
+
+        Returns:
+            torch.Tensor: (num_heads, batch, 1).
+        """
+        sa = torch.cat([state, action], 1)
+        q = sa.unsqueeze(0).expand(self.num_heads, -1, -1)
+        for i in range(len(self.layers)-1):
+            q = self.activation_fn(self.layers[i](q))
+        return self.layers[-1](q)
+
+    def forward(self, state, action):
+        return torch.unbind(self.forward_all(state, action))
+
+    def Q1(self, state, action):
+        """
+        Q-values of the first head only.
+        """
+        q1 = torch.cat([state, action], 1)
+        for i in range(len(self.layers)-1):
+            layer = self.layers[i]
+            q1 = self.activation_fn(torch.addmm(layer.bias[0], q1,
+                                                layer.weight[0]))
+        return torch.addmm(self.layers[-1].bias[0], q1,
+                           self.layers[-1].weight[0])
+
+def critic_layout(state_dict):
+    """
+    Returns:
+        str: "ensemble" for EnsembleCritic state dicts, "twin" for those of
+        TD3.Critic and SAC.QNetwork.
+    """
+    if any(key.startswith("layers.") for key in state_dict):
+        return "ensemble"
+    return "twin"
+
+def _num_layers(state_dict, layout):
+    prefix = "layers." if layout == "ensemble" else "qf1."
+    return len([key for key in state_dict
+                if key.startswith(prefix) and key.endswith(".weight")])
+
+def convert_critic_state_dict(state_dict, layout):
+    """
+    Converts a critic state dict to layout.
+
+    Twin critics keep the heads in the torch.nn.Sequential stacks qf1 and
+    qf2 of torch.nn.Linear layers; the layers of an EnsembleCritic hold the
+    transposed weights of all heads. Only two-head ensembles convert to the
+    twin layout.
+
+    Args:
+        state_dict (dict): state dict of a twin critic or an EnsembleCritic.
+        layout (str): "twin" or "ensemble".
+
+    Returns:
+        dict: the state dict in layout, with the parameters in the order of
+        the critic of that layout.
+    """
+    source = critic_layout(state_dict)
+    if source == layout:
+        return state_dict
+    num_layers = _num_layers(state_dict, source)
+    converted = {}
+    if layout == "ensemble":
+        num_heads = len({key.split(".")[0] for key in state_dict})
+        for i in range(num_layers):
+            converted[f"layers.{i}.weight"] = torch.stack(
+                [state_dict[f"qf{h+1}.{i}.weight"].t()
+                 for h in range(num_heads)]).contiguous()
+            converted[f"layers.{i}.bias"] = torch.stack(
+                [state_dict[f"qf{h+1}.{i}.bias"].unsqueeze(0)
+                 for h in range(num_heads)])
+        return converted
+
+    num_heads = state_dict["layers.0.weight"].shape[0]
+    if num_heads != 2:
+        raise ValueError(f"a {num_heads} head ensemble has no twin layout")
+    for h in range(num_heads):
+        for i in range(num_layers):
+            converted[f"qf{h+1}.{i}.weight"] = \
+                state_dict[f"layers.{i}.weight"][h].t().contiguous()
+            converted[f"qf{h+1}.{i}.bias"] = \
+                state_dict[f"layers.{i}.bias"][h, 0].clone()
+    return converted
+
+def convert_critic_optimizer_state_dict(optimizer_state_dict,
+                                        critic_state_dict,
+                                        layout):
+    """
+    Converts the state of an optimizer of the critic with critic_state_dict
+    (e.g. the moments of Adam) to layout, as convert_critic_state_dict does
+    for the parameters.
+
+    Args:
+        optimizer_state_dict (dict): state dict of an optimizer over all the
+        parameters of the critic, in their order.
+        critic_state_dict (dict): state dict of that critic.
+        layout (str): "twin" or "ensemble".
+
+    Returns:
+        dict: the optimizer state dict for the critic in layout.
+    """
+    if critic_layout(critic_state_dict) == layout:
+        return optimizer_state_dict
+    names = list(critic_state_dict.keys())
+    state = optimizer_state_dict["state"]
+    converted_names = list(convert_critic_state_dict(critic_state_dict,
+                                                     layout).keys())
+
+    converted_state = {}
+    if len(state) == len(names):
+        # per parameter tensors are converted as parameters, step counts
+        # are the same for all parameters
+        first = state[min(state.keys())]
+        for key, value in first.items():
+            if torch.is_tensor(value) and value.dim() > 0:
+                tensors = {name: state[k][key] for k, name in enumerate(names)}
+                tensors = convert_critic_state_dict(tensors, layout)
+                for k, name in enumerate(converted_names):
+                    converted_state.setdefault(k, {})[key] = tensors[name]
+            else:
+                # step counts are tensors updated in place, one per parameter
+                for k in range(len(converted_names)):
+                    converted_state.setdefault(k, {})[key] = \
+                        value.clone() if torch.is_tensor(value) else value
+    elif len(state) > 0:
+        raise ValueError("the optimizer state does not cover every critic"
+                         " parameter")
+
+    param_groups = []
+    for group in optimizer_state_dict["param_groups"]:
+        group = dict(group)
+        group["params"] = list(range(len(converted_names)))
+        param_groups.append(group)
+    return {"state": converted_state, "param_groups": param_groups}
+
+def match_critic_checkpoint(critic, state_dict, optimizer_state_dict=None):
+    """
+    Converts a critic checkpoint to the layout of critic, so that twin and
+    ensemble critics load each other's checkpoints.
+
+    Args:
+        critic: TD3.Critic, SAC.QNetwork or EnsembleCritic.
+        state_dict (dict): saved critic state dict.
+        optimizer_state_dict (dict): saved state dict of its optimizer.
+
+    Returns:
+        tuple: the state dict and the optimizer state dict (None when not
+        given) in the layout of critic.
+    """
+    layout = critic_layout(critic.state_dict())
+    if optimizer_state_dict is not None:
+        optimizer_state_dict = convert_critic_optimizer_state_dict(
+            optimizer_state_dict, state_dict, layout)
+    return convert_critic_state_dict(state_dict, layout), optimizer_state_dict
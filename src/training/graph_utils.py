@@ -10,6 +10,16 @@ Functions:
     rotation formula.
     - kicad_rotate_around_point: Rotate a point (x, y) around a center point
     (cx, cy) by an angle (a) using the Kicad rotation formula.
+    - quarter_turn_index: Index of an angle in quarter_turns, or None.
+
+Classes:
+    - pad_rotation_table: Pad offsets of a board rotated by each of the
+    quarter_turns, built once per board.
+
+Both functions read cos() and sin() of the quarter turns (0, 90, 180 and 270
+degrees; the only orientations the agents use) from a table and fall back to
+computing them for any other angle. The table holds exactly the values
+np.cos() and np.sin() return, so results do not depend on the path taken.
 
 Example Usage:
     import numpy as np
@@ -26,6 +36,27 @@ Example Usage:
 """
 import numpy as np
 
+quarter_turns = (0.0, 90.0, 180.0, 270.0)
+# cos() and sin() of every quarter turn, computed as in kicad_rotate
+quarter_turn_cos_sin = {a: (np.cos(np.pi * (a / 180.0)),
+                            np.sin(np.pi * (a / 180.0))) for a in quarter_turns}
+_quarter_turn_index = {a: k for k, a in enumerate(quarter_turns)}
+
+def quarter_turn_index(a):
+    """
+    Index of the angle a (in degrees) in quarter_turns.
+
+    Returns:
+        int: the index, or None for any other angle (including 360).
+    """
+    return _quarter_turn_index.get(a)
+
+def _cos_sin(a):
+    if a in quarter_turn_cos_sin:
+        return quarter_turn_cos_sin[a]
+    theta =  np.pi * (a / 180.0)
+    return np.cos( theta ), np.sin( theta )
+
 def kicad_rotate( x, y, a):
     """
     Rotate a point (x, y) by an angle a (in degrees) using the Kicad rotation
@@ -44,10 +75,10 @@ def kicad_rotate( x, y, a):
  	# | -sin()   cos() | /\  | y |
  	# --             --     -- --
 
-    theta =  np.pi * (a / 180.0)
+    c, s = _cos_sin(a)
 
-    rx = x * np.cos( theta ) + y * np.sin( theta )
-    ry = - x * np.sin( theta ) + y * np.cos( theta )
+    rx = x * c + y * s
+    ry = - x * s + y * c
 
     return [rx,ry]
 
@@ -72,9 +103,61 @@ def kicad_rotate_around_point( x, y, cx, cy, a):
  	# | -sin()   cos() | /\  | y |
   	# --             --     -- --
 
-    theta =  np.pi * (a / 180.0)
+    c, s = _cos_sin(a)
 
-    rx = ((x - cx) * np.cos( theta ) + ( y - cy ) * np.sin( theta )) + cx
-    ry = (-(x - cx) * np.sin( theta ) + ( y - cy ) * np.cos( theta )) + cy
+    rx = ((x - cx) * c + ( y - cy ) * s) + cx
+    ry = (-(x - cx) * s + ( y - cy ) * c) + cy
 
     return [rx,ry]
+
+class pad_rotation_table:
+    """
+    Pad offsets rotated by each of the quarter_turns, for every pad that
+    appears at an end of the given edges.
+
+    Pad positions are stored relative to the component origin and only
+    change with the orientation of the component, so the table is built
+    once per board (edges = g.get_edges()) and shared by every agent.
+
+    Args:
+        edges (list): edges whose pads are tabulated.
+
+    Attributes:
+        index (dict): (instance id, pad id) => row of offsets.
+        offsets (numpy array): (pads, 2) unrotated pad offsets.
+        rotated (numpy array): (4, pads, 2) offsets rotated by each quarter
+        turn, identical to kicad_rotate.
+    """
+    def __init__(self, edges):
+        self.index = {}
+        offsets = []
+        for e in edges:
+            for i in range(2):
+                key = (e.get_instance_id(i), e.get_pad_id(i))
+                if key in self.index:
+                    continue
+                pad_pos = e.get_pos(i)
+                self.index[key] = len(offsets)
+                offsets.append([float(pad_pos[0]), float(pad_pos[1])])
+
+        self.offsets = np.array(offsets, dtype=np.float64).reshape(-1, 2)
+        self.rotated = np.empty((len(quarter_turns),) + self.offsets.shape)
+        for k, a in enumerate(quarter_turns):
+            c, s = quarter_turn_cos_sin[a]
+            self.rotated[k, :, 0] = self.offsets[:, 0] * c + self.offsets[:, 1] * s
+            self.rotated[k, :, 1] = -self.offsets[:, 0] * s + self.offsets[:, 1] * c
+
+    def rotate(self, instance_id, pad_id, x, y, a):
+        """
+        Equivalent of kicad_rotate(x, y, a) for the pad (x, y) of a
+        component. The table is used for quarter turns of tabulated pads;
+        any other angle or pad is rotated directly.
+
+        Returns:
+            list: The rotated point [rx, ry].
+        """
+        k = quarter_turn_index(a)
+        row = self.index.get((instance_id, pad_id))
+        if k is None or row is None:
+            return kicad_rotate(x, y, a)
+        return [self.rotated[k, row, 0], self.rotated[k, row, 1]]
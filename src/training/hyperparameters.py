@@ -67,6 +67,35 @@ def gen_default_hyperparameters(on_policy=False):
         "policy_noise": 0.2,
         "noise_clip": 0.5,                 # Range to clip target policy noise
         "policy_freq": 2,                  # Frequency of delayed policy updates
+        # Replay buffer storage: "host" (NumPy), "device" (training device),
+        # "memmap" (files in replay_buffer_dir, default log_dir) or
+        # "prioritized" (host, sampled by TD error)
+        "replay_buffer": "host",
+        # "uniform" or "block" (runs of consecutive rows); memmap only
+        "replay_buffer_sampling": "uniform",
+        # Prioritisation exponent, initial importance-sampling exponent and
+        # sampled batches over which it is annealed to 1; prioritized only
+        "per_alpha": 0.6,
+        "per_beta": 0.4,
+        "per_beta_steps": 100_000,
+        # Storage of the states in host and prioritized replay buffers:
+        # None (float32), "compact" or a dict of field => "float32",
+        # "float16" or "uint8"; see observation_codec
+        "observation_codec": None,
+        # Batches sampled ahead on a background thread during learning; 0
+        # samples synchronously in train
+        "prefetch_batches": 0,
+        # Critic network: "twin" (two Q-networks) or "ensemble" (critic_heads
+        # Q-heads with stacked weights, evaluated in one batched pass)
+        "critic": "twin",
+        "critic_heads": 2,
+        # Acting with the policy: "eager", "script" (TorchScript trace) or
+        # "compile" (torch.compile); see inference_engine
+        "inference_backend": "eager",
+        # Target network updates are made every target_update_interval
+        # updates (TD3: delayed policy updates, SAC: gradient steps), with
+        # the rate scaled to match tau per update
+        "target_update_interval": 1,
         }
 
     if on_policy is True:
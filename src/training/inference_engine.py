@@ -0,0 +1,138 @@
+"""
+This module selects actions with a policy at low per-call overhead.
+
+Module: inference_engine
+
+Classes:
+
+    InferenceEngine: Wraps a TD3 Actor or a SAC GaussianPolicy for acting.
+    States are copied into a preallocated input tensor, the policy runs
+    under torch.inference_mode, optionally as a TorchScript trace or a
+    torch.compile graph, and actions are returned as numpy arrays. It has
+    the select_action / select_actions interface of the policies, so it is
+    passed as model to environment.step, vector_environment.step and
+    environment_pool.step.
+
+Usage example:
+from inference_engine import InferenceEngine
+
+engine = InferenceEngine(model.actor, backend="script")
+action = engine.select_action(state)
+actions = engine.select_actions(states)
+env.step(model=engine)
+
+"""
+import numpy as np
+import torch
+
+BACKENDS = ("eager", "script", "compile")
+
+class InferenceEngine(object):
+    """
+    Fast action selection for a TD3 Actor or a SAC GaussianPolicy.
+
+    The engine holds no copy of the weights: traced and compiled graphs use
+    the parameters of the policy, so optimizer steps are picked up without
+    rebuilding it. With the "eager" backend the actions are those of the
+    policy's own select_action and select_actions; the graph backends
+    compute the same function, but SAC draws its exploration noise in a
+    different order.
+
+    Args:
+        policy: TD3 Actor or SAC GaussianPolicy.
+        backend (str): "eager" (the module), "script" (torch.jit.trace of
+        its forward, built on the first call) or "compile" (torch.compile).
+        max_batch (int): initial number of rows of the input tensor; it
+        grows when a larger batch is selected.
+
+    Attributes:
+        input (torch.Tensor): (max_batch, state_dim) input tensor on the
+        device of the policy.
+    """
+    def __init__(self, policy, backend="eager", max_batch=64):
+        if backend not in BACKENDS:
+            raise ValueError(f"unknown inference backend '{backend}'")
+        self.policy = policy
+        self.backend = backend
+        # GaussianPolicy outputs the mean and log std of its actions
+        self.gaussian = hasattr(policy, "mean_linear")
+        parameter = next(policy.parameters())
+        self.device = parameter.device
+        self.state_dim = policy.pi[0].in_features
+        self.input = torch.zeros((max_batch, self.state_dim),
+                                 dtype=torch.float32, device=self.device)
+        self.staging = None
+        if self.device.type == "cuda":
+            self.staging = torch.zeros((max_batch, self.state_dim),
+                                       dtype=torch.float32, pin_memory=True)
+
+        self.forward = None
+        if backend == "eager":
+            self.forward = policy.forward
+        elif backend == "compile":
+            self.forward = torch.compile(policy)
+
+    def _load(self, states):
+        # copies states into the input tensor, returns the rows used
+        states = np.asarray(states, dtype=np.float32).reshape(-1,
+                                                              self.state_dim)
+        n = len(states)
+        if n > len(self.input):
+            self.input = torch.zeros((2 * n, self.state_dim),
+                                     dtype=torch.float32, device=self.device)
+            if self.staging is not None:
+                self.staging = torch.zeros((2 * n, self.state_dim),
+                                           dtype=torch.float32,
+                                           pin_memory=True)
+        if self.staging is None:
+            self.input[:n].copy_(torch.from_numpy(states))
+        else:
+            self.staging[:n].copy_(torch.from_numpy(states))
+            self.input[:n].copy_(self.staging[:n], non_blocking=True)
+        return self.input[:n]
+
+    def _actions(self, states, evaluate):
+        if self.forward is None:
+            # traced on the first call; the trace shares the parameters of
+            # the policy
+            self.forward = torch.jit.trace(self.policy, states,
+                                           check_trace=False)
+        if not self.gaussian:
+            return self.forward(states)
+        if self.backend == "eager":
+            action, _, mean = self.policy.sample(states)
+            return mean if evaluate is True else action
+
+        mean, log_std = self.forward(states)
+        if evaluate is False:
+            mean = mean + log_std.exp() * torch.randn_like(mean)
+        return torch.tanh(mean) * self.policy.action_scale \
+            + self.policy.action_bias
+
+    def select_actions(self, states, evaluate=False):
+        """
+        Actions for a batch of states in one forward pass.
+
+        Args:
+            states (array_like): (batch, state_dim) states.
+            evaluate (bool): SAC only; the mean action instead of a sample.
+
+        Returns:
+            np.ndarray: (batch, action_dim) actions.
+        """
+        with torch.inference_mode():
+            actions = self._actions(self._load(states), evaluate)
+            return actions.cpu().numpy()
+
+    def select_action(self, state, evaluate=False):
+        """
+        Action for one state.
+
+        Args:
+            state (array_like): (state_dim,) state.
+            evaluate (bool): SAC only; the mean action instead of a sample.
+
+        Returns:
+            np.ndarray: (action_dim,) action.
+        """
+        return self.select_actions(state, evaluate)[0]
@@ -0,0 +1,174 @@
+"""
+This module compresses the state vectors kept in replay memories.
+
+Module: observation_codec
+
+Classes:
+
+    observation_codec: Encodes (..., 23) state vectors, the flattened
+    observations of observation_to_state, into rows of bytes with a storage
+    type per observation field, and decodes them back to float32.
+
+Usage example:
+from observation_codec import observation_codec
+
+codec = observation_codec("compact")
+rows = codec.encode(states)            # (n, codec.nbytes) uint8
+states = codec.decode(rows)            # (n, 23) float32
+print(codec.accuracy_report(states))
+
+"""
+import numpy as np
+
+# Fields of the state vector, in the order of observation_to_state, with
+# their width and the range uint8 storage quantises over.
+OBSERVATION_FIELDS = (("los", 8, (0.0, 1.0)),
+                      ("ol", 8, (0.0, 1.0)),
+                      ("dom", 2, None),
+                      ("euc_dist", 2, None),
+                      ("position", 2, (0.0, 1.0)),
+                      ("ortientation", 1, (0.0, np.pi)))
+
+# The bounded line of sight and overlap features in one byte, the board
+# position and orientation in half precision and the unbounded distance and
+# angle terms at full precision: 38 bytes per state instead of 92 (float32).
+COMPACT_SCHEME = {"los": "uint8",
+                  "ol": "uint8",
+                  "dom": "float32",
+                  "euc_dist": "float32",
+                  "position": "float16",
+                  "ortientation": "float16"}
+
+DTYPES = {"float32": np.float32, "float16": np.float16, "uint8": np.uint8}
+
+class observation_codec:
+    """
+    Storage codec for state vectors.
+
+    Every field is stored as "float32", "float16" or "uint8". uint8 maps the
+    range of the field linearly onto 0..255 (values outside it are clipped);
+    a field entry of the scheme may give its own range as a dict, e.g.
+    {"dtype": "uint8", "low": 0.0, "high": 1.0}. Fields missing from the
+    scheme are stored as float32.
+
+    Args:
+        scheme (str or dict): "compact" (COMPACT_SCHEME), "float32" (no
+        compression) or field name => storage type.
+
+    Attributes:
+        nbytes (int): bytes per encoded state.
+        state_dim (int): width of a decoded state.
+    """
+    def __init__(self, scheme="compact"):
+        if scheme == "compact":
+            scheme = COMPACT_SCHEME
+        elif scheme == "float32":
+            scheme = {}
+        unknown = set(scheme) - {name for name, _, _ in OBSERVATION_FIELDS}
+        if len(unknown) > 0:
+            raise ValueError(f"unknown observation fields {sorted(unknown)}")
+
+        # (name, columns, dtype, low, high, bytes) of every field
+        self.fields = []
+        column = 0
+        offset = 0
+        for name, width, bounds in OBSERVATION_FIELDS:
+            entry = scheme.get(name, "float32")
+            if isinstance(entry, dict):
+                dtype = entry["dtype"]
+                low = entry.get("low", None if bounds is None else bounds[0])
+                high = entry.get("high", None if bounds is None else bounds[1])
+            else:
+                dtype = entry
+                low, high = (None, None) if bounds is None else bounds
+            if dtype not in DTYPES:
+                raise ValueError(f"unknown storage type '{dtype}' for {name}")
+            if dtype == "uint8" and (low is None or high is None):
+                raise ValueError(f"uint8 storage of {name} needs a range")
+            nbytes = width * np.dtype(DTYPES[dtype]).itemsize
+            self.fields.append((name,
+                                slice(column, column + width),
+                                dtype,
+                                low,
+                                high,
+                                slice(offset, offset + nbytes)))
+            column += width
+            offset += nbytes
+        self.state_dim = column
+        self.nbytes = offset
+        self.scheme = {name: dtype for name, _, dtype, _, _, _ in self.fields}
+
+    def encode(self, states):
+        """
+        Encodes states.
+
+        Args:
+            states (array_like): (..., state_dim) state vectors.
+
+        Returns:
+            np.ndarray: (..., nbytes) uint8 rows.
+        """
+        states = np.asarray(states, dtype=np.float64)
+        shape = states.shape[:-1]
+        states = states.reshape(-1, self.state_dim)
+        rows = np.empty((len(states), self.nbytes), dtype=np.uint8)
+        for _, columns, dtype, low, high, nbytes in self.fields:
+            values = states[:, columns]
+            if dtype == "uint8":
+                values = np.rint((np.clip(values, low, high) - low)
+                                 * (255.0 / (high - low)))
+            values = np.ascontiguousarray(values, dtype=DTYPES[dtype])
+            rows[:, nbytes] = values.view(np.uint8)
+        return rows.reshape(shape + (self.nbytes,))
+
+    def decode(self, rows):
+        """
+        Decodes states.
+
+        Args:
+            rows (np.ndarray): (..., nbytes) uint8 rows from encode.
+
+        Returns:
+            np.ndarray: (..., state_dim) float32 state vectors.
+        """
+        shape = rows.shape[:-1]
+        rows = rows.reshape(-1, self.nbytes)
+        states = np.empty((len(rows), self.state_dim), dtype=np.float32)
+        for _, columns, dtype, low, high, nbytes in self.fields:
+            values = np.ascontiguousarray(rows[:, nbytes]).view(DTYPES[dtype])
+            if dtype == "uint8":
+                values = low + values * np.float32((high - low) / 255.0)
+            states[:, columns] = values
+        return states.reshape(shape + (self.state_dim,))
+
+    def accuracy_report(self, states):
+        """
+        Round trip errors of the codec on sample states.
+
+        Args:
+            states (array_like): (n, state_dim) state vectors, e.g. the
+            latest states of a replay memory.
+
+        Returns:
+            dict: field name => {"dtype", "max_abs_error", "mean_abs_error",
+            "clipped" (fraction of values outside a uint8 range)}, and
+            "bytes_per_state" and "compression" (against float32).
+        """
+        states = np.asarray(states, dtype=np.float64).reshape(-1,
+                                                              self.state_dim)
+        errors = np.abs(self.decode(self.encode(states)) - states)
+        report = {}
+        for name, columns, dtype, low, high, _ in self.fields:
+            clipped = 0.0
+            if dtype == "uint8" and len(states) > 0:
+                values = states[:, columns]
+                clipped = float(np.mean((values < low) | (values > high)))
+            report[name] = {
+                "dtype": dtype,
+                "max_abs_error": float(errors[:, columns].max(initial=0.0)),
+                "mean_abs_error": float(errors[:, columns].mean())
+                    if len(states) > 0 else 0.0,
+                "clipped": clipped}
+        report["bytes_per_state"] = self.nbytes
+        report["compression"] = 4 * self.state_dim / self.nbytes
+        return report
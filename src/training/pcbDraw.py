@@ -14,8 +14,10 @@ from graph import node
 from graph import edge
 from graph_utils import kicad_rotate
 import sys
+from functools import lru_cache
 
 r = 0.1    # resolution in mm
+los_template_cache_size = 256   # (radius, orientation) pairs kept in memory
 
 def draw_board_from_board_and_graph(b,
                                     g,
@@ -515,6 +517,72 @@ def draw_board_from_graph_multi_agent(g, node_id, bx, by, padding=None):
     else:
         return grid_comps
 
+# Draws a single component on an otherwise empty grid. The result is
+# identical to the layer produced for that component by
+# draw_board_from_graph_multi_agent.
+def draw_component_layer(pos, size, orientation, bx, by, padding=None):
+    x = bx / r
+    y = by / r
+
+    if padding is not None:
+        grid = np.zeros((int(x)+2*int(padding/r),int(y)+2*int(padding/r),1),
+                        np.uint8)
+        xc = float(pos[0]) / r + int(padding/r)
+        yc = float(pos[1]) / r + int(padding/r)
+    else:
+        grid = np.zeros((int(x),int(y),1), np.uint8)
+        xc = float(pos[0]) / r
+        yc = float(pos[1]) / r
+
+    sz_x = float(size[0]) / r
+    sz_y = float(size[1]) / r
+    # convert the center, size and orientation to rectange points
+    box = cv2.boxPoints(((xc,yc), (sz_x,sz_y), -orientation))
+    box = np.int0(box)  # ensure that box point are integers
+    cv2.drawContours(grid,[box],0,(64),-1)
+
+    return grid.reshape(grid.shape[0], grid.shape[1])
+
+# Draws a single component into the smallest window of the grid containing it.
+# The window, placed at (row_0, col_0), is identical to the corresponding part
+# of draw_component_layer.
+def draw_component_footprint(pos, size, orientation, bx, by, padding=None):
+    x = bx / r
+    y = by / r
+
+    if padding is not None:
+        shape = (int(x)+2*int(padding/r), int(y)+2*int(padding/r))
+        xc = float(pos[0]) / r + int(padding/r)
+        yc = float(pos[1]) / r + int(padding/r)
+    else:
+        shape = (int(x), int(y))
+        xc = float(pos[0]) / r
+        yc = float(pos[1]) / r
+
+    sz_x = float(size[0]) / r
+    sz_y = float(size[1]) / r
+    # convert the center, size and orientation to rectange points
+    box = cv2.boxPoints(((xc,yc), (sz_x,sz_y), -orientation))
+    box = np.int0(box)  # ensure that box point are integers
+
+    row_0 = np.min(box[:,1]) - 1
+    row_1 = np.max(box[:,1]) + 2
+    col_0 = np.min(box[:,0]) - 1
+    col_1 = np.max(box[:,0]) + 2
+    if row_0 >= 0 and col_0 >= 0 and row_1 <= shape[0] and col_1 <= shape[1]:
+        grid = np.zeros((row_1-row_0, col_1-col_0), np.uint8)
+        cv2.drawContours(grid,[box - (col_0, row_0)],0,(64),-1)
+        return int(row_0), int(col_0), grid
+
+    # cv2 rasterises shapes crossing the grid edge differently, so these are
+    # drawn on the whole grid and cropped.
+    row_0 = min(max(row_0, 0), shape[0])
+    row_1 = min(max(row_1, 0), shape[0])
+    col_0 = min(max(col_0, 0), shape[1])
+    col_1 = min(max(col_1, 0), shape[1])
+    grid = draw_component_layer(pos, size, orientation, bx, by, padding=padding)
+    return int(row_0), int(col_0), np.array(grid[row_0:row_1, col_0:col_1])
+
 # only comp_grids[0] is used.
 def draw_board_from_nodes_multi_agent(n, bx, by, padding=None):
     # Setup grid
@@ -575,7 +643,8 @@ def draw_ratsnest_with_board(current_node,
                              b,
                              line_thickness=1,
                              padding=None,
-                             ignore_power=False):
+                             ignore_power=False,
+                             rotations=None):
     # Setup grid
     bx = b.get_width()
     by = b.get_height()
@@ -587,7 +656,13 @@ def draw_ratsnest_with_board(current_node,
                          by,
                          line_thickness=line_thickness,
                          padding=padding,
-                         ignore_power=ignore_power)
+                         ignore_power=ignore_power,
+                         rotations=rotations)
+
+def _rotate_pad(rotations, instance_id, pad_id, x, y, a):
+    if rotations is None:
+        return kicad_rotate(x, y, a)
+    return rotations.rotate(instance_id, pad_id, x, y, a)
 
 def draw_ratsnest(current_node,
                   neighbor_nodes,
@@ -596,7 +671,10 @@ def draw_ratsnest(current_node,
                   by,
                   line_thickness=1,
                   padding=None,
-                  ignore_power=False):
+                  ignore_power=False,
+                  rotations=None):
+    # rotations: optional graph_utils.pad_rotation_table of the board; pads
+    # are then rotated by table lookup instead of kicad_rotate.
     x = bx / r
     y = by / r
 
@@ -623,9 +701,12 @@ def draw_ratsnest(current_node,
                 pad_pos = ee.get_pos(i)
                 # rotate pad positions so that they match the component's
                 # orientation
-                rotated_pad_pos = kicad_rotate(float(pad_pos[0]),
-                                               float(pad_pos[1]),
-                                               current_node_orientation)
+                rotated_pad_pos = _rotate_pad(rotations,
+                                              current_node_id,
+                                              ee.get_pad_id(i),
+                                              float(pad_pos[0]),
+                                              float(pad_pos[1]),
+                                              current_node_orientation)
                 src.append([current_node_pos[0] + rotated_pad_pos[0],
                             current_node_pos[1] + rotated_pad_pos[1]
                             ])
@@ -636,9 +717,12 @@ def draw_ratsnest(current_node,
                         pad_pos = ee.get_pos(i)
                         # rotate pad positions so that they match the
                         # component's orientation
-                        rotated_pad_pos = kicad_rotate(float(pad_pos[0]),
-                                                       float(pad_pos[1]),
-                                                       n.get_orientation())
+                        rotated_pad_pos = _rotate_pad(rotations,
+                                                      n.get_id(),
+                                                      ee.get_pad_id(i),
+                                                      float(pad_pos[0]),
+                                                      float(pad_pos[1]),
+                                                      n.get_orientation())
 
                         dst.append([neighbor_node_pos[0] + rotated_pad_pos[0],
                                     neighbor_node_pos[1] + rotated_pad_pos[1]
@@ -674,6 +758,94 @@ def draw_ratsnest(current_node,
     else:
         return ratsnest
 
+@lru_cache(maxsize=los_template_cache_size)
+def get_los_wedge_templates(radius, orientation):
+    """
+    Draws the eight line-of-sight wedges of a circle once per radius and
+    orientation. The results are cached and shared, they must not be modified.
+
+    Args:
+        radius (int): radius of the circle in pixels.
+        orientation (float): orientation of the node in degrees.
+
+    Returns:
+        tuple: (templates, pixels). templates is a read-only
+        (8, 2*radius+3, 2*radius+3) array of wedge masks (value 64) centred
+        on pixel (radius+1, radius+1); pixels is the number of pixels in
+        every wedge.
+    """
+    size = 2*radius + 3
+    templates = np.zeros((8, size, size), np.uint8)
+    start = -22.5 - orientation
+    stop = 22.5 - orientation
+    for i in range(8):
+        cv2.ellipse(templates[i],
+                    (radius+1, radius+1),
+                    (radius,radius),
+                    0,
+                    start,
+                    stop,
+                    (64),
+                    -1)
+        start -= 45
+        stop -= 45
+
+    pixels = np.count_nonzero(templates, axis=(1,2)).astype(np.float64)
+    templates.flags.writeable = False
+    pixels.flags.writeable = False
+    return templates, pixels
+
+def get_los_wedge_window(radius, orientation, cx, cy, shape):
+    """
+    Translates the cached wedge templates to (cx, cy) and clips them to a grid.
+
+    Args:
+        radius (int): radius of the circle in pixels.
+        orientation (float): orientation of the node in degrees.
+        cx (int): column of the circle centre.
+        cy (int): row of the circle centre.
+        shape (tuple): (rows, columns) of the grid.
+
+    Returns:
+        tuple: (masks, pixels, window). masks are the wedges within
+        window = (row_0, row_1, col_0, col_1), the part of the grid the wedges
+        can touch, and must not be modified; pixels is the number of wedge
+        pixels inside the grid.
+    """
+    templates, pixels = get_los_wedge_templates(radius, orientation)
+    size = templates.shape[1]
+    top = cy - radius - 1
+    left = cx - radius - 1
+    row_0 = min(max(top, 0), shape[0])
+    row_1 = min(max(top + size, 0), shape[0])
+    col_0 = min(max(left, 0), shape[1])
+    col_1 = min(max(left + size, 0), shape[1])
+
+    if row_1 - row_0 == size and col_1 - col_0 == size:
+        return templates, pixels, (row_0, row_1, col_0, col_1)
+
+    # The wedges are clipped by the edge of the grid. cv2 rasterises clipped
+    # polygons slightly differently, so they are drawn directly to stay pixel
+    # identical with drawing on the whole grid.
+    masks = np.zeros((8, row_1 - row_0, col_1 - col_0), np.uint8)
+    if masks.size != 0:
+        start = -22.5 - orientation
+        stop = 22.5 - orientation
+        for i in range(8):
+            cv2.ellipse(masks[i],
+                        (cx - col_0, cy - row_0),
+                        (radius,radius),
+                        0,
+                        start,
+                        stop,
+                        (64),
+                        -1)
+            start -= 45
+            stop -= 45
+    pixels = np.count_nonzero(masks, axis=(1,2)).astype(np.float64)
+
+    return masks, pixels, (row_0, row_1, col_0, col_1)
+
 def draw_los(pos_x,
              pos_y,
              radius,
@@ -712,7 +884,6 @@ def draw_los(pos_x,
         los_segments = np.zeros((8,int(x),int(y),1), np.uint8)
 
     padded_los_segments = []
-    segment_pixels = np.zeros(8)
     if padding is not None:
         scaled_x = np.int0(pos_x / r) + int(padding/r)
         scaled_y = np.int0(pos_y / r) + int(padding/r)
@@ -720,20 +891,15 @@ def draw_los(pos_x,
         scaled_x = np.int0(pos_x / r)
         scaled_y = np.int0(pos_y / r)
     scaled_radius = np.int0(radius / r)
-    start = -22.5 - angle_offset
-    stop = 22.5 - angle_offset
-    for i in range(8):
-        cv2.ellipse(los_segments[i],
-                    (scaled_x,scaled_y),
-                    (scaled_radius,scaled_radius),
-                    0,
-                    start,
-                    stop,
-                    (16),
-                    -1)
-        segment_pixels[i] = np.sum(los_segments[i]) / 16
-        start -= 45
-        stop -= 45
+
+    templates, segment_pixels, (row_0, row_1, col_0, col_1) = \
+        get_los_wedge_window(int(scaled_radius),
+                             angle_offset,
+                             int(scaled_x),
+                             int(scaled_y),
+                             los_segments.shape[1:3])
+    # templates are drawn with value 64, draw_los uses 16.
+    los_segments[:, row_0:row_1, col_0:col_1, 0] = templates >> 2
 
     # this is dumb, but needed so arrays are matching.
     # copyMakeBorder reshapes the output image.
@@ -852,11 +1018,16 @@ def get_los_and_ol_multi_agent(node,
                                radius,
                                grid_comps,
                                padding,
-                               los_type=0):
+                               los_type=0,
+                               roi=False):
     # type 0 - traditional case
     # type 1 - remove current node from the radius.
     # type 3 - cropped grid showing overlapping section
     # type 4 - cropped grid showing overlapping section and current node.
+    #
+    # roi - (types 0 and 1) restrict every mask, bitwise operation and pixel
+    # sum to the bounding window of the line-of-sight circle. The features are
+    # identical, but the returned masks cover the window only.
 
     angle_offset = node.get_orientation()
     res = pcbDraw_resolution()
@@ -875,39 +1046,30 @@ def get_los_and_ol_multi_agent(node,
 
     if los_type in (0, 1):
         if padding is not None:
-            los_segments_mask = np.zeros(
-                (8,int(x)+2*int(padding/res),int(y)+2*int(padding/res)),
-                np.uint8)
-            los_segments = np.zeros(
-                (8,int(x)+2*int(padding/res),int(y)+2*int(padding/res)),
-                np.uint8)
-            overlap_segments_mask = np.zeros(
-                (8,int(x)+2*int(padding/res),int(y)+2*int(padding/res)),
-                np.uint8)
-            overlap_segments = np.zeros(
-                (8,int(x)+2*int(padding/res),int(y)+2*int(padding/res)),
-                np.uint8)
+            shape = (int(x)+2*int(padding/res), int(y)+2*int(padding/res))
         else:
-            los_segments_mask = np.zeros((8,int(x),int(y)), np.uint8)
-            los_segments = np.zeros((8,int(x),int(y)), np.uint8)
-            overlap_segments_mask = np.zeros((8,int(x),int(y)), np.uint8)
-            overlap_segments = np.zeros((8,int(x),int(y)), np.uint8)
+            shape = (int(x), int(y))
+
+        templates, template_pixels, (row_0, row_1, col_0, col_1) = \
+            get_los_wedge_window(radius, angle_offset, cx, cy, shape)
+        if roi and row_1 > row_0 and col_1 > col_0:
+            grid_comps = [grid[row_0:row_1, col_0:col_1]
+                          for grid in grid_comps]
+            los_segments_mask = np.array(templates)
+        else:
+            los_segments_mask = np.zeros((8,) + shape, np.uint8)
+            los_segments_mask[:, row_0:row_1, col_0:col_1] = templates
+        window = los_segments_mask.shape
+
+        los_segments = np.zeros(window, np.uint8)
+        overlap_segments_mask = np.zeros(window, np.uint8)
+        overlap_segments = np.zeros(window, np.uint8)
 
-        segment_mask_pixels = np.zeros(8)
+        segment_mask_pixels = template_pixels * 64
         segment_pixels = np.zeros(8)
         overlap_mask_pixels = np.zeros(8)
         overlap_pixels = np.zeros(8)
-        start = -22.5 - angle_offset
-        stop = 22.5 - angle_offset
         for i in range(8):
-            cv2.ellipse(los_segments_mask[i],
-                        (cx,cy),
-                        (radius,radius),
-                        0,
-                        start,
-                        stop,
-                        (64),
-                        -1)
             overlap_segments_mask[i] = cv2.bitwise_and(
                 src1=los_segments_mask[i],
                 src2=grid_comps[1])
@@ -915,8 +1077,7 @@ def get_los_and_ol_multi_agent(node,
             overlap_mask_pixels[i] = np.sum(overlap_segments_mask[i])
             if los_type == 1:
                 los_segments_mask[i] -= overlap_segments_mask[i]
-
-            segment_mask_pixels[i] = np.sum(los_segments_mask[i])
+                segment_mask_pixels[i] = np.sum(los_segments_mask[i])
 
             for j in range(2, len(grid_comps),1):
                 los_segments[i] = cv2.bitwise_or(
@@ -941,9 +1102,6 @@ def get_los_and_ol_multi_agent(node,
             segment_pixels[i] = np.sum(los_segments[i])
             overlap_pixels[i] = np.sum(overlap_segments[i])
 
-            start -= 45
-            stop -= 45
-
         return segment_pixels/segment_mask_pixels, overlap_pixels/overlap_mask_pixels, los_segments_mask, overlap_segments_mask
 
     if los_type == 2:
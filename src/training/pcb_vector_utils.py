@@ -1,5 +1,5 @@
 import numpy as np
-from graph_utils import kicad_rotate
+from graph_utils import kicad_rotate, pad_rotation_table, quarter_turn_index
 from pcbDraw import draw_los, draw_comps_from_nodes_and_edges, pcbDraw_resolution
 
 def polar_to_rectangular(r, theta):
@@ -310,6 +310,472 @@ def compute_sum_of_euclidean_distances_between_pads(n,
 
     return np.sum(all_lengths)
 
+def _group_starts(values):
+    # indices at which runs of equal values in a sorted array start
+    if len(values) == 0:
+        return np.array([], dtype=np.int64)
+    return np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+
+class pad_topology:
+    """
+    Pad to pad connectivity between a node and its neighbors, compiled into
+    NumPy arrays once so that the pad distance kernels
+    (compute_sum_of_euclidean_distances_between_pads_v2,
+    compute_pad_referenced_distance_vectors_v3) do not walk the edges.
+
+    There is one row for every endpoint of an edge in eoi that lies on the
+    current node, in eoi order. Endpoints whose other end is not a node in nn
+    (e.g. connections between two pads of the current node) are dropped.
+
+    Pads are placed with the quarter turn offsets of a pad_rotation_table;
+    nodes at any other orientation are rotated directly.
+
+    Args:
+        n: current node.
+        nn (list): neighbor nodes.
+        eoi (list): edges of interest, i.e. edges connected to n.
+        rotations (pad_rotation_table): board wide table containing the pads
+        of eoi. Built from eoi when None.
+        state (graph_state): NumPy mirror of the graph; node poses are then
+        read from its arrays.
+
+    Attributes:
+        pad_offsets (numpy array): (rows, 2) pad positions relative to the
+        current node, before rotation.
+        neighbor_index (numpy array): index into nn of the node at the other
+        end of the edge.
+        neighbor_pad_offsets (numpy array): (rows, 2) pad positions relative to
+        the neighbor node, before rotation.
+        net_ids (numpy array): net id of the edge.
+        power (numpy array): True for power rail edges.
+        pad_ids (numpy array): pad id on the current node.
+        neighbor_pad_ids (numpy array): pad id on the neighbor node.
+        rotated_offsets (numpy array): (4, 2 x rows, 2) pad offsets rotated by
+        each quarter turn; the pads on the current node followed by the pads
+        on the neighbors.
+    """
+    def __init__(self, n, nn, eoi, rotations=None, state=None):
+        self.node = n
+        self.neighbors = list(nn)
+        self.state = state
+        if state is not None:
+            self.node_indices = np.array(
+                [state.index[v.get_id()] for v in [n] + self.neighbors],
+                dtype=np.int64)
+        current_node_id = n.get_id()
+        self.pin_count = n.get_pin_count()
+
+        neighbor_ids = [v.get_id() for v in self.neighbors]
+        pad_offsets = []
+        neighbor_index = []
+        neighbor_pad_offsets = []
+        net_ids = []
+        power = []
+        pad_ids = []
+        neighbor_pad_ids = []
+        for e in eoi:
+            for i in range(2):
+                if e.get_instance_id(i) != current_node_id:
+                    continue
+                if e.get_instance_id(1-i) not in neighbor_ids:
+                    continue
+                pad_pos = e.get_pos(i)
+                neighbor_pad_pos = e.get_pos(1-i)
+                pad_offsets.append([float(pad_pos[0]), float(pad_pos[1])])
+                neighbor_index.append(neighbor_ids.index(e.get_instance_id(1-i)))
+                neighbor_pad_offsets.append([float(neighbor_pad_pos[0]),
+                                             float(neighbor_pad_pos[1])])
+                net_ids.append(e.get_net_id())
+                power.append(e.get_power_rail() > 0)
+                pad_ids.append(e.get_pad_id(i))
+                neighbor_pad_ids.append(e.get_pad_id(1-i))
+
+        self.pad_offsets = np.array(pad_offsets, dtype=np.float64).reshape(-1, 2)
+        self.neighbor_index = np.array(neighbor_index, dtype=np.int64)
+        self.neighbor_pad_offsets = np.array(neighbor_pad_offsets,
+                                             dtype=np.float64).reshape(-1, 2)
+        self.net_ids = np.array(net_ids, dtype=np.int64)
+        self.power = np.array(power, dtype=bool)
+        self.pad_ids = np.array(pad_ids, dtype=np.int64)
+        self.neighbor_pad_ids = np.array(neighbor_pad_ids, dtype=np.int64)
+
+        if rotations is None:
+            rotations = pad_rotation_table(eoi)
+        other_ids = [neighbor_ids[j] for j in self.neighbor_index]
+        table_rows = [rotations.index[(current_node_id, pad_id)]
+                      for pad_id in pad_ids]
+        table_rows += [rotations.index[key]
+                       for key in zip(other_ids, neighbor_pad_ids)]
+        self.rotated_offsets = rotations.rotated[:, np.array(table_rows,
+                                                             dtype=np.int64)]
+
+        self._plans = {}
+        # ignore_power => merged plan of this topology alone, see
+        # compute_pad_referenced_distance_vectors_batch
+        self.batch_plans = {}
+
+    def get_plan(self, ignore_power=False):
+        """
+        Row orderings used by the kernels, built once per ignore_power value.
+
+        Both endpoints of a row are addressed through one stacked index:
+        row r is the pad on the current node and row r + rows the pad on the
+        neighbor.
+
+        Returns:
+            dict: for the wirelength, the stacked endpoints sorted by pad id
+            (pad_stack), the start of every pad (pad_starts) and its id
+            (pads); for the
+            distance vectors, the stacked endpoints in the order visited by
+            compute_pad_referenced_distance_vectors_v2 (vector_stack), the
+            (net, neighbor, pad) connection of every row (connections) and the
+            connections of every current pad (pad_connections).
+        """
+        if ignore_power in self._plans:
+            return self._plans[ignore_power]
+
+        rows = np.arange(len(self.pad_ids))
+        if ignore_power is True:
+            rows = rows[~self.power[rows]]
+
+        # per pad minima; pads are visited in increasing pad id
+        pad_rows = rows[self.pad_ids[rows] < self.pin_count]
+        pad_rows = pad_rows[np.argsort(self.pad_ids[pad_rows], kind="stable")]
+        pad_starts = _group_starts(self.pad_ids[pad_rows])
+
+        # distance vectors; nets are visited in order of first appearance
+        net_rank = {}
+        for net_id in self.net_ids[rows]:
+            net_rank.setdefault(net_id, len(net_rank))
+        ranks = np.array([net_rank[net_id] for net_id in self.net_ids[rows]],
+                         dtype=np.int64)
+        vector_rows = rows[np.argsort(ranks, kind="stable")]
+
+        # one connection per (net, neighbor, current pad), in order of first
+        # appearance; connections are reduced per current pad, again in order
+        # of first appearance
+        connection_index = {}
+        pad_connections = {}
+        connections = []
+        for row in vector_rows:
+            key = (self.net_ids[row],
+                   self.neighbor_index[row],
+                   self.pad_ids[row])
+            if key not in connection_index:
+                connection_index[key] = len(connection_index)
+                pad_connections.setdefault(self.pad_ids[row], []).append(
+                    connection_index[key])
+            connections.append(connection_index[key])
+
+        plan = {"pad_stack": self._stack(pad_rows),
+                "pad_starts": pad_starts,
+                "pads": self.pad_ids[pad_rows][pad_starts],
+                "single_pad_rows": len(pad_starts) == len(pad_rows),
+                "vector_stack": self._stack(vector_rows),
+                "connections": np.array(connections, dtype=np.int64),
+                "single_rows": len(connection_index) == len(connections),
+                "pad_connections": [np.array(c, dtype=np.int64)
+                                    for c in pad_connections.values()],
+                "single_connections": len(pad_connections) == len(connection_index)}
+        self._plans[ignore_power] = plan
+        return plan
+
+    def _stack(self, rows):
+        # stacked endpoint indices and their unrotated pad offsets
+        stack = np.concatenate((rows, rows + len(self.pad_ids)))
+        offsets = np.concatenate((self.pad_offsets, self.neighbor_pad_offsets))
+        nodes = np.concatenate((np.zeros(len(self.pad_ids), dtype=np.int64),
+                                self.neighbor_index + 1))
+        return {"nodes": nodes[stack],
+                "endpoints": np.arange(len(stack)),
+                "rotated": self.rotated_offsets[:, stack],
+                "x": offsets[stack, 0],
+                "y": offsets[stack, 1],
+                "minus_x": -offsets[stack, 0]}
+
+    def get_pad_positions(self, stack):
+        """
+        Absolute pad positions, using the current poses of the nodes.
+
+        Args:
+            stack (dict): stacked endpoints, as found in the plan.
+
+        Returns:
+            numpy array: (endpoints, 2) pad positions; the pads on the
+            current node come first, followed by the pads on the neighbors.
+        """
+        if self.state is not None:
+            positions = self.state.positions[self.node_indices]
+            orientations = self.state.orientations[self.node_indices]
+        else:
+            nodes = [self.node] + self.neighbors
+            positions = np.array([v.get_pos() for v in nodes], dtype=np.float64)
+            orientations = np.array([v.get_orientation() for v in nodes],
+                                    dtype=np.float64)
+
+        turns = [quarter_turn_index(a) for a in orientations]
+        if None not in turns:
+            turns = np.array(turns)[stack["nodes"]]
+            return positions[stack["nodes"]] + \
+                stack["rotated"][turns, stack["endpoints"]]
+
+        # general angles; same rotation as kicad_rotate
+        positions = positions[stack["nodes"]]
+        theta = np.pi * (orientations[stack["nodes"]] / 180.0)
+        c = np.cos(theta)
+        s = np.sin(theta)
+        positions[:, 0] += stack["x"] * c + stack["y"] * s
+        positions[:, 1] += stack["minus_x"] * s + stack["y"] * c
+        return positions
+
+def compute_per_pad_minimum_distances(topology, ignore_power=False):
+    """
+    For every pad of the current node, the shortest pad-pad distance to any
+    of its neighbors.
+
+    Args:
+        topology (pad_topology): compiled topology of the current node.
+        ignore_power (bool): skip power rail edges.
+
+    Returns:
+        tuple: (pad ids, shortest distances), sorted by pad id. Pads without
+        connections are omitted.
+    """
+    plan = topology.get_plan(ignore_power)
+    if len(plan["pad_starts"]) == 0:
+        return np.array([], dtype=np.int64), np.array([])
+
+    positions = topology.get_pad_positions(plan["pad_stack"])
+    p1, p2 = np.split(positions, 2)
+    lengths = np.sqrt(np.square(p1[:, 0]-p2[:, 0])+np.square(p1[:, 1]-p2[:, 1]))
+    if not plan["single_pad_rows"]:
+        lengths = np.minimum.reduceat(lengths, plan["pad_starts"])
+
+    return plan["pads"], lengths
+
+def compute_sum_of_euclidean_distances_between_pads_v2(topology,
+                                                       ignore_power=False):
+    """
+    Array based equivalent of compute_sum_of_euclidean_distances_between_pads.
+
+    Args:
+        topology (pad_topology): compiled topology of the current node.
+        ignore_power (bool): skip power rail edges.
+
+    Returns:
+        float: sum of the per pad shortest distances.
+    """
+    _, minima = compute_per_pad_minimum_distances(topology, ignore_power)
+    return np.sum(minima)
+
+def _split_stack(stack, rows):
+    # the source (current node) and target (neighbor) halves of a stack
+    halves = []
+    for part in (slice(0, rows), slice(rows, 2 * rows)):
+        halves.append({"nodes": stack["nodes"][part],
+                       "rotated": stack["rotated"][:, part],
+                       "x": stack["x"][part],
+                       "y": stack["y"][part],
+                       "minus_x": stack["minus_x"][part]})
+    return halves
+
+def _concatenate_stacks(stacks):
+    return {"nodes": np.concatenate([st["nodes"] for st in stacks]),
+            "endpoints": np.arange(sum(len(st["nodes"]) for st in stacks)),
+            "rotated": np.concatenate([st["rotated"] for st in stacks], axis=1),
+            "x": np.concatenate([st["x"] for st in stacks]),
+            "y": np.concatenate([st["y"] for st in stacks]),
+            "minus_x": np.concatenate([st["minus_x"] for st in stacks])}
+
+def _batch_plan(topologies, ignore_power):
+    """
+    The distance vector plans of several topologies merged into one.
+
+    Connections are renumbered to be unique across the topologies; when all
+    topologies share a graph_state, the endpoints address its node arrays
+    directly. agents holds, per topology, None (no connections) or the
+    (first, last) pad vector, (first, last) connection and per pad
+    connection lists (None when every connection is its own pad).
+    """
+    state = topologies[0].state
+    shared = state is not None and all(t.state is state for t in topologies)
+    sources = []
+    targets = []
+    connections = []
+    counts = []
+    agents = []
+    n_connections = 0
+    n_pads = 0
+    for t in topologies:
+        plan = t.get_plan(ignore_power)
+        rows = len(plan["connections"])
+        stack = dict(plan["vector_stack"])
+        if shared:
+            stack["nodes"] = t.node_indices[stack["nodes"]]
+        source, target = _split_stack(stack, rows)
+        sources.append(source)
+        targets.append(target)
+        if rows == 0:
+            agents.append(None)
+            continue
+
+        connections.append(plan["connections"] + n_connections)
+        # the vectors of a topology are scaled by its number of connections
+        k = int(np.max(plan["connections"])) + 1
+        counts.append(np.full(rows, k, dtype=np.float64))
+        if plan["single_connections"]:
+            pad_connections = None
+            pads = k
+        else:
+            pad_connections = [c + n_connections
+                               for c in plan["pad_connections"]]
+            pads = len(pad_connections)
+        agents.append(((n_pads, n_pads + pads),
+                       (n_connections, n_connections + k),
+                       pad_connections))
+        n_connections += k
+        n_pads += pads
+
+    return {"shared": shared,
+            "source": _concatenate_stacks(sources),
+            "target": _concatenate_stacks(targets),
+            "connections": np.concatenate(connections + [np.zeros(0, np.int64)]),
+            "counts": np.concatenate(counts + [np.zeros(0)]),
+            "single_rows": all(t.get_plan(ignore_power)["single_rows"]
+                               for t in topologies),
+            "agents": agents}
+
+def _batch_pad_positions(topologies, plan, ignore_power):
+    # (source, target) pad positions of all rows of a merged plan
+    if not plan["shared"]:
+        positions = [t.get_pad_positions(t.get_plan(ignore_power)["vector_stack"])
+                     for t in topologies]
+        return (np.concatenate([p[:len(p)//2] for p in positions]),
+                np.concatenate([p[len(p)//2:] for p in positions]))
+
+    state = topologies[0].state
+    turns = [quarter_turn_index(a) for a in state.orientations.tolist()]
+    if None in turns:
+        turns = None
+    else:
+        turns = np.array(turns)
+    positions = []
+    for stack in (plan["source"], plan["target"]):
+        nodes = stack["nodes"]
+        if turns is not None:
+            positions.append(state.positions[nodes] +
+                             stack["rotated"][turns[nodes], stack["endpoints"]])
+            continue
+        # general angles; same rotation as kicad_rotate
+        p = state.positions[nodes]
+        theta = np.pi * (state.orientations[nodes] / 180.0)
+        c = np.cos(theta)
+        s = np.sin(theta)
+        p[:, 0] += stack["x"] * c + stack["y"] * s
+        p[:, 1] += stack["minus_x"] * s + stack["y"] * c
+        positions.append(p)
+    return positions
+
+def compute_pad_referenced_distance_vectors_batch(topologies,
+                                                  ignore_power=False,
+                                                  plans=None):
+    """
+    Dominant vectors of several agents of one board in a single pass.
+
+    The plans of the topologies are merged once, so the vector math runs once
+    over the connections of all agents instead of once per agent. The merged
+    plan of a single topology is kept by the topology, that of several
+    topologies in plans when given; plans holds references to the
+    topologies, so its owner (the environment) replaces it together with
+    them. Only the per pad and per agent reductions loop, with np.sum, so
+    results are identical to compute_pad_referenced_distance_vectors_v2,
+    including the order of all floating point reductions.
+
+    Args:
+        topologies (list): pad_topology of every agent.
+        ignore_power (bool): skip power rail edges.
+        plans (dict): (tuple of topologies, ignore_power) => merged plan.
+
+    Returns:
+        list: dom, the (r, theta) resultant of all pad referenced vectors,
+        of every topology.
+    """
+    topologies = tuple(topologies)
+    if len(topologies) == 1:
+        plans, key = topologies[0].batch_plans, ignore_power
+    else:
+        key = (topologies, ignore_power)
+    if plans is None:
+        plan = _batch_plan(topologies, ignore_power)
+    elif key in plans:
+        plan = plans[key]
+    else:
+        plan = plans[key] = _batch_plan(topologies, ignore_power)
+    connections = plan["connections"]
+
+    if len(connections) != 0:
+        s, d = _batch_pad_positions(topologies, plan, ignore_power)
+        delta_x = d[:, 0] - s[:, 0]
+        delta_y = s[:, 1] - d[:, 1]
+
+        # as calculate_resultant_vector
+        euclidean_dist = np.sqrt(np.square(delta_x) + np.square(delta_y))
+        ratio = np.divide(delta_y, delta_x, out=np.zeros(len(delta_x)),
+                          where=delta_x != 0.0)
+        vertical = (delta_x == 0.0) & (delta_y != 0.0)
+        if np.any(vertical):
+            with np.errstate(divide="ignore"):
+                ratio[vertical] = delta_y[vertical] / delta_x[vertical]
+        angle = np.arctan(ratio)
+        angle[delta_x < 0] += np.pi
+
+        # the shortest (first if tied) vector of every connection
+        counts = plan["counts"]
+        if not plan["single_rows"]:
+            order = np.lexsort((np.arange(len(connections)),
+                                euclidean_dist,
+                                connections))
+            shortest = order[_group_starts(connections[order])]
+            euclidean_dist = euclidean_dist[shortest]
+            angle = angle[shortest]
+            counts = counts[shortest]
+
+        v_pts = polar_to_rectangular(euclidean_dist/counts, angle)
+        pad_pts = []
+        for agent in plan["agents"]:
+            if agent is None:
+                continue
+            if agent[2] is None:
+                pad_pts.append(v_pts[agent[1][0]:agent[1][1]])
+            else:
+                # np.sum per pad (rather than np.add.reduceat) keeps the
+                # summation order of the loop based version.
+                pad_pts.append(np.array([np.sum(v_pts[c]) for c in agent[2]]))
+        r, theta = rectangular_to_polar(np.concatenate(pad_pts))
+        pad_pts = polar_to_rectangular(r, theta)
+
+    sums = np.array([np.sum([]) if agent is None else
+                     np.sum(pad_pts[agent[0][0]:agent[0][1]])
+                     for agent in plan["agents"]])
+    r, theta = rectangular_to_polar(sums)
+    return [(r[k], theta[k]) for k in range(len(topologies))]
+
+def compute_pad_referenced_distance_vectors_v3(topology, ignore_power=False):
+    """
+    Array based equivalent of the dominant vector returned by
+    compute_pad_referenced_distance_vectors_v2, for a single agent; see
+    compute_pad_referenced_distance_vectors_batch.
+
+    Args:
+        topology (pad_topology): compiled topology of the current node.
+        ignore_power (bool): skip power rail edges.
+
+    Returns:
+        tuple: dom, the (r, theta) resultant of all pad referenced vectors.
+    """
+    return compute_pad_referenced_distance_vectors_batch([topology],
+                                                         ignore_power)[0]
+
 def distance_between_two_points(p1,p2):
     if p1[0] == p2[0] and p1[1] == p2[1]:
         return 0
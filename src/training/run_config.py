@@ -80,6 +80,38 @@ def cmdline_args():
     parser.add_argument(
         "--pcb_idx", required=False, default=-1, type=int,
         help="When supplied the particular pcb is used for training")
+    parser.add_argument("--los_backend", required=False, default="raster",
+                        choices=["raster", "analytic"],
+                        help="computation of the line-of-sight and overlap\
+                              observations")
+    parser.add_argument("--step_mode", required=False, default="sequential",
+                        choices=["sequential", "simultaneous"],
+                        help="sequential: every agent observes the moves of\
+                              the agents before it; simultaneous: all agents\
+                              act on the board at the start of the step,\
+                              with one batched policy evaluation")
+    parser.add_argument("--num_envs", required=False, type=int, default=1,
+                        help="number of training environments stepped in\
+                              lockstep; every timestep collects one step of\
+                              each")
+    parser.add_argument("--env_workers", required=False, type=int, default=0,
+                        help="number of worker processes stepping the\
+                              --num_envs training environments; 0 steps them\
+                              in the training process")
+    parser.add_argument("--async_collectors", required=False, type=int,
+                        default=0,
+                        help="number of collector processes stepping\
+                              environments while the learner trains\
+                              asynchronously; 0 alternates steps and updates")
+    parser.add_argument("--weight_sync_interval", required=False, type=int,
+                        default=100,
+                        help="gradient updates between publishing the policy\
+                              weights to the collectors")
+    parser.add_argument("--max_update_to_data_ratio", required=False,
+                        type=float, default=None,
+                        help="when supplied, the asynchronous learner waits\
+                              for data rather than exceed this ratio of\
+                              gradient updates to environment steps")
     parser.add_argument("--redirect_stdout", required=False,
                         action="store_true", default=False,
                         help="redirect standard output to file")
@@ -137,6 +169,13 @@ def cmdline_args():
     settings["shuffle_training_idxs"] = args.shuffle_training_idxs
     settings["shuffle_evaluation_idxs"] = args.shuffle_evaluation_idxs
     settings["pcb_idx"] = args.pcb_idx
+    settings["los_backend"] = args.los_backend
+    settings["step_mode"] = args.step_mode
+    settings["num_envs"] = args.num_envs
+    settings["env_workers"] = args.env_workers
+    settings["async_collectors"] = args.async_collectors
+    settings["weight_sync_interval"] = args.weight_sync_interval
+    settings["max_update_to_data_ratio"] = args.max_update_to_data_ratio
     settings["redirect_stdout"] = args.redirect_stdout
     settings["redirect_stderr"] = args.redirect_stderr
 
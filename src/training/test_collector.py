@@ -0,0 +1,37 @@
+"""Unit tests for the collector module"""
+import torch
+
+from collector import collector_pool
+from core.environment.environment import environment
+from test_vector_environment import make_parameters
+from TD3 import Actor
+
+def test_collectors_deliver_transitions_and_pick_up_weights():
+    """Collected steps reach the learner and collectors act with the weights \
+        published last."""
+    params = make_parameters(max_steps=2)
+    env = environment(params)
+    actor = Actor(env.agents[0].get_observation_space_shape(), 3, 1,
+                  device="cpu")
+    collectors = collector_pool(params, actor, "TD3", num_collectors=2,
+                                num_envs=2, start_timesteps=0)
+    try:
+        items = collectors.get(block=True)
+        item = items[0]
+        assert item["state"].shape[0] == item["action"].shape[0]
+        assert set(item["env"]) <= {0, 1, 2, 3}
+
+        with torch.no_grad():
+            for param in actor.parameters():
+                param.add_(1.0)
+        collectors.publish(actor)
+        for param, shared in zip(actor.parameters(),
+                                 collectors.shared_policy.parameters()):
+            assert torch.equal(param, shared)
+
+        seen = set()
+        while 1 not in seen:
+            seen.update(item["policy_version"]
+                        for item in collectors.get(block=True))
+    finally:
+        collectors.close()
@@ -0,0 +1,69 @@
+"""Unit tests for the ensemble_critic module"""
+import pytest
+import torch
+
+from ensemble_critic import EnsembleCritic, convert_critic_state_dict, \
+    convert_critic_optimizer_state_dict, critic_layout
+from SAC import QNetwork
+from TD3 import Critic
+
+def test_converted_twin_critic_gives_the_same_q_values():
+    """A twin critic and the ensemble loaded from its converted state dict \
+        compute the same Q-values, and converting back restores it."""
+    torch.manual_seed(0)
+    state, action = torch.rand(16, 23), torch.rand(16, 3)
+    for twin in (Critic(23, 3, [64, 32]), QNetwork(23, 3, [64, 32])):
+        ensemble = EnsembleCritic(23, 3, [64, 32])
+        assert critic_layout(twin.state_dict()) == "twin"
+        ensemble.load_state_dict(convert_critic_state_dict(twin.state_dict(),
+                                                           "ensemble"))
+        for q, expected in zip(ensemble(state, action), twin(state, action)):
+            torch.testing.assert_close(q, expected)
+        torch.testing.assert_close(ensemble.Q1(state, action),
+                                   twin(state, action)[0])
+
+        restored = convert_critic_state_dict(ensemble.state_dict(), "twin")
+        assert list(restored.keys()) == list(twin.state_dict().keys())
+        for key, value in twin.state_dict().items():
+            assert torch.equal(restored[key], value)
+
+    with pytest.raises(ValueError):
+        convert_critic_state_dict(EnsembleCritic(23, 3, [8], num_heads=4)
+                                  .state_dict(), "twin")
+
+def test_converted_optimizer_state_continues_training():
+    """Adam moments follow the parameters through the conversion, so one \
+        more step of both critics gives the same parameters."""
+    torch.manual_seed(0)
+    state, action, target = torch.rand(8, 23), torch.rand(8, 3), torch.rand(8, 1)
+    twin = Critic(23, 3, [16])
+    optimizer = torch.optim.Adam(twin.parameters(), lr=1e-2)
+
+    def step(critic, optimizer):
+        loss = sum(torch.nn.functional.mse_loss(q, target)
+                   for q in critic(state, action))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    step(twin, optimizer)
+    ensemble = EnsembleCritic(23, 3, [16])
+    ensemble.load_state_dict(convert_critic_state_dict(twin.state_dict(),
+                                                       "ensemble"))
+    ensemble_optimizer = torch.optim.Adam(ensemble.parameters(), lr=1e-2)
+    ensemble_optimizer.load_state_dict(convert_critic_optimizer_state_dict(
+        optimizer.state_dict(), twin.state_dict(), "ensemble"))
+
+    step(twin, optimizer)
+    step(ensemble, ensemble_optimizer)
+    for key, value in convert_critic_state_dict(ensemble.state_dict(),
+                                                "twin").items():
+        torch.testing.assert_close(value, twin.state_dict()[key])
+
+def test_ensemble_critic_needs_two_heads():
+    """A single head ensemble is rejected when it is built, not by the \
+        first update."""
+    with pytest.raises(ValueError):
+        EnsembleCritic(23, 3, [64, 32], num_heads=1)
+    assert len(EnsembleCritic(23, 3, [64, 32], num_heads=3)(
+        torch.rand(4, 23), torch.rand(4, 3))) == 3
@@ -0,0 +1,34 @@
+"""Unit tests for the environment_pool module"""
+import numpy as np
+import torch
+
+from core.environment.vector_environment import vector_environment
+from core.environment.environment_pool import environment_pool
+from test_vector_environment import make_parameters
+from TD3 import Actor
+
+def test_pool_matches_vector_environment():
+    """Workers reading and writing shared memory give the transitions and \
+        episodes of a vector environment with the same seeds."""
+    envs = vector_environment(make_parameters(max_steps=2), num_envs=3)
+    envs.reset()
+    pool = environment_pool(make_parameters(max_steps=2), num_envs=3,
+                            num_workers=2)
+    try:
+        pool.reset()
+        torch.manual_seed(0)
+        actor = Actor(envs.agents[0].get_observation_space_shape(), 3, 1,
+                      device="cpu")
+        for t in range(4):
+            expected = envs.step(actor, random=t < 2, deterministic=True)
+            steps = pool.step(actor, random=t < 2, deterministic=True)
+            for key in ("state", "next_state", "action", "reward", "done",
+                        "env"):
+                np.testing.assert_array_equal(steps[key], expected[key])
+            assert steps["episodes"] == [
+                {**episode, "episode_fps": steps["episodes"][i]["episode_fps"]}
+                for i, episode in enumerate(expected["episodes"])]
+            assert pool.calc_hpwl() == envs.calc_hpwl()
+            assert list(pool.tracker.metrics) == list(envs.tracker.metrics)
+    finally:
+        pool.close()
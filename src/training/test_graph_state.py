@@ -0,0 +1,39 @@
+"""Unit tests for the graph_state module"""
+import numpy as np
+
+from core.environment.graph_state import graph_state
+from core.environment.hpwl import hpwl_tracker
+from core.environment.occupancy import occupancy_cache
+from test_occupancy import load_graph_and_board
+
+def test_graph_state_mirrors_graph():
+    """Moves through the mirror reach the graph, direct graph moves are \
+        picked up by pull(), and consumers reading the mirror agree with \
+        consumers polling the graph."""
+    rng = np.random.default_rng(0)
+    _pv, g, b = load_graph_and_board()
+    state = graph_state(g)
+    nn = g.get_nodes()
+    assert np.array_equal(state.node_ids[state.edge_nodes],
+                          state.edge_instance_ids)
+
+    mirrored = occupancy_cache(g, b.get_width(), b.get_height(), state=state)
+    polled = occupancy_cache(g, b.get_width(), b.get_height())
+    hpwl = hpwl_tracker(g, state=state)
+    for trial in range(10):
+        for i in range(len(nn)):
+            if rng.uniform() < 0.5:
+                state.set_pose(i, tuple(rng.uniform(0, 20, 2)),
+                               float(rng.integers(4) * 90))
+        if trial % 3 == 0:
+            nn[0].set_pos(tuple(rng.uniform(0, 20, 2)))
+            assert state.pull() == 1
+
+        for i in range(len(nn)):
+            assert tuple(state.positions[i]) == nn[i].get_pos()
+            assert state.orientations[i] == nn[i].get_orientation()
+
+        mirrored.sync()
+        polled.sync()
+        assert np.array_equal(mirrored.coverage, polled.coverage)
+        assert hpwl.calc_hpwl() == g.calc_hpwl(True)
@@ -0,0 +1,39 @@
+"""Unit tests for the graph_utils module"""
+import numpy as np
+
+from graph_utils import kicad_rotate, pad_rotation_table, quarter_turn_index
+from pcbDraw import draw_ratsnest
+from test_occupancy import load_graph_and_board
+
+def test_pad_rotation_table_matches_kicad_rotate():
+    """Table lookups, including the fallback for other angles, are identical \
+        to computing the rotation, and so is the ratsnest drawn with them."""
+    _pv, g, b = load_graph_and_board()
+    edges = g.get_edges()
+    rotations = pad_rotation_table(edges)
+    for angle in (0.0, 90.0, 180.0, 270.0, 45.0, 360.0):
+        assert (quarter_turn_index(angle) is None) == (angle in (45.0, 360.0))
+        for e in edges:
+            for i in range(2):
+                pad_pos = e.get_pos(i)
+                x, y = float(pad_pos[0]), float(pad_pos[1])
+                expected = np.cos(np.pi * (angle / 180.0)), \
+                    np.sin(np.pi * (angle / 180.0))
+                assert kicad_rotate(x, y, angle) == \
+                    [x * expected[0] + y * expected[1],
+                     - x * expected[1] + y * expected[0]]
+                assert rotations.rotate(e.get_instance_id(i), e.get_pad_id(i),
+                                        x, y, angle) == kicad_rotate(x, y, angle)
+
+    rng = np.random.default_rng(0)
+    nn = g.get_nodes()
+    for i in range(len(nn)):
+        nn[i].set_orientation(float(rng.integers(4) * 90))
+    for n in nn:
+        neighbors = [g.get_node_by_id(node_id)
+                     for node_id in g.get_neighbor_node_ids(n.get_id())]
+        np.testing.assert_array_equal(
+            draw_ratsnest(n, neighbors, edges, b.get_width(), b.get_height(),
+                          padding=4),
+            draw_ratsnest(n, neighbors, edges, b.get_width(), b.get_height(),
+                          padding=4, rotations=rotations))
@@ -0,0 +1,31 @@
+"""Unit tests for the hpwl module"""
+import numpy as np
+
+from core.environment.hpwl import hpwl_tracker
+from test_occupancy import load_graph_and_board
+
+def test_hpwl_tracker_matches_graph():
+    """Per net and board hpwl are identical to the graph library while \
+        random subsets of nodes move, including off the board and at \
+        arbitrary angles, and only the nets of moved nodes are updated."""
+    rng = np.random.default_rng(0)
+    for idx in range(2):
+        _pv, g, _b = load_graph_and_board(idx)
+        hpwl = hpwl_tracker(g)
+        nn = g.get_nodes()
+        for trial in range(40):
+            moved = set()
+            for i in range(len(nn)):
+                if trial == 0 or rng.uniform() < 0.3:
+                    nn[i].set_pos(tuple(rng.uniform(-5, 25, 2)))
+                    if rng.uniform() < 0.8:
+                        nn[i].set_orientation(float(rng.integers(4) * 90))
+                    else:
+                        nn[i].set_orientation(float(rng.uniform(0, 360)))
+                    moved.update(net_id for net_id, _ in hpwl.node_pins[i])
+
+            assert hpwl.sync() == len(moved)
+            for net_id in hpwl.net_ids:
+                assert hpwl.get_hpwl_of_net(net_id) == \
+                    g.calc_hpwl_of_net(net_id, True)
+            assert hpwl.calc_hpwl() == g.calc_hpwl(True)
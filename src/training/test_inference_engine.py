@@ -0,0 +1,43 @@
+"""Unit tests for the inference_engine module"""
+import numpy as np
+import pytest
+import torch
+
+from inference_engine import InferenceEngine
+from SAC import GaussianPolicy
+from TD3 import Actor
+
+def test_engine_matches_the_policies():
+    """Every backend selects the actions of Actor.select_actions, and the \
+        eager backend reproduces GaussianPolicy samples for the same seed."""
+    torch.manual_seed(0)
+    states = np.random.default_rng(0).uniform(size=(100, 23))
+    actor = Actor(23, 3, 1, [32, 16], device="cpu")
+    expected = actor.select_actions(states)
+    for backend in ("eager", "script"):
+        engine = InferenceEngine(actor, backend=backend, max_batch=4)
+        np.testing.assert_allclose(engine.select_actions(states), expected,
+                                   rtol=1e-6)
+        np.testing.assert_allclose(engine.select_action(states[3]),
+                                   actor.select_action(states[3]), rtol=1e-6)
+
+    # optimizer steps are picked up without rebuilding the engine
+    with torch.no_grad():
+        actor.pi[0].weight.add_(0.1)
+    np.testing.assert_allclose(engine.select_actions(states),
+                               actor.select_actions(states), rtol=1e-6)
+
+    policy = GaussianPolicy(23, 3, [32, 16], device="cpu")
+    engine = InferenceEngine(policy)
+    for evaluate in (False, True):
+        torch.manual_seed(1)
+        expected = policy.select_actions(states, evaluate=evaluate)
+        torch.manual_seed(1)
+        np.testing.assert_array_equal(
+            engine.select_actions(states, evaluate=evaluate), expected)
+    np.testing.assert_allclose(
+        InferenceEngine(policy, backend="script").select_actions(
+            states, evaluate=True), expected, rtol=1e-6)
+
+    with pytest.raises(ValueError):
+        InferenceEngine(actor, backend="onnx")
@@ -0,0 +1,94 @@
+"""Unit tests for the observation module"""
+import os
+import numpy as np
+
+from core.environment.environment import environment
+from core.environment.parameters import parameters
+from core.agent.observation import get_agent_observation, get_agent_observations
+
+pcb_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "../../dataset/base/training.pcb")
+
+def make_environment(los_backend="raster", seed=0):
+    return environment(parameters({"pcb_file": pcb_file,
+                                   "training_pcb": pcb_file,
+                                   "evaluation_pcb": pcb_file,
+                                   "net": "",
+                                   "use_dataAugmenter": True,
+                                   "augment_position": True,
+                                   "augment_orientation": True,
+                                   "agent_max_action": 1,
+                                   "agent_expl_noise": 0.1,
+                                   "debug": False,
+                                   "max_steps": 200,
+                                   "w": 2.0,
+                                   "o": 2.0,
+                                   "hpwl": 2.0,
+                                   "seed": seed,
+                                   "ignore_power": True,
+                                   "log_dir": None,
+                                   "idx": 0,
+                                   "shuffle_idxs": False,
+                                   "los_backend": los_backend}))
+
+def assert_observations_equal(a, b):
+    assert a.keys() == b.keys()
+    for key in a:
+        if key == "info":
+            np.testing.assert_array_equal(a[key]["ol_ratios"],
+                                          b[key]["ol_ratios"])
+        else:
+            np.testing.assert_array_equal(a[key], b[key])
+
+def test_batched_observations_match_single_agent_observations():
+    """All three board representations give the same observations when the \
+        agents are batched as when they are observed one at a time."""
+    for los_backend, use_occupancy in (("raster", True),
+                                       ("raster", False),
+                                       ("analytic", True)):
+        env = make_environment(los_backend)
+        env.reset()
+        params = [a.parameters for a in env.agents]
+        if not use_occupancy:
+            for p in params:
+                p.occupancy = None
+
+        batched = get_agent_observations(params)
+        assert len(batched) == len(params)
+        for p, observation in zip(params, batched):
+            p.observation_memo = None
+            assert_observations_equal(observation, get_agent_observation(p))
+
+def test_observation_memo_is_invalidated_by_moves():
+    """An observation is reused while the board is unchanged and recomputed \
+        once any node moves."""
+    env = make_environment()
+    env.reset()
+    params = env.agents[0].parameters
+    first = get_agent_observation(params)
+    assert get_agent_observation(params) is first
+
+    other = env.agents[1].parameters.node
+    pos = other.get_pos()
+    other.set_pos((pos[0] + 0.5, pos[1]))
+    second = get_agent_observation(params)
+    assert second is not first
+
+    params.observation_memo = None
+    assert_observations_equal(second, get_agent_observation(params))
+
+def test_analytic_observations_are_memoised_without_rasterising():
+    """The analytic backend memoises against the graph_state version and \
+        never redraws footprints."""
+    env = make_environment("analytic")
+    env.reset()
+    params = env.agents[0].parameters
+    redraws = env.occupancy.redraws
+    first = get_agent_observation(params)
+    assert get_agent_observation(params) is first
+
+    other = env.state.index[env.agents[1].parameters.node.get_id()]
+    pos = env.state.positions[other]
+    env.state.set_pos(other, (pos[0] + 0.5, pos[1]))
+    assert get_agent_observation(params) is not first
+    assert env.occupancy.redraws == redraws
@@ -0,0 +1,67 @@
+"""Unit tests for the observation_codec module"""
+import numpy as np
+import pytest
+
+from observation_codec import observation_codec
+from utils import ReplayMemory
+
+def make_states(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.concatenate([rng.uniform(0, 1, (n, 16)),        # los, ol
+                           rng.uniform(0, 25, (n, 1)),        # dom
+                           rng.uniform(-np.pi, np.pi, (n, 1)),
+                           rng.uniform(0, 12, (n, 1)),        # euc_dist
+                           rng.uniform(-np.pi, 2 * np.pi, (n, 1)),
+                           rng.uniform(-0.1, 1.1, (n, 2)),    # position
+                           rng.uniform(0, np.pi, (n, 1))], axis=1)
+
+def test_compact_codec_round_trip_and_report():
+    """The compact scheme quantises the bounded fields within half a step, \
+        keeps dom and euc_dist at float32 and reports its errors."""
+    codec = observation_codec("compact")
+    assert codec.nbytes == 38
+    states = make_states(1000)
+    rows = codec.encode(states)
+    assert rows.shape == (1000, 38) and rows.dtype == np.uint8
+    decoded = codec.decode(rows)
+    assert decoded.dtype == np.float32
+    np.testing.assert_allclose(decoded[:, :16], states[:, :16],
+                               atol=0.5 / 255 + 1e-6)
+    np.testing.assert_array_equal(decoded[:, 16:20],
+                                  states[:, 16:20].astype(np.float32))
+    np.testing.assert_allclose(decoded[:, 20:], states[:, 20:], rtol=1e-3)
+    np.testing.assert_array_equal(codec.decode(codec.encode(states[0])),
+                                  decoded[0])
+
+    report = codec.accuracy_report(states)
+    assert report["los"]["max_abs_error"] <= 0.5 / 255 + 1e-6
+    assert report["dom"]["max_abs_error"] < 1e-5
+    assert report["compression"] == pytest.approx(92 / 38)
+
+    codec = observation_codec({"position": {"dtype": "uint8",
+                                            "low": 0.0, "high": 1.0}})
+    assert codec.nbytes == 21 * 4 + 2
+    assert codec.accuracy_report(states)["position"]["clipped"] > 0
+    with pytest.raises(ValueError):
+        observation_codec({"dom": "uint8"})
+
+def test_replay_memory_with_codec():
+    """A memory with a codec stores encoded states and samples and reads \
+        the decoded ones."""
+    codec = observation_codec("compact")
+    states = make_states(6)
+    memory = ReplayMemory(4, device="cpu", codec=codec)
+    memory.add(states[0], [0, 0, 0], states[1], 0.0, 1.0)
+    memory.add_batch(states[1:5], np.zeros((4, 3)), states[2:6],
+                     np.arange(1, 5), np.ones(4))
+    assert memory.memory.state.dtype == np.uint8
+    assert memory.memory.state.shape == (4, 38)
+
+    expected = codec.decode(codec.encode(states))
+    latest = memory.get_latest(4)
+    np.testing.assert_array_equal(latest.state, expected[1:5])
+    np.testing.assert_array_equal(latest.next_state, expected[2:6])
+    state, _, next_state, reward, _ = memory.sample(4)
+    rows = reward[:, 0].numpy().astype(int)
+    np.testing.assert_array_equal(state.numpy(), expected[rows])
+    np.testing.assert_array_equal(next_state.numpy(), expected[rows + 1])
@@ -0,0 +1,93 @@
+"""Unit tests for the occupancy module"""
+import os
+import numpy as np
+from pcb import pcb
+
+from pcbDraw import draw_board_from_graph_multi_agent, get_los_and_ol_multi_agent
+from core.environment.occupancy import occupancy_cache
+
+pcb_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "../../dataset/base/training.pcb")
+
+def load_graph_and_board(idx=0):
+    pv = pcb.vptr_pcbs()
+    pcb.read_pcb_file(pcb_file, pv)
+    p = pv[idx]
+    g = p.get_graph()
+    g.reset()
+    b = p.get_board()
+    g.set_component_origin_to_zero(b)
+    # keep the pcb vector alive for as long as the graph is used.
+    return pv, g, b
+
+def assert_layers_match_full_redraw(occupancy, g, b, node_id):
+    expected = draw_board_from_graph_multi_agent(g=g,
+                                                 node_id=node_id,
+                                                 bx=b.get_width(),
+                                                 by=b.get_height(),
+                                                 padding=4)
+    layers = occupancy.get_layers(node_id)
+    assert len(layers) == len(expected)
+    for layer, expected_layer in zip(layers, expected):
+        assert np.array_equal(layer, expected_layer)
+
+def test_get_layers_matches_full_redraw():
+    """Layers served from the cache, before and after a node moves, are \
+        identical to those drawn from scratch."""
+    _pv, g, b = load_graph_and_board()
+    occupancy = occupancy_cache(g, b.get_width(), b.get_height(), padding=4)
+    nn = g.get_nodes()
+    for n in nn:
+        assert_layers_match_full_redraw(occupancy, g, b, n.get_id())
+    assert occupancy.redraws == len(nn)
+
+    n = nn[len(nn)-1]
+    n.set_pos((n.get_pos()[0] + 1.3, n.get_pos()[1] - 0.7))
+    n.set_orientation(90.0)
+    assert_layers_match_full_redraw(occupancy, g, b, nn[0].get_id())
+    # only the layer of the moved node is redrawn
+    assert occupancy.redraws == len(nn) + 1
+
+def test_coverage_map_matches_layer_stack():
+    """Coverage counts, footprints, line-of-sight/overlap features and legality \
+        read from the compact maps equal those computed from the full layer \
+        stack."""
+    rng = np.random.default_rng(0)
+    _pv, g, b = load_graph_and_board()
+    occupancy = occupancy_cache(g, b.get_width(), b.get_height(), padding=4)
+    nn = g.get_nodes()
+    for trial in range(6):
+        for i in range(len(nn)):
+            if trial == 0 or rng.uniform() < 0.5:
+                nn[i].set_pos(tuple(rng.uniform(-1, b.get_width() + 1, 2)))
+                nn[i].set_orientation(float(rng.integers(4) * 90))
+
+        stack = draw_board_from_graph_multi_agent(g, nn[0].get_id(),
+                                                  b.get_width(),
+                                                  b.get_height(),
+                                                  padding=4)
+        covered = np.array(stack) != 0
+        occupancy.sync()
+        assert np.array_equal(occupancy.coverage, np.sum(covered, axis=0))
+        assert occupancy.is_legal() == (np.max(np.sum(stack, axis=0)) <= 64)
+        for i in range(len(nn)):
+            assert np.array_equal(occupancy.get_layer(i), stack[i + 1])
+
+        for n in nn:
+            radius = np.max(n.get_size()) * 1.5
+            stack = draw_board_from_graph_multi_agent(g, n.get_id(),
+                                                      b.get_width(),
+                                                      b.get_height(),
+                                                      padding=4)
+            expected = get_los_and_ol_multi_agent(n, b, radius, stack, 4)
+            result = occupancy.get_los_and_ol(n.get_id(), radius)
+            np.testing.assert_array_equal(result[0], expected[0])
+            np.testing.assert_array_equal(result[1], expected[1])
+            np.testing.assert_array_equal(np.sum(result[3], axis=(1, 2)),
+                                          np.sum(expected[3], axis=(1, 2)))
+            los, ol, overlap_pixels = occupancy.get_los_and_ol_pixels(
+                n.get_id(), radius)
+            np.testing.assert_array_equal(los, expected[0])
+            np.testing.assert_array_equal(ol, expected[1])
+            np.testing.assert_array_equal(overlap_pixels * 64,
+                                          np.sum(expected[3], axis=(1, 2)))
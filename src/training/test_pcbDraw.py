@@ -0,0 +1,60 @@
+"""Unit tests for the pcbDraw module"""
+import numpy as np
+import cv2
+
+from pcbDraw import draw_board_from_graph_multi_agent, get_los_and_ol_multi_agent
+from pcbDraw import get_los_wedge_window
+from test_occupancy import load_graph_and_board
+
+def test_los_and_ol_roi_matches_full_grid():
+    """Cropping to the line-of-sight window gives the same features and mask \
+        pixel counts as working on the whole grid, with and without padding."""
+    rng = np.random.default_rng(0)
+    _pv, g, b = load_graph_and_board()
+    nn = g.get_nodes()
+    for padding in (4, None):
+        for _ in range(5):
+            for i in range(len(nn)):
+                nn[i].set_pos(tuple(rng.uniform(-3, b.get_width() + 3, 2)))
+                nn[i].set_orientation(float(rng.integers(4) * 90))
+
+            for n in nn:
+                radius = np.max(n.get_size()) * 1.5
+                grids = draw_board_from_graph_multi_agent(g,
+                                                          n.get_id(),
+                                                          b.get_width(),
+                                                          b.get_height(),
+                                                          padding=padding)
+                full = get_los_and_ol_multi_agent(n, b, radius, grids, padding)
+                cropped = get_los_and_ol_multi_agent(n, b, radius, grids,
+                                                     padding, roi=True)
+
+                np.testing.assert_array_equal(full[0], cropped[0])
+                np.testing.assert_array_equal(full[1], cropped[1])
+                for i in (2, 3):
+                    np.testing.assert_array_equal(
+                        np.sum(full[i], axis=(1, 2)),
+                        np.sum(cropped[i], axis=(1, 2)))
+
+def test_los_wedge_window_matches_direct_drawing():
+    """Translated and clipped templates are identical to wedges drawn \
+        directly onto the grid, including near and beyond the grid edges."""
+    shape = (60, 80)
+    for radius in (3, 12):
+        for orientation in (0.0, 90.0, 180.0, 270.0):
+            for cx, cy in ((40, 30), (2, 5), (78, 58), (-10, 30), (40, 75)):
+                masks, pixels, window = get_los_wedge_window(radius,
+                                                             orientation,
+                                                             cx,
+                                                             cy,
+                                                             shape)
+                placed = np.zeros((8,) + shape, np.uint8)
+                placed[:, window[0]:window[1], window[2]:window[3]] = masks
+
+                start = -22.5 - orientation
+                for i in range(8):
+                    expected = np.zeros(shape, np.uint8)
+                    cv2.ellipse(expected, (cx, cy), (radius, radius), 0,
+                                start - 45*i, start - 45*i + 45, (64), -1)
+                    np.testing.assert_array_equal(placed[i], expected)
+                    assert pixels[i] == np.count_nonzero(expected)
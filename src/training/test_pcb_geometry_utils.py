@@ -0,0 +1,66 @@
+"""Unit tests for the pcb_geometry_utils module"""
+import numpy as np
+
+from pcbDraw import draw_board_from_graph_multi_agent, get_los_and_ol_multi_agent
+from pcb_geometry_utils import area_of_union_within, get_los_and_ol_analytic
+from test_occupancy import load_graph_and_board
+
+def test_area_of_union_within():
+    """Overlapping squares are only counted once and clipped to the region."""
+    region = np.array([[0, 0], [10, 0], [10, 10], [0, 10]], dtype=np.float64)
+    a = np.array([[-1, -1], [2, -1], [2, 2], [-1, 2]], dtype=np.float64)
+    b = np.array([[1, 1], [3, 1], [3, 3], [1, 3]], dtype=np.float64)
+    assert np.isclose(area_of_union_within(region, [a]), 4.0)
+    assert np.isclose(area_of_union_within(region, [a, b]), 7.0)
+    # many mutually overlapping polygons
+    shifted = [b + [0.01 * k, 0.0] for k in range(40)]
+    assert np.isclose(area_of_union_within(region, shifted), 2.39 * 2)
+
+def test_los_and_ol_analytic_outside_the_board():
+    """Sectors with no area give features of 0 instead of NaN."""
+    los, ol, segment_areas, overlap_areas = get_los_and_ol_analytic(
+        (-50.0, -50.0), (1.0, 1.0), 0.0, [], 20.0, 20.0, 1.5, padding=4)
+    assert np.all(segment_areas == 0) and np.all(overlap_areas == 0)
+    assert np.all(los == 0) and np.all(ol == 0)
+
+def test_los_and_ol_analytic_matches_raster():
+    """The analytic features agree with the raster features, in every \
+        sector, within the errors documented by get_los_and_ol_analytic for \
+        the pixel discretisation of the raster."""
+    rng = np.random.default_rng(0)
+    for idx in range(2):
+        _pv, g, b = load_graph_and_board(idx)
+        nn = g.get_nodes()
+        for _ in range(3):
+            for i in range(len(nn)):
+                nn[i].set_pos(tuple(rng.uniform(-1, b.get_width() + 1, 2)))
+                nn[i].set_orientation(float(rng.integers(4) * 90))
+
+            for n in nn:
+                radius = np.max(n.get_size()) * 1.5
+                grids = draw_board_from_graph_multi_agent(g,
+                                                          n.get_id(),
+                                                          b.get_width(),
+                                                          b.get_height(),
+                                                          padding=4)
+                los, ol, _, ol_masks = get_los_and_ol_multi_agent(n,
+                                                                   b,
+                                                                   radius,
+                                                                   grids,
+                                                                   padding=4)
+                others = [(m.get_pos(), m.get_size(), m.get_orientation())
+                          for m in nn if m.get_id() != n.get_id()]
+                los_a, ol_a, _, overlap_areas = get_los_and_ol_analytic(
+                    n.get_pos(), n.get_size(), n.get_orientation(), others,
+                    b.get_width(), b.get_height(), radius, padding=4)
+
+                assert np.all(np.abs(los - los_a) <= 0.1)
+                # overlap ratios of small sectors are dominated by edge pixels
+                ol_tolerance = np.where(overlap_areas < 1.0, 0.3, 0.15)
+                assert np.all(np.abs(ol - ol_a) <= ol_tolerance)
+
+                ol_ratios = np.array([np.sum(m) for m in ol_masks], dtype=np.float64)
+                ol_ratios /= np.sum(ol_ratios)
+                assert np.allclose(ol_ratios,
+                                   overlap_areas / np.sum(overlap_areas),
+                                   atol=0.05)
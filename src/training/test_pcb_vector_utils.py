@@ -1,5 +1,14 @@
 """Unit tests for pcb_vector_utils module"""
+import numpy as np
+
 import pcb_vector_utils
+from pcb_vector_utils import compute_sum_of_euclidean_distances_between_pads
+from pcb_vector_utils import compute_sum_of_euclidean_distances_between_pads_v2
+from pcb_vector_utils import compute_pad_referenced_distance_vectors_v2
+from pcb_vector_utils import compute_pad_referenced_distance_vectors_v3
+from pcb_vector_utils import compute_pad_referenced_distance_vectors_batch
+from pcb_vector_utils import pad_topology
+from test_observation import make_environment
 
 def test_calculate_resultant_vector():
     """Tests rare condition of having both inputs 0.0 which if unchecked, will \
@@ -7,3 +16,44 @@ def test_calculate_resultant_vector():
     euclidean_dist, angle = pcb_vector_utils.calculate_resultant_vector(0,0)
     assert euclidean_dist == 0.0
     assert angle == 0.0
+
+def test_pad_topology_kernels_match_loop_kernels():
+    """The array based wirelength and distance vector kernels, single and \
+        batched over the agents, give results identical to the loop based \
+        ones, for any pose of the nodes."""
+    rng = np.random.default_rng(0)
+    env = make_environment()
+    env.reset()
+    for trial in range(10):
+        nn = env.g.get_nodes()
+        for i in range(len(nn)):
+            nn[i].set_pos(tuple(rng.uniform(-1, 21, 2)))
+            if trial % 2 == 0:
+                nn[i].set_orientation(float(rng.integers(4) * 90))
+            else:
+                nn[i].set_orientation(float(rng.uniform(0, 360)))
+        env.state.pull()
+
+        doms = []
+        topologies = []
+        for a in env.agents:
+            p = a.parameters
+            topology = pad_topology(p.node, p.neighbors, p.eoi)
+            assert compute_sum_of_euclidean_distances_between_pads(
+                p.node, p.neighbors, p.eoi, ignore_power=True) == \
+                compute_sum_of_euclidean_distances_between_pads_v2(
+                    topology, ignore_power=True)
+
+            dom, _, _ = compute_pad_referenced_distance_vectors_v2(
+                p.node, p.neighbors, p.eoi, ignore_power=True)
+            assert dom == compute_pad_referenced_distance_vectors_v3(
+                topology, ignore_power=True)
+            doms.append(dom)
+            topologies.append(topology)
+
+        # topologies reading the environment's graph_state, and reading the
+        # nodes
+        assert doms == compute_pad_referenced_distance_vectors_batch(
+            [a.parameters.topology for a in env.agents], ignore_power=True)
+        assert doms == compute_pad_referenced_distance_vectors_batch(
+            topologies, ignore_power=True)
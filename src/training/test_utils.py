@@ -0,0 +1,270 @@
+"""Unit tests for the utils module"""
+import copy
+import random
+import time
+import numpy as np
+import pytest
+import torch
+
+from utils import ReplayMemory, DeviceReplayMemory, MemmapReplayMemory, \
+    PrioritizedReplayMemory, BatchPrefetcher, is_prioritized, PolyakUpdater
+
+def fill(memory, n):
+    for i in range(n):
+        memory.add(np.full(4, i), [i, i, i], np.full(4, i + 1), float(i), 1.0)
+
+def test_replay_memory_ring_buffer():
+    """The memory keeps the latest capacity transitions, oldest first, and \
+        samples whole transitions."""
+    memory = ReplayMemory(5, device="cpu")
+    fill(memory, 8)
+    assert len(memory) == 5
+    np.testing.assert_array_equal(memory.get_latest(3).reward[:, 0], [5, 6, 7])
+    np.testing.assert_array_equal(memory.get_latest(10).reward[:, 0],
+                                  [3, 4, 5, 6, 7])
+
+    random.seed(0)
+    state, action, next_state, reward, done = memory.sample(4)
+    assert state.shape == (4, 4) and action.shape == (4, 3)
+    np.testing.assert_array_equal(state[:, 0], reward[:, 0])
+    np.testing.assert_array_equal(next_state[:, 0], reward[:, 0] + 1)
+    assert set(reward[:, 0].tolist()) <= {3, 4, 5, 6, 7}
+
+    _, _, _, reward, _ = memory.sample_from_latest(2, 2)
+    assert sorted(reward[:, 0].tolist()) == [6, 7]
+
+def test_replay_memory_add_content_of():
+    """Copying into a larger memory keeps the order of the transitions."""
+    memory = ReplayMemory(5, device="cpu")
+    fill(memory, 8)
+    larger = ReplayMemory(10, device="cpu")
+    larger.add_content_of(memory)
+    fill(larger, 2)
+    np.testing.assert_array_equal(larger.get_latest(10).reward[:, 0],
+                                  [3, 4, 5, 6, 7, 0, 1])
+
+def test_device_replay_memory_matches_host_contents():
+    """The device memory stages, flushes and keeps the latest transitions \
+        like the host memory."""
+    host = ReplayMemory(5, device="cpu")
+    device = DeviceReplayMemory(5, device="cpu", chunk_size=3)
+    fill(host, 8)
+    fill(device, 8)
+    assert len(device) == len(host)
+    for a, b in zip(device.get_latest(10), host.get_latest(10)):
+        np.testing.assert_array_equal(a, b)
+
+    state, _, next_state, reward, _ = device.sample(16)
+    assert state.shape == (16, 4)
+    np.testing.assert_array_equal(next_state[:, 0], reward[:, 0] + 1)
+    _, _, _, reward, _ = device.sample_from_latest(8, 2)
+    assert set(reward[:, 0].tolist()) <= {6, 7}
+
+def test_replay_memory_grow_keeps_ring_order():
+    """Growing a wrapped memory in place keeps its transitions in order, as \
+        copying them into a new, larger memory does."""
+    for memory in (ReplayMemory(5, device="cpu"),
+                   DeviceReplayMemory(5, device="cpu", chunk_size=2)):
+        fill(memory, 7)
+        memory.grow(8)
+        assert memory.capacity == 8 and len(memory) == 5
+        fill(memory, 4)
+        np.testing.assert_array_equal(memory.get_latest(8).reward[:, 0],
+                                      [3, 4, 5, 6, 0, 1, 2, 3])
+
+def test_replay_memory_grow_samples_every_transition(tmp_path):
+    """After one or two grows, of a wrapped memory or not, sampling draws \
+        from exactly the stored transitions, before and after refilling, \
+        and get_latest keeps them in order."""
+    def add(memory, start, stop):
+        for i in range(start, stop):
+            memory.add(np.full(4, i), [i, i, i], np.full(4, i + 1), float(i),
+                       1.0)
+
+    def sampled(memory, batch_size):
+        rewards = set()
+        for _ in range(50):
+            rewards |= set(memory.sample(batch_size)[3][:, 0].tolist())
+        return rewards
+
+    directories = iter(range(100))
+    for make in (lambda capacity: ReplayMemory(capacity, device="cpu"),
+                 lambda capacity: MemmapReplayMemory(
+                     capacity, device="cpu",
+                     directory=str(tmp_path / str(next(directories)))),
+                 lambda capacity: PrioritizedReplayMemory(capacity,
+                                                          device="cpu"),
+                 lambda capacity: DeviceReplayMemory(capacity, device="cpu",
+                                                     chunk_size=2)):
+        # newest segment (rows 0 and 1) shorter than the oldest one
+        memory = make(4)
+        add(memory, 0, 6)
+        memory.grow(8)
+        assert sampled(memory, 4) == {2, 3, 4, 5}
+        add(memory, 6, 8)
+        assert sampled(memory, 6) == {2, 3, 4, 5, 6, 7}
+        np.testing.assert_array_equal(memory.get_latest(8).reward[:, 0],
+                                      [2, 3, 4, 5, 6, 7])
+
+        # oldest segment shorter than the newest one
+        memory = make(5)
+        add(memory, 0, 9)
+        memory.grow(8)
+        assert sampled(memory, 5) == {4, 5, 6, 7, 8}
+        add(memory, 9, 14)
+        np.testing.assert_array_equal(memory.get_latest(8).reward[:, 0],
+                                      [6, 7, 8, 9, 10, 11, 12, 13])
+
+        # two grows before refilling
+        memory = make(2)
+        add(memory, 0, 3)
+        memory.grow(6)
+        memory.grow(9)
+        np.testing.assert_array_equal(memory.get_latest(9).reward[:, 0],
+                                      [1, 2])
+        assert sampled(memory, 2) == {1, 2}
+        add(memory, 3, 5)
+        np.testing.assert_array_equal(memory.get_latest(9).reward[:, 0],
+                                      [1, 2, 3, 4])
+        assert sampled(memory, 4) == {1, 2, 3, 4}
+
+def test_memmap_replay_memory_survives_restarts(tmp_path):
+    """A memory reopened from its directory continues with the stored \
+        transitions, in order, and samples whole transitions."""
+    for sampling in ("uniform", "block"):
+        directory = str(tmp_path / sampling)
+        memory = MemmapReplayMemory(5, device="cpu", directory=directory,
+                                    sampling=sampling, block_size=2)
+        fill(memory, 7)
+        memory.sync()
+
+        reopened = MemmapReplayMemory(8, device="cpu", directory=directory,
+                                      sampling=sampling, block_size=2)
+        assert reopened.capacity == 8 and len(reopened) == 5
+        fill(reopened, 1)
+        np.testing.assert_array_equal(reopened.get_latest(8).reward[:, 0],
+                                      [2, 3, 4, 5, 6, 0])
+
+        state, _, next_state, reward, _ = reopened.sample(4)
+        np.testing.assert_array_equal(state[:, 0], reward[:, 0])
+        np.testing.assert_array_equal(next_state[:, 0], reward[:, 0] + 1)
+
+def test_prioritized_replay_memory_samples_by_priority():
+    """Rows are drawn in proportion to their priority, importance weights \
+        favour rare rows and priorities follow the ring through grow."""
+    memory = PrioritizedReplayMemory(8, device="cpu", alpha=1.0, beta=1.0,
+                                     eps=0.0)
+    fill(memory, 8)
+    assert memory.tree.total() == 8
+    memory.update_priorities(np.arange(8), [1, 1, 1, 1, 1, 1, 1, 93])
+
+    np.random.seed(0)
+    counts = np.zeros(8)
+    for _ in range(100):
+        _, _, _, reward, _, weights, rows = memory.sample_prioritized(10)
+        np.testing.assert_array_equal(reward[:, 0].numpy(), rows)
+        counts += np.bincount(rows, minlength=8)
+        # with beta = 1 the weights are inversely proportional to priority
+        priorities = np.where(rows == 7, 93.0, 1.0)
+        np.testing.assert_allclose(weights[:, 0].numpy(),
+                                   priorities.min() / priorities, rtol=1e-6)
+    assert counts[7] / counts.sum() > 0.9
+
+    fill(memory, 3)
+    assert memory.tree.get(memory._latest_rows(3)).tolist() == [93, 93, 93]
+    priorities = memory.tree.get(memory._latest_rows(8))
+    memory.grow(12)
+    np.testing.assert_array_equal(memory.tree.get(memory._latest_rows(8)),
+                                  priorities)
+    assert memory.tree.total() == priorities.sum()
+
+def test_batch_prefetcher_pops_batches_and_counts_stalls():
+    """Prefetched batches are whole transitions of the memory; writes go \
+        through to it and the memory is returned on close."""
+    memory = PrioritizedReplayMemory(16, device="cpu")
+    fill(memory, 8)
+    prefetcher = BatchPrefetcher(memory, batch_size=4, depth=2)
+    assert is_prioritized(prefetcher)
+    assert not is_prioritized(ReplayMemory(4, device="cpu"))
+    for _ in range(10):
+        state, _, next_state, reward, _, weights, rows = \
+            prefetcher.sample_prioritized(4)
+        np.testing.assert_array_equal(state[:, 0], reward[:, 0])
+        np.testing.assert_array_equal(next_state[:, 0], reward[:, 0] + 1)
+        assert weights.shape == (4, 1)
+        prefetcher.update_priorities(rows, np.ones(4))
+        fill(prefetcher, 1)
+    assert len(prefetcher) == 16 and prefetcher.capacity == 16
+    assert prefetcher.batches == 10 and 1 <= prefetcher.stalls <= 10
+
+    # batches prefetched before a reset are never popped
+    while prefetcher.ready.qsize() < 2:
+        time.sleep(0.01)
+    prefetcher.reset()
+    for i in range(8):
+        prefetcher.add(np.full(4, 100 + i), [i, i, i], np.full(4, 101 + i),
+                       float(100 + i), 1.0)
+    for _ in range(4):
+        assert (prefetcher.sample_prioritized(4)[3] >= 100).all()
+    assert prefetcher.close() is memory
+    assert not prefetcher.thread.is_alive()
+
+def test_replay_memory_samples_into_staging_buffers():
+    """Batches gathered into given host tensors hold the same transitions \
+        as new ones, and reuse the buffers."""
+    for memory in (ReplayMemory(16, device="cpu"),
+                   PrioritizedReplayMemory(16, device="cpu")):
+        fill(memory, 8)
+        out = [torch.empty((4, width)) for width in (4, 3, 4, 1, 1)]
+        for _ in range(3):
+            batch = memory.sample(4, out=out)
+            for tensor, buffer in zip(batch, out):
+                assert tensor.data_ptr() == buffer.data_ptr()
+            state, action, next_state, reward, done = batch
+            np.testing.assert_array_equal(state[:, 0], reward[:, 0])
+            np.testing.assert_array_equal(action[:, 2], reward[:, 0])
+            np.testing.assert_array_equal(next_state[:, 0], reward[:, 0] + 1)
+            assert (done == 1).all()
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA")
+def test_batch_prefetcher_stages_batches_in_pinned_memory():
+    """On CUDA, batches of a host memory are gathered into a reused ring \
+        of pinned buffers."""
+    memory = ReplayMemory(16, device="cuda")
+    fill(memory, 8)
+    prefetcher = BatchPrefetcher(memory, batch_size=4, depth=2)
+    for _ in range(10):
+        state, _, next_state, reward, _ = prefetcher.sample(4)
+        torch.testing.assert_close(next_state[:, 0], reward[:, 0] + 1)
+    prefetcher.close()
+    assert len(prefetcher.staging) == 3
+    assert all(tensor.is_pinned()
+               for slot in prefetcher.staging for tensor in slot)
+
+def test_polyak_updater_matches_parameter_loop():
+    """Fused updates equal the per parameter update, and an interval of k \
+        decays the initial target weights as k updates do."""
+    torch.manual_seed(0)
+    source = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.ReLU(),
+                                 torch.nn.Linear(8, 1))
+    target = copy.deepcopy(source)
+    expected = copy.deepcopy(source)
+    delayed = copy.deepcopy(source)
+    for param in source.parameters():
+        param.data.add_(torch.randn_like(param))
+
+    updater = PolyakUpdater([target], [source], 0.005)
+    for _ in range(4):
+        updater.update()
+        for param, target_param in zip(source.parameters(),
+                                       expected.parameters()):
+            target_param.data.copy_(0.005 * param.data
+                                    + (1 - 0.005) * target_param.data)
+    for param, target_param in zip(expected.parameters(),
+                                   target.parameters()):
+        assert torch.equal(param, target_param)
+
+    PolyakUpdater([delayed], [source], 0.005, interval=4).update()
+    for param, target_param in zip(delayed.parameters(),
+                                   target.parameters()):
+        torch.testing.assert_close(param, target_param)
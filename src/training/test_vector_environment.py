@@ -0,0 +1,116 @@
+"""Unit tests for the vector_environment module"""
+import os
+import numpy as np
+import torch
+
+from core.environment.environment import environment
+from core.environment.parameters import parameters
+from core.environment.vector_environment import vector_environment, derive_seeds
+from core.agent.observation import observation_to_state
+from TD3 import Actor
+
+pcb_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "../../dataset/base/training.pcb")
+
+def make_parameters(max_steps=200, seed=0):
+    return parameters({"pcb_file": pcb_file,
+                       "training_pcb": pcb_file,
+                       "evaluation_pcb": pcb_file,
+                       "net": "",
+                       "use_dataAugmenter": True,
+                       "augment_position": True,
+                       "augment_orientation": True,
+                       "agent_max_action": 1,
+                       "agent_expl_noise": 0.1,
+                       "debug": False,
+                       "max_steps": max_steps,
+                       "w": 2.0,
+                       "o": 2.0,
+                       "hpwl": 2.0,
+                       "seed": seed,
+                       "ignore_power": True,
+                       "log_dir": None,
+                       "idx": 0,
+                       "shuffle_idxs": False,
+                       "los_backend": "raster"})
+
+def test_derive_seeds():
+    """The first environment keeps the seed; seeds are reproducible and \
+        distinct."""
+    seeds = derive_seeds(3, 4)
+    assert seeds[0] == 3
+    assert seeds == derive_seeds(3, 4)
+    assert len(set(seeds)) == 4
+
+def test_single_environment_matches_environment_step():
+    """With one environment, lockstep stepping with a batched policy gives \
+        the transitions of environment.step."""
+    env = environment(make_parameters())
+    env.reset()
+    envs = vector_environment(make_parameters(), num_envs=1)
+    envs.reset()
+    torch.manual_seed(0)
+    actor = Actor(env.agents[0].get_observation_space_shape(), 3, 1,
+                  device="cpu")
+
+    for _ in range(3):
+        expected = env.step(actor, deterministic=True)
+        steps = envs.step(actor, deterministic=True)
+        assert len(steps["reward"]) == len(expected)
+        for k, transition in enumerate(expected):
+            np.testing.assert_array_equal(steps["state"][k], transition[0])
+            np.testing.assert_array_equal(steps["next_state"][k], transition[1])
+            np.testing.assert_array_equal(steps["action"][k], transition[3])
+            assert steps["reward"][k] == transition[2]
+
+def test_finished_environments_are_reset():
+    """Every environment contributes one transition per agent and finished \
+        episodes are reported and reset."""
+    envs = vector_environment(make_parameters(max_steps=2), num_envs=2)
+    envs.reset()
+    num_agents = len(envs.agents)
+
+    finished = []
+    for _ in range(2):
+        steps = envs.step(None, random=True)
+        assert steps["state"].shape[0] == steps["action"].shape[0]
+        assert steps["state"].shape[0] <= 2 * num_agents
+        assert set(steps["env"]) == {0, 1}
+        finished += steps["episodes"]
+
+    assert sorted(episode["env"] for episode in finished) == [0, 1]
+    assert all(episode["episode_length"] == 2 for episode in finished)
+    assert envs.episode_lengths == [0, 0]
+
+def test_simultaneous_step_mode():
+    """In the simultaneous step mode all agents act on the observations of \
+        the board at the start of the step, and a vector environment of one \
+        environment gives the transitions of environment.step."""
+    torch.manual_seed(0)
+    params = make_parameters()
+    params.step_mode = "simultaneous"
+    env = environment(params)
+    env.reset()
+    actor = Actor(env.agents[0].get_observation_space_shape(), 3, 1,
+                  device="cpu")
+    states = [observation_to_state(s) for s in env.get_observations()]
+    transitions = env.step(actor, deterministic=True)
+    assert len(transitions) == len(env.agents)
+    for k, transition in enumerate(transitions):
+        np.testing.assert_array_equal(transition[0], states[k])
+        np.testing.assert_allclose(transition[3],
+                                   actor.select_action(np.array(states[k])),
+                                   atol=1e-6)
+
+    env = environment(params)
+    env.reset()
+    envs = vector_environment(params, num_envs=1)
+    envs.reset()
+    for _ in range(3):
+        expected = env.step(actor, deterministic=True)
+        steps = envs.step(actor, deterministic=True)
+        for k, transition in enumerate(expected):
+            np.testing.assert_array_equal(steps["state"][k], transition[0])
+            np.testing.assert_array_equal(steps["next_state"][k],
+                                          transition[1])
+            assert steps["reward"][k] == transition[2]
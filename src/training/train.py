@@ -16,6 +16,8 @@ To run this script, execute the main function.
 """
 
 from core.environment.environment import environment
+from core.environment.vector_environment import vector_environment
+from core.environment.environment_pool import environment_pool
 from core.environment.parameters import parameters
 
 import numpy as np
@@ -97,39 +99,71 @@ def training_run(settings):
                            "log_dir": settings["log_dir"],
                            "idx": settings["pcb_idx"],
                            "shuffle_idxs": settings["shuffle_training_idxs"],
+                           "los_backend": settings["los_backend"],
+                           "step_mode": settings["step_mode"],
                            })
 
-    env = environment(env_params)
-    env.reset()
-
-    model = setup_model(model_type=settings["policy"],
-                        train_env=env,
-                        hyperparameters=hp,
-                        device=settings["device"],
-                        early_stopping=settings["early_stopping"],
-                        verbose=settings["verbose"])
-
-    callback = log_and_eval_callback(log_dir=settings["log_dir"],
-                                     settings=settings,
-                                     hyperparameters=hp,
-                                     model=model,
-                                     eval_freq=settings["evaluate_every"],
-                                     verbose=settings["verbose"],
-                                     training_log="training.log",
-                                     num_evaluations=16)
-
-    write_desc_log( full_fn=os.path.join(settings["log_dir"],
-                                         f'{settings["run_name"]}_desc.log'),
+    if settings["async_collectors"] > 0:
+        # the collectors own the training environments; this one is only
+        # used for shapes, parameters and targets
+        env = environment(env_params)
+    elif settings["env_workers"] > 0:
+        # every environment is seeded from settings["seed"], independently
+        # of the number of workers
+        env = environment_pool(env_params,
+                               num_envs=settings["num_envs"],
+                               num_workers=settings["env_workers"])
+    elif settings["num_envs"] > 1:
+        env = vector_environment(env_params, num_envs=settings["num_envs"])
+    else:
+        env = environment(env_params)
+    try:
+        env.reset()
+
+        model = setup_model(model_type=settings["policy"],
+                            train_env=env,
+                            hyperparameters=hp,
+                            device=settings["device"],
+                            early_stopping=settings["early_stopping"],
+                            verbose=settings["verbose"])
+
+        callback = log_and_eval_callback(log_dir=settings["log_dir"],
                                          settings=settings,
                                          hyperparameters=hp,
-                                         model=model)
-
-    model.explore_for_expert_targets(settings["target_exploration_steps"])
-    model.learn(timesteps=settings["max_timesteps"],
+                                         model=model,
+                                         eval_freq=settings["evaluate_every"],
+                                         verbose=settings["verbose"],
+                                         training_log="training.log",
+                                         num_evaluations=16)
+
+        write_desc_log( full_fn=os.path.join(settings["log_dir"],
+                                             f'{settings["run_name"]}_desc.log'),
+                                             settings=settings,
+                                             hyperparameters=hp,
+                                             model=model)
+
+        if settings["async_collectors"] > 0:
+            model.learn_async(
+                timesteps=settings["max_timesteps"],
                 callback=callback,
                 start_timesteps=settings["start_timesteps"],
-                incremental_replay_buffer=settings["incremental_replay_buffer"]
-                )
+                num_collectors=settings["async_collectors"],
+                num_envs=settings["num_envs"],
+                target_exploration_steps=settings["target_exploration_steps"],
+                weight_sync_interval=settings["weight_sync_interval"],
+                max_update_to_data_ratio=settings["max_update_to_data_ratio"],
+                incremental_replay_buffer=settings["incremental_replay_buffer"])
+        else:
+            model.explore_for_expert_targets(settings["target_exploration_steps"])
+            model.learn(timesteps=settings["max_timesteps"],
+                        callback=callback,
+                        start_timesteps=settings["start_timesteps"],
+                        incremental_replay_buffer=settings["incremental_replay_buffer"]
+                        )
+    finally:
+        # stops the workers of an environment pool, also when training fails
+        if isinstance(env, environment_pool):
+            env.close()
 
     return [callback.best_metrics, callback.best_mean_metrics]
 
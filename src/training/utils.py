@@ -2,34 +2,100 @@ import torch
 import numpy as np
 from collections import namedtuple
 import random
+import json
+import os
+import queue
+import threading
+import time
+
+from observation_codec import observation_codec
+
+def _polyak(targets, sources, tau):
+    # target = tau * source + (1 - tau) * target over lists of tensors, in
+    # three fused multi-tensor kernels; the rounding of the per parameter
+    # expression is kept
+    scaled = torch._foreach_mul(sources, tau)
+    torch._foreach_mul_(targets, 1.0 - tau)
+    torch._foreach_add_(targets, scaled)
 
 def soft_update(target, source, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(
-            target_param.data * (1.0 - tau) + param.data * tau
-            )
+    _polyak([param.data for param in target.parameters()],
+            [param.data for param in source.parameters()],
+            tau)
 
 def hard_update(target, source):
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(param.data)
 
+class PolyakUpdater(object):
+    """
+    Polyak averaging of target networks, updated with fused multi-tensor
+    kernels instead of a loop over the parameters.
+
+    The parameter lists are collected once, so the updater must be rebuilt
+    when a network is replaced (e.g. by copy.deepcopy), not when its
+    parameters are loaded in place. With an interval k the averaging runs
+    on every k-th update of the caller with rate 1 - (1 - tau)^k, which
+    decays old weights as k updates with rate tau would.
+
+    Args:
+        targets (list): target networks.
+        sources (list): networks they track, in the same order.
+        tau (float): update rate per training step.
+        interval (int): training steps between updates.
+
+    Attributes:
+        tau (float): rate applied by update.
+    """
+    def __init__(self, targets, sources, tau, interval=1):
+        self.targets = [param.data for target in targets
+                        for param in target.parameters()]
+        self.sources = [param.data for source in sources
+                        for param in source.parameters()]
+        if len(self.targets) != len(self.sources):
+            raise ValueError("target and source networks differ")
+        self.interval = interval
+        # 1 - (1 - tau) is not exactly tau in floating point
+        self.tau = tau if interval == 1 else 1.0 - (1.0 - tau) ** interval
+
+    def update(self):
+        """
+        Moves the targets towards the sources by tau.
+        """
+        _polyak(self.targets, self.sources, self.tau)
+
 Transition = namedtuple(
     'Transition', ('state', 'action', 'next_state', 'reward', 'done'))
 
+# Transition fields holding states, which a codec stores encoded
+STATE_FIELDS = (0, 2)
+
 class ReplayMemory(object):
     """
     A replay memory buffer used in reinforcement learning algorithms to store\
           and sample transitions.
 
+    Transitions are kept in five preallocated arrays, one per Transition
+    field, used as a ring buffer. The arrays are float32, the precision of
+    the sampled tensors, and are allocated with the first transition (when
+    their widths become known) with np.zeros, so the operating system only
+    commits the pages that have been written. With a codec, states and next
+    states are stored encoded, as rows of bytes, and decoded when they are
+    sampled or read.
+
     Args:
         capacity (int): The maximum capacity of the replay memory.
         device (str): The device to store the tensors (e.g., 'cpu', 'cuda').
+        codec (observation_codec): Storage codec of the states; float32
+            when None.
 
     Attributes:
         capacity (int): The maximum capacity of the replay memory.
         device (str): The device to store the tensors.
-        memory (list): A list to store the transitions.
+        memory (Transition): The (capacity, width) arrays of every field, or
+            None before the first transition.
         position (int): The current position in the memory buffer.
+        size (int): The number of transitions stored.
 
     Methods:
         add(*args): Saves a transition to the replay memory.
@@ -48,23 +114,75 @@ class ReplayMemory(object):
         reset(): Resets the replay memory by clearing all stored transitions.
     """
 
-    def __init__(self, capacity, device):
+    def __init__(self, capacity, device, codec=None):
         self.device = device
         self.capacity = capacity
-        self.memory = []
+        self.codec = codec
+        self.memory = None
         self.position = 0
+        self.size = 0
+
+    def _allocate(self, widths):
+        dtypes = [np.float32] * len(widths)
+        if self.codec is not None:
+            for i in STATE_FIELDS:
+                widths[i] = self.codec.nbytes
+                dtypes[i] = np.uint8
+        self.memory = Transition(*[np.zeros((self.capacity, width),
+                                            dtype=dtype)
+                                   for width, dtype in zip(widths, dtypes)])
+
+    def _encode(self, args):
+        # fields as they are stored
+        if self.codec is None:
+            return args
+        args = list(args)
+        for i in STATE_FIELDS:
+            args[i] = self.codec.encode(args[i])
+        return args
+
+    def _decode(self, fields):
+        # stored fields as float32
+        if self.codec is None:
+            return fields
+        fields = list(fields)
+        for i in STATE_FIELDS:
+            fields[i] = self.codec.decode(fields[i])
+        return fields
 
     def add(self, *args):
         """Saves a transition."""
-        if len(self.memory) < self.capacity:
-            self.memory.append(None)
+        if self.memory is None:
+            self._allocate([np.size(arg) for arg in args])
+        args = self._encode(args)
 
-        reshaped_args = []
-        for arg in args:
-            reshaped_args.append(np.reshape(arg, (1, -1)))
+        for field, arg in zip(self.memory, args):
+            field[self.position] = np.reshape(arg, -1)
 
-        self.memory[self.position] = Transition(*reshaped_args)
         self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def add_batch(self, *args):
+        """
+        Saves a batch of transitions; every argument holds one row per
+        transition.
+        """
+        n = len(args[0])
+        if n == 0:
+            return
+        if self.memory is None:
+            self._allocate([np.size(arg) // n for arg in args])
+        if n > self.capacity:
+            args = [np.asarray(arg)[-self.capacity:] for arg in args]
+            n = self.capacity
+        args = self._encode(args)
+
+        rows = (self.position + np.arange(n)) % self.capacity
+        for field, arg in zip(self.memory, args):
+            field[rows] = np.reshape(arg, (n, -1))
+
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
 
     def add_content_of(self, other):
         """
@@ -73,9 +191,12 @@ class ReplayMemory(object):
         Args:
             other (ReplayMemory): Another replay buffer.
         """
-        latest_trans = other.get_latest(self.capacity)
-        for transition in latest_trans:
-            self.add(*transition)
+        self.add_batch(*other.get_latest(self.capacity))
+
+    def _latest_rows(self, latest):
+        # rows of the latest transitions, oldest first
+        latest = min(latest, self.size)
+        return (self.position - latest + np.arange(latest)) % self.capacity
 
     def get_latest(self, latest):
         """
@@ -85,17 +206,14 @@ class ReplayMemory(object):
             latest (int): The number of latest elements to return.
 
         Returns:
-            list: A list containing the latest elements.
-        """
-        if self.capacity < latest:
-            latest_trans = self.memory[self.position:].copy() + self.memory[:self.position].copy()
-        elif len(self.memory) < self.capacity:
-            latest_trans = self.memory[-latest:].copy()
-        elif self.position >= latest:
-            latest_trans = self.memory[:self.position][-latest:].copy()
-        else:
-            latest_trans = self.memory[-latest+self.position:].copy() + self.memory[:self.position].copy()
-        return latest_trans
+            Transition: The (latest, width) arrays of every field, oldest
+            transition first.
+        """
+        if self.memory is None:
+            return Transition(*[np.zeros((0, 1), dtype=np.float32)
+                                for _ in Transition._fields])
+        rows = self._latest_rows(latest)
+        return Transition(*self._decode([field[rows] for field in self.memory]))
 
     def add_latest_from(self, other, latest):
         """
@@ -105,34 +223,301 @@ class ReplayMemory(object):
             other (ReplayMemory): Another replay buffer.
             latest (int): The number of elements to add.
         """
-        latest_trans = other.get_latest(latest)
-        for transition in latest_trans:
-            self.add(*transition)
+        self.add_batch(*other.get_latest(latest))
 
     def shuffle(self):
         """Shuffles the transitions in the replay memory."""
-        random.shuffle(self.memory)
+        if self.memory is None:
+            return
+        order = list(range(self.size))
+        random.shuffle(order)
+        for field in self.memory:
+            field[:self.size] = field[order]
 
-    def sample(self, batch_size):
+    def _to_tensors(self, rows, out=None):
+        if out is None:
+            fields = self._decode([field[rows] for field in self.memory])
+            return tuple(torch.from_numpy(field).to(self.device)
+                         for field in fields)
+
+        # gathered into the host tensors out; from pinned memory the copies
+        # to the device do not block
+        buffers = [tensor.numpy() for tensor in out]
+        if self.codec is None:
+            for field, buffer in zip(self.memory, buffers):
+                np.take(field, rows, axis=0, out=buffer)
+        else:
+            fields = self._decode([field[rows] for field in self.memory])
+            for field, buffer in zip(fields, buffers):
+                np.copyto(buffer, field)
+        return tuple(tensor.to(self.device, non_blocking=True)
+                     for tensor in out)
+
+    def sample(self, batch_size, out=None):
         """
         Samples a batch of transitions from the replay memory.
 
         Args:
             batch_size (int): The size of the batch to sample.
+            out (list): (batch_size, width) host tensors of every field the
+                batch is gathered into before it is copied to the device;
+                new tensors when None.
+
+        Returns:
+            tuple: A tuple containing the sampled tensors\
+                  (state, action, next_state, reward, done).
+        """
+        rows = random.sample(range(self.size), batch_size)
+        return self._to_tensors(rows, out)
+
+    def sample_from_latest(self, batch_size, latest):
+        """
+        Samples a batch of transitions from the latest elements in the\
+              replay memory.
+
+        Args:
+            batch_size (int): The size of the batch to sample.
+            latest (int): The number of latest elements to consider.
 
         Returns:
             tuple: A tuple containing the sampled tensors\
                   (state, action, next_state, reward, done).
         """
-        transitions = random.sample(self.memory, batch_size)
-        batch = Transition(*zip(*transitions))
+        latest_rows = self._latest_rows(latest)
+        rows = latest_rows[random.sample(range(len(latest_rows)), batch_size)]
+        return self._to_tensors(rows)
+
+    def grow(self, capacity):
+        """
+        Increases the capacity in place, keeping every transition and the
+        order of the ring.
+
+        The arrays are resized with realloc, which for allocations of this
+        size remaps their pages rather than copying them. The transitions
+        then fill rows [0, size), oldest first, as in a memory that never
+        wrapped; a wrapped ring is rotated one field at a time, so the
+        temporary overhead is a single field.
+
+        Args:
+            capacity (int): The new capacity; smaller values are ignored.
+        """
+        if capacity <= self.capacity:
+            return
+        old_capacity = self.capacity
+        self.capacity = capacity
+        if self.memory is None:
+            return
+
+        # ReplayMemory never hands out views of its arrays (sampled batches
+        # and get_latest are copies), so they can be resized in place.
+        for field in self.memory:
+            field.resize((capacity, field.shape[1]), refcheck=False)
+        self._unwrap(old_capacity)
+
+    def _unwrap(self, old_capacity):
+        # Moves the transitions of a ring of old_capacity rows to rows
+        # [0, size), oldest first, and writes the next transition after them.
+        # sample and shuffle draw from rows [0, size), so the rows below size
+        # must be the transitions, whatever the capacity.
+        if self.size == old_capacity and self.position != 0:
+            # rows [position, old_capacity) are the oldest, [0, position)
+            # the newest transitions
+            head = self.position
+            for field in self.memory:
+                field[:old_capacity] = np.concatenate(
+                    (field[head:old_capacity], field[:head]))
+        self.position = self.size % self.capacity
+
+    def __len__(self):
+        return self.size
+
+    def reset(self):
+        self.position = 0
+        self.size = 0
+
+class DeviceReplayMemory(object):
+    """
+    A replay memory buffer with the interface of ReplayMemory that keeps its
+    transitions in preallocated torch tensors on the training device.
+
+    Transitions are first written to a host staging chunk (pinned memory on
+    CUDA devices) and copied to the device one chunk at a time, when the
+    chunk is full or before sampling. The copy is asynchronous on CUDA; a
+    CUDA event recorded after it is waited on before the chunk is written
+    again. Batches are drawn with torch.randint on the device and gathered
+    there, so sampling never touches host memory. Unlike ReplayMemory,
+    indices are drawn with replacement.
+
+    Args:
+        capacity (int): The maximum capacity of the replay memory.
+        device (str): The device to store the tensors (e.g., 'cpu', 'cuda').
+        chunk_size (int): Number of transitions staged on the host before
+            they are copied to the device.
+
+    Attributes:
+        memory (Transition): The (capacity, width) tensors of every field, or
+            None before the first transition.
+        staging (Transition): The (chunk_size, width) host arrays of every
+            field.
+        pending (int): The number of staged transitions.
+        copied (torch.cuda.Event): Recorded after the last copy of the
+            staging chunk to a CUDA device, until it is waited on; None
+            otherwise.
+        position (int): The device row the next chunk is written to.
+        size (int): The number of transitions on the device.
+    """
+
+    def __init__(self, capacity, device, chunk_size=1024):
+        self.device = torch.device(device)
+        self.capacity = capacity
+        self.chunk_size = min(chunk_size, capacity)
+        self.memory = None
+        self.staging = None
+        self.pending = 0
+        self.copied = None
+        self.position = 0
+        self.size = 0
+
+    def _allocate(self, widths):
+        self.memory = Transition(*[torch.zeros((self.capacity, width),
+                                               dtype=torch.float32,
+                                               device=self.device)
+                                   for width in widths])
+        pin = self.device.type == "cuda"
+        self.staging = Transition(*[torch.zeros((self.chunk_size, width),
+                                                dtype=torch.float32,
+                                                pin_memory=pin).numpy()
+                                    for width in widths])
+
+    def flush(self):
+        """Copies the staged transitions to the device."""
+        n = self.pending
+        if n == 0:
+            return
+        rows = torch.remainder(torch.arange(self.position, self.position + n,
+                                            device=self.device),
+                               self.capacity)
+        for field, chunk in zip(self.memory, self.staging):
+            field[rows] = torch.from_numpy(chunk[:n]).to(self.device,
+                                                         non_blocking=True)
+        if self.device.type == "cuda":
+            self.copied = torch.cuda.Event()
+            self.copied.record()
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        self.pending = 0
+
+    def _wait_for_copy(self):
+        # the staging chunk must not be overwritten while the asynchronous
+        # copy of its previous content is still reading it
+        if self.copied is not None:
+            self.copied.synchronize()
+            self.copied = None
+
+    def add(self, *args):
+        """Saves a transition."""
+        if self.memory is None:
+            self._allocate([np.size(arg) for arg in args])
+
+        self._wait_for_copy()
+        for chunk, arg in zip(self.staging, args):
+            chunk[self.pending] = np.reshape(arg, -1)
+        self.pending += 1
+        if self.pending == self.chunk_size:
+            self.flush()
+
+    def add_batch(self, *args):
+        """
+        Saves a batch of transitions; every argument holds one row per
+        transition.
+        """
+        n = len(args[0])
+        if n == 0:
+            return
+        if self.memory is None:
+            self._allocate([np.size(arg) // n for arg in args])
+        args = [np.reshape(np.asarray(arg, dtype=np.float32), (n, -1))
+                for arg in args]
+
+        start = 0
+        while start < n:
+            self._wait_for_copy()
+            count = min(n - start, self.chunk_size - self.pending)
+            for chunk, arg in zip(self.staging, args):
+                chunk[self.pending:self.pending+count] = arg[start:start+count]
+            self.pending += count
+            start += count
+            if self.pending == self.chunk_size:
+                self.flush()
+
+    def add_content_of(self, other):
+        """
+        Adds the content of another replay buffer to this replay buffer.
+
+        Args:
+            other: Another replay buffer.
+        """
+        self.add_batch(*other.get_latest(self.capacity))
+
+    def _latest_rows(self, latest):
+        # device rows of the latest transitions, oldest first
+        latest = min(latest, self.size)
+        return torch.remainder(
+            torch.arange(self.position - latest, self.position,
+                         device=self.device),
+            self.capacity)
+
+    def get_latest(self, latest):
+        """
+        Returns the latest elements from the replay memory.
+
+        Args:
+            latest (int): The number of latest elements to return.
+
+        Returns:
+            Transition: The (latest, width) host arrays of every field, oldest
+            transition first.
+        """
+        if self.memory is None:
+            return Transition(*[np.zeros((0, 1), dtype=np.float32)
+                                for _ in Transition._fields])
+        self.flush()
+        rows = self._latest_rows(latest)
+        return Transition(*[field[rows].cpu().numpy() for field in self.memory])
+
+    def add_latest_from(self, other, latest):
+        """
+        Adds the latest samples from another buffer to this buffer.
+
+        Args:
+            other: Another replay buffer.
+            latest (int): The number of elements to add.
+        """
+        self.add_batch(*other.get_latest(latest))
+
+    def shuffle(self):
+        """Shuffles the transitions in the replay memory."""
+        if self.memory is None:
+            return
+        self.flush()
+        order = torch.randperm(self.size, device=self.device)
+        for field in self.memory:
+            field[:self.size] = field[order]
+
+    def sample(self, batch_size):
+        """
+        Samples a batch of transitions from the replay memory.
+
+        Args:
+            batch_size (int): The size of the batch to sample.
 
-        state = torch.FloatTensor(np.concatenate(batch.state)).to(self.device)
-        action = torch.FloatTensor(np.concatenate(batch.action)).to(self.device)
-        next_state = torch.FloatTensor(np.concatenate(batch.next_state)).to(self.device)
-        reward = torch.FloatTensor(np.concatenate(batch.reward)).to(self.device)
-        done = torch.FloatTensor(np.concatenate(batch.done)).to(self.device)
-        return state, action, next_state, reward, done
+        Returns:
+            tuple: A tuple containing the sampled tensors\
+                  (state, action, next_state, reward, done).
+        """
+        self.flush()
+        rows = torch.randint(0, self.size, (batch_size,), device=self.device)
+        return tuple(field[rows] for field in self.memory)
 
     def sample_from_latest(self, batch_size, latest):
         """
@@ -147,20 +532,725 @@ class ReplayMemory(object):
             tuple: A tuple containing the sampled tensors\
                   (state, action, next_state, reward, done).
         """
-        latest_trans = self.get_latest(latest)
-        transitions = random.sample(latest_trans, batch_size)
-        batch = Transition(*zip(*transitions))
+        self.flush()
+        latest_rows = self._latest_rows(latest)
+        rows = latest_rows[torch.randint(0, len(latest_rows), (batch_size,),
+                                         device=self.device)]
+        return tuple(field[rows] for field in self.memory)
 
-        state = torch.FloatTensor(np.concatenate(batch.state)).to(self.device)
-        action = torch.FloatTensor(np.concatenate(batch.action)).to(self.device)
-        next_state = torch.FloatTensor(np.concatenate(batch.next_state)).to(self.device)
-        reward = torch.FloatTensor(np.concatenate(batch.reward)).to(self.device)
-        done = torch.FloatTensor(np.concatenate(batch.done)).to(self.device)
-        return state, action, next_state, reward, done
+    def grow(self, capacity):
+        """
+        Increases the capacity, keeping every transition in ring order.
+
+        Device tensors cannot be resized in place; every field is copied to
+        its larger tensor on the device, one field at a time, so the
+        temporary overhead is a single field.
+
+        Args:
+            capacity (int): The new capacity; smaller values are ignored.
+        """
+        if capacity <= self.capacity:
+            return
+        self.flush()
+        rows = None if self.memory is None else self._latest_rows(self.size)
+        self.capacity = capacity
+        if self.memory is None:
+            return
+
+        old_fields = list(self.memory)
+        self.memory = None
+        fields = []
+        while len(old_fields) != 0:
+            field = old_fields.pop(0)
+            grown = torch.zeros((capacity, field.shape[1]),
+                                dtype=field.dtype,
+                                device=self.device)
+            grown[:self.size] = field[rows]
+            fields.append(grown)
+            del field
+        self.memory = Transition(*fields)
+        self.position = self.size % capacity
 
     def __len__(self):
-        return len(self.memory)
+        return min(self.size + self.pending, self.capacity)
 
     def reset(self):
-        self.memory = []
+        self.pending = 0
         self.position = 0
+        self.size = 0
+
+class MemmapReplayMemory(ReplayMemory):
+    """
+    A ReplayMemory whose arrays are np.memmap files in a directory, so that
+    the operating system pages them to and from disk instead of holding
+    them in RAM, and that survives process restarts.
+
+    The directory holds one file per Transition field and memory.json with
+    the capacity, widths, position and size. The metadata is written every
+    sync_interval transitions and by sync(); after a restart the memory
+    reopens the files and continues with the experience stored up to the
+    last sync.
+
+    Args:
+        capacity (int): The maximum capacity of the replay memory; a larger
+            capacity found in the directory is kept.
+        device (str): The device to store the tensors (e.g., 'cpu', 'cuda').
+        directory (str): Directory of the memory files; created if missing.
+        sampling (str): "uniform" draws batch_size independent rows, read
+            in increasing order; "block" draws batch_size / block_size runs
+            of block_size consecutive rows (in ring order), so a batch reads
+            a few contiguous pages.
+        block_size (int): Rows per run with "block" sampling.
+        sync_interval (int): Transitions between metadata writes.
+    """
+
+    def __init__(self, capacity, device, directory, sampling="uniform",
+                 block_size=32, sync_interval=1000):
+        super().__init__(capacity, device)
+        if sampling not in ("uniform", "block"):
+            raise ValueError(f"unknown sampling '{sampling}'")
+        self.directory = directory
+        self.sampling = sampling
+        self.block_size = block_size
+        self.sync_interval = sync_interval
+        self.unsynced = 0
+        os.makedirs(directory, exist_ok=True)
+
+        metadata = os.path.join(directory, "memory.json")
+        if os.path.isfile(metadata):
+            with open(metadata, "r", encoding="utf-8") as fp:
+                state = json.load(fp)
+            self.capacity = state["capacity"]
+            self.memory = self._open(state["widths"], "r+")
+            self.position = state["position"]
+            self.size = state["size"]
+            self.grow(capacity)
+
+    def _filename(self, field):
+        return os.path.join(self.directory, f"{field}.dat")
+
+    def _open(self, widths, mode):
+        return Transition(*[np.memmap(self._filename(field),
+                                      dtype=np.float32,
+                                      mode=mode,
+                                      shape=(self.capacity, width))
+                            for field, width in zip(Transition._fields,
+                                                    widths)])
+
+    def _allocate(self, widths):
+        self.memory = self._open(widths, "w+")
+        self.sync()
+
+    def sync(self):
+        """Writes the arrays and the metadata to disk."""
+        self.unsynced = 0
+        if self.memory is None:
+            return
+        for field in self.memory:
+            field.flush()
+        state = {"capacity": self.capacity,
+                 "widths": [field.shape[1] for field in self.memory],
+                 "position": self.position,
+                 "size": self.size}
+        metadata = os.path.join(self.directory, "memory.json")
+        with open(metadata + ".tmp", "w", encoding="utf-8") as fp:
+            json.dump(state, fp)
+        os.replace(metadata + ".tmp", metadata)
+
+    def add(self, *args):
+        """Saves a transition."""
+        super().add(*args)
+        self.unsynced += 1
+        if self.unsynced >= self.sync_interval:
+            self.sync()
+
+    def add_batch(self, *args):
+        """
+        Saves a batch of transitions; every argument holds one row per
+        transition.
+        """
+        super().add_batch(*args)
+        self.unsynced += len(args[0])
+        if self.unsynced >= self.sync_interval:
+            self.sync()
+
+    def grow(self, capacity):
+        """
+        Increases the capacity, keeping every transition in ring order.
+
+        The files are extended in place and remapped; as in
+        ReplayMemory.grow, a wrapped ring is then rotated one field at a time
+        so that the transitions fill rows [0, size), oldest first.
+
+        Args:
+            capacity (int): The new capacity; smaller values are ignored.
+        """
+        if capacity <= self.capacity:
+            return
+        if self.memory is None:
+            self.capacity = capacity
+            return
+
+        old_capacity = self.capacity
+        widths = [field.shape[1] for field in self.memory]
+        for field in self.memory:
+            field.flush()
+        self.memory = None
+        for field, width in zip(Transition._fields, widths):
+            with open(self._filename(field), "r+b") as fp:
+                fp.truncate(capacity * width * np.dtype(np.float32).itemsize)
+        self.capacity = capacity
+        self.memory = self._open(widths, "r+")
+        self._unwrap(old_capacity)
+        self.sync()
+
+    def shuffle(self):
+        """Shuffles the transitions in the replay memory."""
+        super().shuffle()
+        self.sync()
+
+    def _block_rows(self, batch_size, latest):
+        # rows of batch_size / block_size runs of consecutive rows among the
+        # latest transitions, in ring order
+        latest = min(latest, self.size)
+        block_size = min(self.block_size, latest)
+        blocks = -(-batch_size // block_size)
+        starts = np.array([random.randrange(latest - block_size + 1)
+                           for _ in range(blocks)])
+        offsets = (starts[:, None] + np.arange(block_size)).reshape(-1)
+        rows = (self.position - latest + offsets[:batch_size]) % self.capacity
+        return np.sort(rows)
+
+    def sample(self, batch_size, out=None):
+        """
+        Samples a batch of transitions from the replay memory, with the
+        configured sampling strategy.
+
+        Args:
+            batch_size (int): The size of the batch to sample.
+            out (list): Host tensors the batch is gathered into; see
+                ReplayMemory.sample.
+
+        Returns:
+            tuple: A tuple containing the sampled tensors\
+                  (state, action, next_state, reward, done).
+        """
+        if self.sampling == "block":
+            return self._to_tensors(self._block_rows(batch_size, self.size),
+                                    out)
+        rows = np.sort(random.sample(range(self.size), batch_size))
+        return self._to_tensors(rows, out)
+
+    def sample_from_latest(self, batch_size, latest):
+        """
+        Samples a batch of transitions from the latest elements in the\
+              replay memory, with the configured sampling strategy.
+
+        Args:
+            batch_size (int): The size of the batch to sample.
+            latest (int): The number of latest elements to consider.
+
+        Returns:
+            tuple: A tuple containing the sampled tensors\
+                  (state, action, next_state, reward, done).
+        """
+        if self.sampling == "block":
+            return self._to_tensors(self._block_rows(batch_size, latest))
+        latest_rows = self._latest_rows(latest)
+        rows = np.sort(latest_rows[random.sample(range(len(latest_rows)),
+                                                 batch_size)])
+        return self._to_tensors(rows)
+
+    def reset(self):
+        super().reset()
+        self.sync()
+
+class SumTree(object):
+    """
+    A binary tree whose leaves hold non-negative priorities and whose inner
+    nodes hold the sum of their children, stored in one array: node i has
+    the children 2i and 2i+1 and the root is node 1. Setting priorities and
+    finding the leaves of prefix sums take O(log n), vectorised over a batch
+    of leaves.
+
+    Args:
+        capacity (int): The number of leaves.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.leaves = 1 << max(capacity - 1, 0).bit_length()
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    def total(self):
+        """The sum of all priorities."""
+        return self.tree[1]
+
+    def get(self, rows):
+        """The priorities of rows."""
+        return self.tree[self.leaves + np.asarray(rows, dtype=np.int64)]
+
+    def update(self, rows, priorities):
+        """
+        Sets the priorities of rows and recomputes the sums above them,
+        level by level.
+        """
+        nodes = self.leaves + np.asarray(rows, dtype=np.int64)
+        if len(nodes) == 0:
+            return
+        self.tree[nodes] = priorities
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """
+        Rows of the leaves whose prefix sums contain values, i.e. rows drawn
+        with probability proportional to their priority for values drawn
+        uniformly from [0, total()).
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.leaves.bit_length() - 1):
+            left = self.tree[2 * nodes]
+            right = self.tree[2 * nodes + 1]
+            # never descend into an empty subtree, whatever the rounding
+            go_right = ((values >= left) | (left == 0)) & (right > 0)
+            values = np.where(go_right, values - left, values)
+            nodes = 2 * nodes + go_right
+        return nodes - self.leaves
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """
+    A ReplayMemory that samples transitions with probability proportional to
+    their priority, |TD error| + eps raised to alpha, kept in a SumTree.
+
+    New transitions get the largest priority seen so far, so that every
+    transition is replayed at least once soon after it is stored; the
+    trainers refresh the priorities of a batch with its TD errors through
+    update_priorities. Sampling is stratified: the total priority is split
+    into batch_size equal segments and one row is drawn from every segment.
+
+    The importance-sampling weights (size * P(row)) ^ -beta correct the bias
+    of prioritised sampling; they are normalised by the largest weight of
+    the batch, and beta is annealed linearly from its initial value to 1
+    over beta_steps sampled batches.
+
+    Args:
+        capacity (int): The maximum capacity of the replay memory.
+        device (str): The device to store the tensors (e.g., 'cpu', 'cuda').
+        codec (observation_codec): Storage codec of the states.
+        alpha (float): How much prioritisation is used; 0 is uniform.
+        beta (float): Initial importance-sampling exponent.
+        beta_steps (int): Sampled batches over which beta reaches 1.
+        eps (float): Added to |TD error| so no transition has zero priority.
+
+    Attributes:
+        tree (SumTree): The priorities of every row.
+        max_priority (float): The largest priority set so far.
+    """
+
+    def __init__(self, capacity, device, codec=None, alpha=0.6, beta=0.4,
+                 beta_steps=100_000, eps=1e-6):
+        super().__init__(capacity, device, codec=codec)
+        self.alpha = alpha
+        self.beta_start = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.sampled = 0
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+
+    @property
+    def beta(self):
+        fraction = min(self.sampled / max(self.beta_steps, 1), 1.0)
+        return self.beta_start + fraction * (1.0 - self.beta_start)
+
+    def add(self, *args):
+        """Saves a transition."""
+        row = self.position
+        super().add(*args)
+        self.tree.update([row], self.max_priority)
+
+    def add_batch(self, *args):
+        """
+        Saves a batch of transitions; every argument holds one row per
+        transition.
+        """
+        n = min(len(args[0]), self.capacity)
+        position = self.position
+        super().add_batch(*args)
+        self.tree.update((position + np.arange(n)) % self.capacity,
+                         self.max_priority)
+
+    def shuffle(self):
+        """Shuffles the transitions in the replay memory."""
+        if self.memory is None:
+            return
+        order = list(range(self.size))
+        random.shuffle(order)
+        for field in self.memory:
+            field[:self.size] = field[order]
+        self.tree.update(np.arange(self.size), self.tree.get(order))
+
+    def _sample_rows(self, batch_size):
+        segment = self.tree.total() / batch_size
+        values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) \
+            * segment
+        return self.tree.find(values)
+
+    def sample(self, batch_size, out=None):
+        """
+        Samples a batch of transitions by priority, without the
+        importance-sampling weights; see sample_prioritized.
+
+        Args:
+            batch_size (int): The size of the batch to sample.
+            out (list): Host tensors the batch is gathered into; see
+                ReplayMemory.sample.
+
+        Returns:
+            tuple: A tuple containing the sampled tensors\
+                  (state, action, next_state, reward, done).
+        """
+        return self._to_tensors(self._sample_rows(batch_size), out)
+
+    def sample_prioritized(self, batch_size, out=None):
+        """
+        Samples a batch of transitions by priority.
+
+        Args:
+            batch_size (int): The size of the batch to sample.
+            out (list): Host tensors the transitions are gathered into; see
+                ReplayMemory.sample.
+
+        Returns:
+            tuple: The sampled tensors (state, action, next_state, reward,
+            done), the (batch_size, 1) tensor of importance-sampling weights
+            and the rows of the batch, to be passed to update_priorities.
+        """
+        rows = self._sample_rows(batch_size)
+        probabilities = self.tree.get(rows) / self.tree.total()
+        weights = (self.size * probabilities) ** -self.beta
+        weights = (weights / weights.max()).astype(np.float32)
+        self.sampled += 1
+        return (*self._to_tensors(rows, out),
+                torch.from_numpy(weights).reshape(-1, 1).to(self.device),
+                rows)
+
+    def update_priorities(self, rows, td_errors):
+        """
+        Sets the priorities of sampled rows from their TD errors.
+
+        Args:
+            rows (np.ndarray): Rows returned by sample_prioritized.
+            td_errors (np.ndarray): TD error of every row.
+        """
+        priorities = (np.abs(np.reshape(td_errors, -1)) + self.eps) \
+            ** self.alpha
+        self.tree.update(rows, priorities)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+
+    def grow(self, capacity):
+        """
+        Increases the capacity in place, keeping every transition, its
+        priority and the order of the ring.
+
+        Args:
+            capacity (int): The new capacity; smaller values are ignored.
+        """
+        if capacity <= self.capacity:
+            return
+        priorities = self.tree.get(self._latest_rows(self.size))
+        super().grow(capacity)
+        self.tree = SumTree(capacity)
+        self.tree.update(self._latest_rows(self.size), priorities)
+
+    def reset(self):
+        super().reset()
+        self.tree = SumTree(self.capacity)
+        self.max_priority = 1.0
+
+def make_replay_memory(hyperparameters, device, log_dir=None):
+    """
+    Creates the replay memory selected by the hyperparameters.
+
+    "replay_buffer" is "host" (ReplayMemory, the default), "device"
+    (DeviceReplayMemory), "memmap" (MemmapReplayMemory) or "prioritized"
+    (PrioritizedReplayMemory). A memmap memory is stored in
+    "replay_buffer_dir", or in log_dir/replay_buffer when that is not
+    given, and sampled with "replay_buffer_sampling" ("uniform" or
+    "block"). A prioritized memory is configured with "per_alpha",
+    "per_beta" and "per_beta_steps". "observation_codec" (a scheme of
+    observation_codec, e.g. "compact") stores the states of host and
+    prioritized memories compressed. Hyperparameter files written before
+    these options existed use the host memory, uncompressed.
+
+    Args:
+        hyperparameters (dict): The model hyperparameters.
+        device (str): The training device.
+        log_dir (str): Log directory of the run.
+    """
+    replay_buffer = hyperparameters.get("replay_buffer", "host")
+    capacity = hyperparameters["buffer_size"]
+    codec = None
+    if hyperparameters.get("observation_codec", None) is not None:
+        if replay_buffer not in ("host", "prioritized"):
+            raise ValueError("observation_codec needs a host or prioritized"
+                             " replay_buffer")
+        codec = observation_codec(hyperparameters["observation_codec"])
+    if replay_buffer == "host":
+        return ReplayMemory(capacity, device=device, codec=codec)
+    if replay_buffer == "device":
+        return DeviceReplayMemory(capacity, device=device)
+    if replay_buffer == "memmap":
+        directory = hyperparameters.get("replay_buffer_dir", None)
+        if directory is None and log_dir is not None:
+            directory = os.path.join(log_dir, "replay_buffer")
+        if directory is None:
+            raise ValueError("a memmap replay buffer needs replay_buffer_dir"
+                             " or a log directory")
+        return MemmapReplayMemory(
+            capacity,
+            device=device,
+            directory=directory,
+            sampling=hyperparameters.get("replay_buffer_sampling", "uniform"))
+    if replay_buffer == "prioritized":
+        return PrioritizedReplayMemory(
+            capacity,
+            device=device,
+            codec=codec,
+            alpha=hyperparameters.get("per_alpha", 0.6),
+            beta=hyperparameters.get("per_beta", 0.4),
+            beta_steps=hyperparameters.get("per_beta_steps", 100_000))
+    raise ValueError(f"unknown replay_buffer '{replay_buffer}'")
+
+class BatchPrefetcher(object):
+    """
+    Wraps a replay memory and samples its next batches on a background
+    thread, so that sampling, tensor construction and host to device copies
+    are off the critical path of the gradient updates.
+
+    The wrapper is used in place of the memory while training: sample (and
+    sample_prioritized for prioritized memories) pop a prefetched batch of
+    batch_size transitions, every other attribute is that of the memory.
+    Writes to the memory (add, add_batch, update_priorities, grow, shuffle,
+    reset) and sampling are serialised by a lock, so a batch never sees a
+    transition half written. A batch can be up to depth updates older than
+    the memory it is popped from; batches sampled before a grow, shuffle or
+    reset, whose rows no longer address their transitions, are discarded
+    when popped. The thread starts with the first sample, once the memory
+    holds enough transitions. On CUDA devices batches are prepared on a side
+    stream, and host memories gather them into a ring of pinned buffers, one
+    per queue slot plus the one being filled, so that their copies to the
+    device do not block; a buffer is refilled once its last copy is done.
+
+    Since the background thread draws from the global random generators,
+    training with prefetching is not reproducible for a given seed.
+
+    Args:
+        memory: The replay memory.
+        batch_size (int): The size of the prefetched batches.
+        depth (int): Number of batches prepared ahead.
+
+    Attributes:
+        replay_memory: The wrapped replay memory.
+        batches (int): Number of batches popped.
+        stalls (int): Number of pops that waited for the thread.
+        stall_time (float): Seconds spent waiting for the thread.
+        generation (int): Incremented by grow, shuffle and reset; batches
+            carry the generation they were sampled in.
+        staging (list): depth + 1 lists of pinned (batch_size, width) host
+            tensors, one per Transition field; None on CPU devices, for
+            DeviceReplayMemory and before the first batch.
+    """
+
+    def __init__(self, memory, batch_size, depth=2):
+        self.replay_memory = memory
+        self.batch_size = batch_size
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.ready = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.thread = None
+        self.error = None
+        self.stream = None
+        if torch.device(memory.device).type == "cuda":
+            self.stream = torch.cuda.Stream(torch.device(memory.device))
+        self.batches = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.generation = 0
+        self.staging = None
+        # events recorded after the last copy of every staging slot
+        self.copied = [None] * (depth + 1)
+        self.slot = 0
+
+    def __getattr__(self, name):
+        # everything not defined here is the memory's
+        return getattr(self.__dict__["replay_memory"], name)
+
+    def __len__(self):
+        return len(self.replay_memory)
+
+    def _sample(self, out=None):
+        kwargs = {} if out is None else {"out": out}
+        with self.lock:
+            if len(self.replay_memory) < self.batch_size:
+                # emptied by reset
+                return None, self.generation
+            if isinstance(self.replay_memory, PrioritizedReplayMemory):
+                batch = self.replay_memory.sample_prioritized(self.batch_size,
+                                                              **kwargs)
+            else:
+                batch = self.replay_memory.sample(self.batch_size, **kwargs)
+            return batch, self.generation
+
+    def _staging_slot(self):
+        # pinned buffers of the next batch, once their last copy is done
+        if self.staging is None:
+            return None
+        if self.copied[self.slot] is not None:
+            self.copied[self.slot].synchronize()
+        return self.staging[self.slot]
+
+    def _allocate_staging(self, batch):
+        # shaped like the fields of a batch sampled without buffers
+        if not isinstance(self.replay_memory, ReplayMemory):
+            return
+        self.staging = [[torch.empty(tuple(tensor.shape),
+                                     dtype=tensor.dtype,
+                                     pin_memory=True)
+                         for tensor in batch[:len(Transition._fields)]]
+                        for _ in range(self.depth + 1)]
+
+    def _run(self):
+        try:
+            while not self.stop.is_set():
+                event = None
+                if self.stream is None:
+                    batch, generation = self._sample()
+                else:
+                    with torch.cuda.stream(self.stream):
+                        out = self._staging_slot()
+                        batch, generation = self._sample(out)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                    if batch is not None and out is not None:
+                        self.copied[self.slot] = event
+                        self.slot = (self.slot + 1) % len(self.copied)
+                    elif batch is not None and self.staging is None:
+                        self._allocate_staging(batch)
+                if batch is None:
+                    self.stop.wait(0.01)
+                    continue
+                while not self.stop.is_set():
+                    try:
+                        self.ready.put((batch, event, generation),
+                                       timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as error: # pylint: disable=broad-except
+            # raised again by the next pop
+            self.error = error
+
+    def _pop(self, batch_size):
+        if batch_size != self.batch_size:
+            with self.lock:
+                return self.replay_memory.sample(batch_size)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+        self.batches += 1
+        start = None
+        while True:
+            try:
+                batch, event, generation = self.ready.get_nowait()
+            except queue.Empty:
+                if start is None:
+                    self.stalls += 1
+                    start = time.perf_counter()
+                if self.error is not None:
+                    raise self.error
+                try:
+                    batch, event, generation = self.ready.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            # generation is only changed by this (the training) thread
+            if generation == self.generation:
+                break
+        if start is not None:
+            self.stall_time += time.perf_counter() - start
+
+        if event is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_event(event)
+            for tensor in batch:
+                if isinstance(tensor, torch.Tensor):
+                    # memory allocated on the side stream, used on this one
+                    tensor.record_stream(stream)
+        return batch
+
+    def sample(self, batch_size):
+        """
+        Pops the next batch; see ReplayMemory.sample.
+        """
+        return self._pop(batch_size)
+
+    def sample_prioritized(self, batch_size):
+        """
+        Pops the next batch; see PrioritizedReplayMemory.sample_prioritized.
+        """
+        return self._pop(batch_size)
+
+    def add(self, *args):
+        with self.lock:
+            self.replay_memory.add(*args)
+
+    def add_batch(self, *args):
+        with self.lock:
+            self.replay_memory.add_batch(*args)
+
+    def update_priorities(self, rows, td_errors):
+        with self.lock:
+            self.replay_memory.update_priorities(rows, td_errors)
+
+    def grow(self, capacity):
+        with self.lock:
+            self.replay_memory.grow(capacity)
+            self.generation += 1
+
+    def shuffle(self):
+        with self.lock:
+            self.replay_memory.shuffle()
+            self.generation += 1
+
+    def reset(self):
+        with self.lock:
+            self.replay_memory.reset()
+            self.generation += 1
+
+    def stall_fraction(self):
+        """The fraction of pops that waited for the thread."""
+        return self.stalls / max(self.batches, 1)
+
+    def close(self):
+        """
+        Stops the thread and returns the memory.
+        """
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self.replay_memory
+
+def is_prioritized(memory):
+    """
+    Whether memory, or the memory a BatchPrefetcher wraps, samples by
+    priority.
+    """
+    if isinstance(memory, BatchPrefetcher):
+        memory = memory.replay_memory
+    return isinstance(memory, PrioritizedReplayMemory)